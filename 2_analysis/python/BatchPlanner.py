@@ -0,0 +1,141 @@
+#' ---
+#' title: "Batch Planner"
+#' ---
+
+#' This script replays a large batch of journey requests against one
+#' timetable, for example historic requests for a capacity study.
+#'
+#' Rather than planning each query in turn, the queries are grouped so that
+#' Leave After queries from the same station at the same minute (and Arrive
+#' Before queries to the same station at the same minute) share a single
+#' scan of the timetable. See `ConnectionScan.find_journeys`. The groups are
+#' packed into tasks which are spread over a process pool, each process
+#' memory-mapping the same [binary timetable](TimetableStore.html), and the
+#' journeys are streamed back as each task finishes.
+#'
+#' The queries are read from a CSV file with the columns `From_StopPointName`,
+#' `To_StopPointName`, `time` (minutes past midnight), `leave_after` and
+#' optionally `date` (YYYY-MM-DD, for timetables with a
+#' [ServiceCalendar](ServiceCalendar.html)) and the journeys are written
+#' as JSON lines in the order they finish:
+#'
+#' `$python3 python/BatchPlanner.py --jobs 4 DeparturesTimetable20171218 queries.csv journeys.jsonl`
+#'
+#' [Source code](https://github.com/ruaridhw/london-tube/blob/master/2_analysis/python/BatchPlanner.py)
+
+#+ batchplanner, engine='python'
+import os
+
+import click
+
+from ConnectionScan import ConnectionScan
+
+# Timetable of each worker process
+_cs = None
+
+def _init_worker(path):
+    from TimetableStore import load_timetable
+
+    global _cs
+    _cs = load_timetable(path)
+
+def _plan(task):
+    """
+        task    List of (index, path query) pairs
+
+        Returns a list of (index, Journey) pairs
+    """
+    journeys = _cs.find_journeys([path_query for i, path_query in task])
+    return [(i, journey) for (i, path_query), journey in zip(task, journeys)]
+
+def make_tasks(path_queries, task_size=500):
+    """
+        Group the queries by ConnectionScan.group_key and pack whole groups
+        into tasks of roughly `task_size` queries
+
+        Returns a list of lists of (index, path query) pairs
+    """
+    groups = {}
+    for i, path_query in enumerate(path_queries):
+        groups.setdefault(ConnectionScan.group_key(path_query), []).append((i, path_query))
+
+    tasks = [[]]
+    for key in sorted(groups, key=repr):
+        if len(tasks[-1]) >= task_size:
+            tasks.append([])
+        tasks[-1].extend(groups[key])
+    return [task for task in tasks if task]
+
+def plan_journeys(timetable, path_queries, jobs=1, task_size=500):
+    """
+        timetable       Location of the timetable. See TimetableStore.load_timetable
+        path_queries    List of query dictionaries as per ShortestPath.example_path_query
+        jobs            Number of worker processes. 0 uses every core
+        task_size       Approximate number of queries sent to a worker at a time
+
+        Yields (index, Journey) pairs in the order they are planned
+        where `index` is the position of the query in `path_queries`
+    """
+    import concurrent.futures
+
+    tasks = make_tasks(path_queries, task_size)
+    if jobs == 1:
+        _init_worker(timetable)
+        for task in tasks:
+            yield from _plan(task)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(jobs or os.cpu_count(),
+                                                initializer=_init_worker,
+                                                initargs=(timetable,)) as executor:
+        futures = [executor.submit(_plan, task) for task in tasks]
+        for future in concurrent.futures.as_completed(futures):
+            yield from future.result()
+
+def read_queries(file):
+    """
+        Returns the list of path queries in a CSV file
+    """
+    import csv
+
+    path_queries = []
+    with open(file, newline='') as f:
+        for row in csv.DictReader(f):
+            path_query = {
+                'From_StopPointName': row['From_StopPointName'],
+                'To_StopPointName': row['To_StopPointName'],
+                'time': float(row['time']),
+                'leave_after': row['leave_after'].strip().lower() in ('true', 't', '1', 'yes')
+            }
+            if row.get('date'):
+                path_query['date'] = row['date'].strip()
+            path_queries.append(path_query)
+    return path_queries
+
+@click.command()
+@click.argument('timetable', required=1, type=click.Path(exists=True))
+@click.argument('queries_file', required=1, type=click.Path(exists=True))
+@click.argument('output_file', required=1, type=click.Path())
+@click.option('--jobs', '-j', default=1, help='Number of processes. 0 uses every core')
+@click.option('--task-size', default=500, help='Number of queries sent to a process at a time')
+def main(timetable, queries_file, output_file, jobs, task_size):
+    """
+        Plan the journey of every query in QUERIES_FILE against TIMETABLE
+        and write them to OUTPUT_FILE as JSON lines
+    """
+    import json
+    import time
+
+    from ShortestPath import journey_to_dict
+
+    path_queries = read_queries(queries_file)
+    then = time.perf_counter()
+    with open(output_file, 'w') as f:
+        for i, journey in plan_journeys(timetable, path_queries, jobs, task_size):
+            f.write(json.dumps({'query': i, 'journey': journey_to_dict(journey)}) + '\n')
+    elapsed = time.perf_counter() - then
+    print('Planned {} journeys in {:.1f}s ({:.0f} queries/s)'.format(
+        len(path_queries), elapsed, len(path_queries) / elapsed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,907 @@
+#' ---
+#' title: "Benchmarks"
+#' ---
+
+#' This script collects the command line benchmarks used to measure
+#' the journey planners in [ShortestPath.py](ShortestPath.html) (with and
+#' without the [StationBounds.py](StationBounds.html) of A*) and
+#' [ConnectionScan.py](ConnectionScan.html), the
+#' [JourneyCache.py](JourneyCache.html) in front of them, the XML extraction
+#' and duration parsing in [TfLTimetable.py](TfLTimetable.html) and the
+#' encoding of the Feather files written by [XMLParsing.py](XMLParsing.html).
+#' The `suite` benchmark runs the whole pipeline on timetables written by
+#' [SyntheticTransXChange.py](SyntheticTransXChange.html) and `load`
+#' generates requests to the [JourneyServer.py](JourneyServer.html).
+#'
+#' The benchmarks only report timings. That the faster code gives the same
+#' answers as the code it replaces is checked by the tests in `tests/`,
+#' other than by `suite` which fails if its journeys differ from the
+#' Dijkstra search.
+#'
+#' Each benchmark is a subcommand. For usage see
+#' `python3 python/Benchmarks.py --help`
+#'
+#' [Source code](https://github.com/ruaridhw/london-tube/blob/master/2_analysis/python/Benchmarks.py)
+
+#+ benchmarks, engine='python'
+import os
+import random
+import time
+
+import click
+
+@click.group()
+def cli():
+    """
+        Benchmarks for the London Underground analysis modules
+    """
+
+def random_queries(station_names, n, seed=0):
+    """
+        station_names   List of station names to pick origins and destinations from
+        n               Number of queries
+
+        Returns a reproducible list of path queries between 06:00 and 22:00
+    """
+    rnd = random.Random(seed)
+    queries = []
+    for _ in range(n):
+        origin, destination = rnd.sample(station_names, 2)
+        queries.append({
+            'From_StopPointName': origin,
+            'To_StopPointName': destination,
+            'time': rnd.uniform(6 * 60, 22 * 60),
+            'leave_after': rnd.random() < 0.5
+        })
+    return queries
+
+def load_planner(graph_file, engine):
+    """
+        graph_file   Location of a Departures Board NetworkX GPickle object
+                     or a timetable directory written by TimetableStore.py
+        engine       'dijkstra' for ShortestPath.JourneyPlanner
+                     or 'csa' for ConnectionScan.ConnectionScan
+
+        Returns the planner, a function running one query and the station names
+    """
+    if os.path.isdir(graph_file):
+        if engine != 'csa':
+            raise click.BadParameter('A timetable directory can only be used with the csa engine')
+        from TimetableStore import read_timetable
+        planner = read_timetable(graph_file)
+        return planner, planner.find_journey, sorted(planner.stop_names)
+
+    from DeparturesGraph import read_gpickle
+
+    H = read_gpickle(graph_file)
+    station_names = sorted({n_data['StopPointName'] for n, n_data in H.nodes(data=True)
+                            if n not in ('Start', 'End')})
+    if engine == 'dijkstra':
+        from ShortestPath import JourneyPlanner
+        planner = JourneyPlanner(H)
+        return planner, planner.find_journey, station_names
+    else:
+        from ConnectionScan import ConnectionScan
+        planner = ConnectionScan.from_graph(H)
+        return planner, planner.find_journey, station_names
+
+# Query function inherited by forked worker processes
+_find = None
+
+def _run_query(query):
+    return _find(query)
+
+#' ## Concurrency
+#'
+#' Runs the same batch of queries against one shared planner
+#' with an increasing number of workers and reports queries per second.
+#' Threads share the planner directly. Processes are forked after the
+#' planner has been loaded so they share its pages copy-on-write.
+
+@cli.command()
+@click.argument('graph_file', type=click.Path(exists=True))
+@click.option('--engine', type=click.Choice(['dijkstra', 'csa']), default='csa',
+              help='Journey planner to benchmark')
+@click.option('--executor', type=click.Choice(['thread', 'process']), default='thread',
+              help='Run queries in a thread or process pool')
+@click.option('--workers', default='1,2,4,8', help='Comma separated worker counts')
+@click.option('--queries', default=200, help='Number of queries per worker count')
+@click.option('--seed', default=0, help='Random seed for the queries')
+def concurrency(graph_file, engine, executor, workers, queries, seed):
+    """
+        Measure journey planning throughput as workers scale
+    """
+    import concurrent.futures
+    import multiprocessing
+
+    global _find
+    then = time.perf_counter()
+    planner, _find, station_names = load_planner(graph_file, engine)
+    print('Loaded {} planner in {:.2f}s'.format(engine, time.perf_counter() - then))
+
+    batch = random_queries(station_names, queries, seed)
+    print('{:>8} {:>10} {:>8}'.format('workers', 'queries/s', 'speedup'))
+    baseline = None
+    for n_workers in [int(w) for w in workers.split(',')]:
+        if executor == 'thread':
+            pool = concurrent.futures.ThreadPoolExecutor(n_workers)
+        else:
+            pool = concurrent.futures.ProcessPoolExecutor(
+                n_workers, mp_context=multiprocessing.get_context('fork'))
+        with pool:
+            # Start every worker before timing
+            list(pool.map(_run_query, batch[:n_workers]))
+            then = time.perf_counter()
+            list(pool.map(_run_query, batch))
+            qps = len(batch) / (time.perf_counter() - then)
+        baseline = baseline or qps
+        print('{:>8} {:>10.1f} {:>7.2f}x'.format(n_workers, qps, qps / baseline))
+
+#' ## Goal-directed search
+#'
+#' Runs the same queries through JourneyPlanner with Dijkstra's algorithm
+#' and with A* directed by the StationBounds of the graph. Reports the nodes
+#' settled and the latency of each for Leave After and Arrive Before
+#' queries. That A* finds journeys arriving as early (Leave After) or
+#' leaving as late (Arrive Before) as Dijkstra's algorithm is checked by
+#' `tests/test_StationBounds.py`.
+
+@cli.command()
+@click.argument('graph_file', type=click.Path(exists=True))
+@click.option('--queries', default=500, help='Number of queries')
+@click.option('--seed', default=0, help='Random seed for the queries')
+def astar(graph_file, queries, seed):
+    """
+        Measure the nodes settled and latency of A* against Dijkstra
+    """
+    import numpy as np
+
+    from DeparturesGraph import read_gpickle
+    from ShortestPath import JourneyPlanner
+
+    H = read_gpickle(graph_file)
+    dijkstra = JourneyPlanner(H, astar=False)
+    then = time.perf_counter()
+    a_star = JourneyPlanner(H)
+    print('Station bounds of {} stations in {:.2f}s'.format(
+        len(a_star.bounds.stations), time.perf_counter() - then))
+
+    station_names = sorted(dijkstra.index.stations.names)
+    results = {}
+    for query in random_queries(station_names, queries, seed):
+        for name, planner in (('dijkstra', dijkstra), ('astar', a_star)):
+            stats = {}
+            then = time.perf_counter()
+            planner.find_path(query, stats)
+            seconds = time.perf_counter() - then
+            results.setdefault((query['leave_after'], name), []).append((stats['settled'], seconds))
+
+    print('{:<14} {:<9} {:>8} {:>14} {:>8} {:>8} {:>8}'.format(
+        'query', 'search', 'queries', 'nodes settled', 'mean ms', 'p50 ms', 'p90 ms'))
+    for (leave_after, name), measured in sorted(results.items(), reverse=True):
+        settled, seconds = np.array(measured).T
+        p50, p90 = np.percentile(seconds, [50, 90]) * 1e3
+        print('{:<14} {:<9} {:>8} {:>14.0f} {:>8.2f} {:>8.2f} {:>8.2f}'.format(
+            'Leave After' if leave_after else 'Arrive Before', name, len(measured),
+            settled.mean(), seconds.mean() * 1e3, p50, p90))
+
+#' ## Journey cache
+#'
+#' Runs a peak hour query mix concentrated on a few station pairs with
+#' and without a JourneyCache in front of the planner. That every cached
+#' journey is the planner's journey is checked by `tests/test_JourneyCache.py`.
+
+@cli.command()
+@click.argument('graph_file', type=click.Path(exists=True))
+@click.option('--engine', type=click.Choice(['dijkstra', 'csa']), default='csa',
+              help='Journey planner to benchmark')
+@click.option('--pairs', default=200, help='Number of distinct station pairs')
+@click.option('--queries', default=20000, help='Number of queries')
+@click.option('--bucket', default=5, help='Cache bucket width in minutes')
+@click.option('--maxsize', default=10000, help='Maximum number of cached station pairs and buckets')
+@click.option('--seed', default=0, help='Random seed for the queries')
+def cache(graph_file, engine, pairs, queries, bucket, maxsize, seed):
+    """
+        Measure the hit rate and latency of the journey cache
+    """
+    from JourneyCache import JourneyCache
+
+    planner, find, station_names = load_planner(graph_file, engine)
+    rnd = random.Random(seed)
+    station_pairs = [rnd.sample(station_names, 2) for _ in range(pairs)]
+    batch = []
+    for _ in range(queries):
+        origin, destination = rnd.choice(station_pairs)
+        batch.append({
+            'From_StopPointName': origin,
+            'To_StopPointName': destination,
+            # Morning peak
+            'time': min(max(rnd.gauss(8.5 * 60, 30), 6 * 60), 11 * 60),
+            'leave_after': rnd.random() < 0.7
+        })
+
+    journey_cache = JourneyCache(planner, bucket=bucket, maxsize=maxsize)
+    then = time.perf_counter()
+    for query in batch:
+        find(query)
+    uncached = time.perf_counter() - then
+
+    then = time.perf_counter()
+    for query in batch:
+        journey_cache.find_journey(query)
+    with_cache = time.perf_counter() - then
+
+    info = journey_cache.cache_info()
+    print('{} queries over {} station pairs'.format(queries, pairs))
+    print('Hit rate {:.1%} ({} hits, {} misses)'.format(info.hits / queries, info.hits, info.misses))
+    print('Mean query time {:.1f}us uncached, {:.1f}us cached'.format(
+        1e6 * uncached / queries, 1e6 * with_cache / queries))
+    then = time.perf_counter()
+    for query in batch[-100:]:
+        journey_cache.find_journey(query)
+    print('Mean repeated query time {:.1f}us'.format(1e6 * (time.perf_counter() - then) / 100))
+
+#' ## Extraction
+#'
+#' Compares the single pass `TfLTimetable.get_df` with the original one XPath
+#' per column method `get_df_by_column` on every table of every XML file
+#' found in a directory such as the tube timetables. That both extract the
+#' same tables is checked by `tests/test_TfLTimetable.py`.
+
+@cli.command()
+@click.argument('input_dir', type=click.Path(exists=True))
+@click.option('--repeat', default=3, help='Number of times to extract each table')
+def extract(input_dir, repeat):
+    """
+        Measure table extraction time per method on the XML files in INPUT_DIR
+    """
+    import TfLTimetable as tfl
+
+    files = sorted(os.path.join(input_dir, f) for f in os.listdir(input_dir) if f.endswith('.xml'))
+    totals = {}
+    for file in files:
+        timetable = tfl.TfLTimetable(file)
+        for table, paths in timetable.required_xpaths.items():
+            root = timetable.required_roots[table]
+            rows, by_column, single_pass = totals.get(table, (0, 0.0, 0.0))
+
+            then = time.perf_counter()
+            for _ in range(repeat):
+                df = timetable.get_df(paths, root)
+            single_pass += (time.perf_counter() - then) / repeat
+
+            then = time.perf_counter()
+            try:
+                for _ in range(repeat):
+                    timetable.get_df_by_column(paths)
+            except ValueError:
+                # Columns of different lengths cannot be extracted by column
+                by_column = float('nan')
+            else:
+                by_column += (time.perf_counter() - then) / repeat
+
+            totals[table] = (rows + len(df), by_column, single_pass)
+
+    print('{} files'.format(len(files)))
+    print('{:<28} {:>9} {:>11} {:>12} {:>8}'.format('table', 'rows', 'by column', 'single pass', 'speedup'))
+    for table, (rows, by_column, single_pass) in sorted(totals.items()):
+        print('{:<28} {:>9} {:>10.3f}s {:>11.3f}s {:>7.2f}x'.format(
+            table, rows, by_column, single_pass, by_column / single_pass))
+
+#' ## Durations
+#'
+#' Compares `TfLTimetable.duration_seconds` and `time_of_day_seconds` with
+#' parsing each row in turn on the RunTime, WaitTime and DepartureTime
+#' columns of every XML file found in a directory. The seconds are checked
+#' against the conversion of [VariableCreation.R](VariableCreation.html) by
+#' `tests/test_TfLTimetable.py`.
+
+@cli.command()
+@click.argument('input_dir', type=click.Path(exists=True))
+@click.option('--repeat', default=3, help='Number of times to convert each column')
+def durations(input_dir, repeat):
+    """
+        Measure duration parsing time per method on the XML files in INPUT_DIR
+    """
+    import re
+
+    import numpy as np
+    import pandas as pd
+
+    from TfLTimetable import TfLTimetable
+
+    files = sorted(os.path.join(input_dir, f) for f in os.listdir(input_dir) if f.endswith('.xml'))
+    tables = [TfLTimetable.stream_tables(file) for file in files]
+    # Table, vectorised method and the pattern and multipliers of each row
+    columns = {
+        'RunTime': ('JourneyPatternTimingLinks', TfLTimetable.duration_seconds,
+                    TfLTimetable._duration, (86400, 3600, 60, 1)),
+        'WaitTime': ('JourneyPatternTimingLinks', TfLTimetable.duration_seconds,
+                     TfLTimetable._duration, (86400, 3600, 60, 1)),
+        'DepartureTime': ('VehicleJourneys', TfLTimetable.time_of_day_seconds,
+                          TfLTimetable._time_of_day, (3600, 60, 1))
+    }
+
+    def row_by_row(values, pattern, multipliers):
+        seconds = []
+        for value in values:
+            match = re.match(pattern, value.strip()) if isinstance(value, str) else None
+            if match is None or not any(match.groups()):
+                seconds.append(float('nan'))
+            else:
+                seconds.append(sum(float(group) * multiplier
+                                   for group, multiplier in zip(match.groups(), multipliers)
+                                   if group is not None))
+        return np.array(seconds)
+
+    print('{} files'.format(len(files)))
+    print('{:<14} {:>9} {:>11} {:>11} {:>8}'.format(
+        'column', 'rows', 'row by row', 'vectorised', 'speedup'))
+    for col, (table, convert, pattern, multipliers) in columns.items():
+        values = pd.concat([t[table][col] for t in tables], ignore_index=True)
+        strings = [value if isinstance(value, str) else None for value in values.tolist()]
+
+        then = time.perf_counter()
+        for _ in range(repeat):
+            row_by_row(strings, pattern.pattern, multipliers)
+        by_row = (time.perf_counter() - then) / repeat
+
+        then = time.perf_counter()
+        for _ in range(repeat):
+            convert(values)
+        vectorised = (time.perf_counter() - then) / repeat
+
+        print('{:<14} {:>9} {:>10.3f}s {:>10.3f}s {:>7.1f}x'.format(
+            col, len(values), by_row, vectorised, by_row / vectorised))
+
+#' ## Encoding
+#'
+#' Compares the Feather files written by XMLParsing.py with the same tables
+#' written with every categorical and numeric cast column as text, as they
+#' were before they were encoded. Reports the size on disk, the time to
+#' read each file and the memory of the DataFrames read.
+
+@cli.command()
+@click.argument('data_dir', type=click.Path(exists=True))
+@click.option('--repeat', default=3, help='Number of times to read each file')
+def encoding(data_dir, repeat):
+    """
+        Measure the size and load time of the encoded Feather files in DATA_DIR
+    """
+    import tempfile
+
+    import feather
+
+    from XMLParsing import numeric_casts
+
+    def text(tablename, df):
+        df = df.copy()
+        for col in df.columns:
+            if df[col].dtype.name == 'category' or col in numeric_casts.get(tablename, []):
+                df[col] = [None if value != value else str(value) for value in df[col].tolist()]
+        return df
+
+    def measure(file):
+        then = time.perf_counter()
+        for _ in range(repeat):
+            df = feather.read_dataframe(file)
+        return (os.path.getsize(file), (time.perf_counter() - then) / repeat,
+                df.memory_usage(deep=True).sum())
+
+    totals = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for file in sorted(os.listdir(data_dir)):
+            if not file.endswith('.feather'):
+                continue
+            tablename = file[:-len('.feather')].split('-', 1)[1]
+            encoded = os.path.join(data_dir, file)
+            plain = os.path.join(tmp_dir, file)
+            feather.write_dataframe(text(tablename, feather.read_dataframe(encoded)), plain)
+            before, after = measure(plain), measure(encoded)
+            total = totals.get(tablename, [0] * 6)
+            totals[tablename] = [t + m for t, m in zip(total, before + after)]
+
+    def mb(n):
+        return n / 1e6
+
+    print('{:<58} {:>17} {:>17} {:>17}'.format('', 'file MB', 'read ms', 'memory MB'))
+    print('{:<58} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}'.format(
+        'table', 'text', 'encoded', 'text', 'encoded', 'text', 'encoded'))
+    rows = sorted(totals.items()) + [('TOTAL', [sum(c) for c in zip(*totals.values())])]
+    for tablename, (size, read, memory, size_enc, read_enc, memory_enc) in rows:
+        print('{:<58} {:>8.2f} {:>8.2f} {:>8.1f} {:>8.1f} {:>8.2f} {:>8.2f}'.format(
+            tablename, mb(size), mb(size_enc), 1e3 * read, 1e3 * read_enc,
+            mb(memory), mb(memory_enc)))
+
+#' ## Partitioned datasets
+#'
+#' Compares reading the tables of the departure board from the Feather files
+#' and from the Parquet datasets written by `XMLParsing.py --format parquet`
+#' of the same timetables. Every column of every Line is read as the
+#' readers did before [TableDataset.py](TableDataset.html) and then only the
+#' columns used, only the Lines running on a date and only the given Lines.
+#' That both layouts read the same tables is checked by
+#' `tests/test_TableDataset.py`.
+
+@cli.command()
+@click.argument('feather_dir', type=click.Path(exists=True))
+@click.argument('dataset_dir', type=click.Path(exists=True))
+@click.option('--date', 'timetable_date', default='2017-12-18',
+              help='ISO formatted date to read the running Lines of')
+@click.option('--line', 'lines', multiple=True, help='Line code to read. The first Line if not given')
+@click.option('--repeat', default=3, help='Number of times to read the tables')
+def dataset(feather_dir, dataset_dir, timetable_date, lines, repeat):
+    """
+        Measure reading the tables in FEATHER_DIR and in DATASET_DIR with
+        column projection and Line pruning
+    """
+    from Departures import read_tables, required_tables
+    from TableDataset import table_lines
+
+    lines = list(lines) or table_lines(feather_dir, 'VehicleJourneys')[:1]
+    reads = [
+        ('every column', dict(columns=None)),
+        ('used columns', dict()),
+        ('running on ' + timetable_date, dict(timetable_date=timetable_date)),
+        ('lines ' + ','.join(lines), dict(lines=lines))
+    ]
+
+    print('{:<28} {:>12} {:>12} {:>10}'.format('read', 'feather ms', 'dataset ms', 'rows'))
+    for name, kwargs in reads:
+        times = []
+        for data_dir in (feather_dir, dataset_dir):
+            then = time.perf_counter()
+            for _ in range(repeat):
+                tables = read_tables(data_dir, required_tables, **kwargs)
+            times.append((time.perf_counter() - then) / repeat)
+            rows = sum(len(df) for df in tables.values() if df is not None)
+        print('{:<28} {:>12.1f} {:>12.1f} {:>10}'.format(name, 1e3 * times[0], 1e3 * times[1], rows))
+
+#' ## Vehicle positions
+#'
+#' Compares finding the trains running at each frame of an animation as
+#' NumberOfTrainsPointInTime.sql does, by grouping the whole departure board
+#' by vehicle for every frame, with `VehiclePositions.at` for every frame and
+#' with `VehiclePositions.frames` for all of them at once. The grouping is
+#' only timed on a sample of the frames. That both find the same trains is
+#' checked by `tests/test_VehiclePositions.py`.
+
+def _trains_point_in_time(df, t):
+    """
+        The VehicleJourneyCodes of NumberOfTrainsPointInTime.sql at minute `t`
+    """
+    by_vehicle = df.groupby('VehicleJourneyCode')
+    running = (by_vehicle['DepartureMins_Link'].transform('min') <= t) & \
+        (by_vehicle['ArrivalMins_Link'].transform('max') > t)
+    return set(df.loc[running, 'VehicleJourneyCode'])
+
+@cli.command()
+@click.argument('departure_board', type=click.Path(exists=True))
+@click.option('--start', default=300.0, help='Minute of the first frame')
+@click.option('--end', default=1440.0, help='Minute after the last frame')
+@click.option('--step', default=1.0, help='Minutes between frames')
+@click.option('--sample', default=20, help='Number of frames to time the grouping on')
+def positions(departure_board, start, end, step, sample):
+    """
+        Measure finding the position of every train in every animation frame
+    """
+    import feather
+    import numpy as np
+
+    from VehiclePositions import VehiclePositions
+
+    df = feather.read_dataframe(departure_board)
+    minutes = np.arange(start, end, step)
+    sampled = minutes[np.linspace(0, len(minutes) - 1, min(sample, len(minutes))).astype(int)]
+
+    then = time.perf_counter()
+    for t in sampled:
+        _trains_point_in_time(df, t)
+    grouping = (time.perf_counter() - then) / len(sampled) * len(minutes)
+
+    then = time.perf_counter()
+    index = VehiclePositions(df)
+    build = time.perf_counter() - then
+
+    then = time.perf_counter()
+    for t in minutes:
+        index.at(t)
+    per_frame = time.perf_counter() - then
+
+    then = time.perf_counter()
+    frames = index.frames(start, end, step)
+    sweep = time.perf_counter() - then
+
+    print('{} frames, {} positions. Index built in {:.2f}s'.format(len(minutes), len(frames), build))
+    print('{:<28} {:>10}'.format('method', 'seconds'))
+    print('{:<28} {:>10.2f}'.format('grouping per frame (est.)', grouping))
+    print('{:<28} {:>10.2f}'.format('VehiclePositions.at', per_frame))
+    print('{:<28} {:>10.2f}'.format('VehiclePositions.frames', sweep))
+
+#' ## Station locations
+#'
+#' Compares the grid of `StationIndex.StationLocations` with measuring the
+#' distance to every StopPoint for random points around the StopPoints.
+#' That both find the same stations is checked by `tests/test_StationIndex.py`.
+
+@cli.command()
+@click.argument('stop_points_file', type=click.Path(exists=True))
+@click.option('--queries', default=2000, help='Number of random points')
+@click.option('--radius', default=1000.0, help='Radius in metres of the within queries')
+@click.option('--k', default=3, help='Number of nearest stations')
+@click.option('--seed', default=0, help='Random seed for the points')
+def locations(stop_points_file, queries, radius, k, seed):
+    """
+        Measure nearest and within radius station lookups on a StopPoints Feather file
+    """
+    import feather
+    import numpy as np
+    import pandas as pd
+
+    from StationIndex import StationLocations
+
+    df = feather.read_dataframe(stop_points_file)
+    x = pd.to_numeric(df['Place_Location_Easting']).values.astype(np.float64)
+    y = pd.to_numeric(df['Place_Location_Northing']).values.astype(np.float64)
+    stations = df['Descriptor_CommonName'].astype(object).values
+    located = ~(np.isnan(x) | np.isnan(y))
+    x, y, stations = x[located], y[located], stations[located]
+
+    then = time.perf_counter()
+    index = StationLocations(stations, x, y)
+    build = time.perf_counter() - then
+
+    rnd = np.random.RandomState(seed)
+    points = np.column_stack([rnd.uniform(x.min() - radius, x.max() + radius, queries),
+                              rnd.uniform(y.min() - radius, y.max() + radius, queries)])
+
+    def scan(easting, northing):
+        distances = np.hypot(x - easting, y - northing)
+        nearest = {}
+        for distance, station in zip(distances.tolist(), stations.tolist()):
+            if distance < nearest.get(station, np.inf):
+                nearest[station] = distance
+        return sorted((distance, station) for station, distance in nearest.items())
+
+    results = {}
+    for name, within, nearest in [
+            ('scan', lambda e, n: [s for s in scan(e, n) if s[0] <= radius],
+             lambda e, n: scan(e, n)[:k]),
+            ('grid', lambda e, n: index.within(e, n, radius),
+             lambda e, n: index.nearest(e, n, k))]:
+        then = time.perf_counter()
+        for e, n in points.tolist():
+            within(e, n)
+        within_us = (time.perf_counter() - then) / queries * 1e6
+        then = time.perf_counter()
+        for e, n in points.tolist():
+            nearest(e, n)
+        nearest_us = (time.perf_counter() - then) / queries * 1e6
+        results[name] = (within_us, nearest_us)
+
+    print('{} StopPoints. Grid built in {:.1f}ms'.format(len(x), build * 1e3))
+    print('{:<8} {:>12} {:>12}'.format('method', 'within us', 'nearest us'))
+    for name, (within_us, nearest_us) in results.items():
+        print('{:<8} {:>12.1f} {:>12.1f}'.format(name, within_us, nearest_us))
+
+#' ## Suite
+#'
+#' Runs the whole pipeline on synthetic timetables of a given size (or on
+#' the TransXChange files in `--input-dir`) and reports
+#'
+#' * **ingest**: XMLParsing.py throughput in MB of XML and rows per second
+#' * **graph**: the time to build the departure board with Departures.py
+#'   and the DeparturesGraph from it
+#' * **query**: the latency percentiles of each journey planner
+#'
+#' along with the peak memory of the ingest and of the graph build. Each is
+#' run in a process of its own so that its peak memory is not hidden by the
+#' one before. The timetables and queries are seeded so that the numbers of
+#' two commits can be compared, for example with `--output` to save them as
+#' JSON.
+#'
+#' The journeys of every planner are compared with those of the Dijkstra
+#' search of ShortestPath.py without A* and the suite exits with an error
+#' if any differ, so that a faster but wrong commit is not taken for an
+#' improvement.
+
+def _ingest(input_dir, output_dir):
+    """
+        Run XMLParsing.py and return the metrics of the run. See IngestMetrics.py
+    """
+    import json
+
+    import XMLParsing
+
+    metrics_file = os.path.join(output_dir, 'metrics.jsonl')
+    XMLParsing.main.main([input_dir, output_dir, '--full', '--metrics', metrics_file],
+                         standalone_mode=False)
+    with open(metrics_file) as f:
+        records = [json.loads(line) for line in f]
+    run = records[-1]
+    run['rows'] = sum(n for record in records if record['event'] == 'file'
+                      for n in record['rows'].values())
+    return run
+
+def _build_graph(data_dir, timetable_date, graph_file):
+    """
+        Build and save the DeparturesGraph of `timetable_date` from the Feather
+        files in `data_dir` and return the seconds of each step and the peak memory
+    """
+    from Departures import departure_board, read_tables, service_calendar
+    from DeparturesGraph import DeparturesGraph, write_gpickle
+    from IngestMetrics import peak_rss_mb
+
+    result = {}
+    then = time.perf_counter()
+    tables = read_tables(data_dir)
+    df = departure_board(tables, timetable_date, service_calendar(tables))
+    result['board_seconds'] = time.perf_counter() - then
+    result['board_rows'] = len(df)
+
+    then = time.perf_counter()
+    graph = DeparturesGraph.from_departureboard(df)
+    H = graph.to_networkx()
+    result['graph_seconds'] = time.perf_counter() - then
+    result['nodes'] = len(graph)
+    result['edges'] = graph.n_edges
+
+    write_gpickle(H, graph_file)
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+def _same_journey(expected, found, path_query):
+    """
+        Do two journeys answer `path_query` equally well: the earliest arrival
+        of a Leave After query or the latest start of an Arrive Before query.
+        Equally good journeys may take different trains
+    """
+    if expected is None or found is None:
+        return expected is found
+    if path_query['leave_after']:
+        return abs(expected.end_time - found.end_time) < 1e-9
+    return abs(expected.start_time - found.start_time) < 1e-9
+
+def _in_process(func, *args):
+    """
+        Returns the result of `func(*args)` run in a new process
+    """
+    import concurrent.futures
+    import multiprocessing
+
+    with concurrent.futures.ProcessPoolExecutor(
+            1, mp_context=multiprocessing.get_context('fork')) as pool:
+        return pool.submit(func, *args).result()
+
+@cli.command()
+@click.option('--input-dir', type=click.Path(exists=True),
+              help='TransXChange files to use rather than synthetic ones')
+@click.option('--lines', default=4, help='Number of synthetic lines')
+@click.option('--stops', default=30, help='Number of stops per synthetic line')
+@click.option('--patterns', default=2, help='Number of journey patterns per direction in each file')
+@click.option('--vehicle-journeys', default=200, help='Number of vehicle journeys in each file')
+@click.option('--files', default=2, help='Number of files per synthetic line')
+@click.option('--date', 'timetable_date', default='2017-12-18', help='Date of the graph')
+@click.option('--engines', default='dijkstra,csa', help='Comma separated journey planners')
+@click.option('--queries', default=200, help='Number of queries per planner')
+@click.option('--seed', default=0, help='Random seed for the timetables and queries')
+@click.option('--output', type=click.Path(), help='JSON file to save the results to')
+def suite(input_dir, lines, stops, patterns, vehicle_journeys, files, timetable_date,
+          engines, queries, seed, output):
+    """
+        Measure ingest throughput, graph build time, query latency and peak memory
+    """
+    import json
+    import tempfile
+
+    import numpy as np
+
+    from DeparturesGraph import read_gpickle
+    from ShortestPath import JourneyPlanner
+    from SyntheticTransXChange import generate
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if input_dir is None:
+            input_dir = os.path.join(tmp_dir, 'xml')
+            os.mkdir(input_dir)
+            generate(input_dir, n_lines=lines, n_stops=stops, n_files=files,
+                     n_patterns=patterns, n_journeys=vehicle_journeys, seed=seed)
+        xml_mb = sum(os.path.getsize(os.path.join(input_dir, f))
+                     for f in os.listdir(input_dir) if f.endswith('.xml')) / 1e6
+
+        data_dir = os.path.join(tmp_dir, 'feather')
+        os.mkdir(data_dir)
+        run = _in_process(_ingest, input_dir, data_dir)
+        results['ingest'] = {'files': run['files'], 'xml_mb': xml_mb, 'rows': run['rows'],
+                             'seconds': run['seconds'], 'mb_per_second': xml_mb / run['seconds'],
+                             'rows_per_second': run['rows'] / run['seconds'],
+                             'peak_rss_mb': run['peak_rss_mb']}
+
+        graph_file = os.path.join(tmp_dir, 'DeparturesGraph.gpickle')
+        results['graph'] = _in_process(_build_graph, data_dir, timetable_date, graph_file)
+
+        reference = JourneyPlanner(read_gpickle(graph_file), astar=False)
+        batch = random_queries(sorted(reference.index.stations.names), queries, seed)
+        expected = [reference.find_journey(query) for query in batch]
+
+        results['query'] = {}
+        for engine in engines.split(','):
+            then = time.perf_counter()
+            planner, find, station_names = load_planner(graph_file, engine)
+            load_seconds = time.perf_counter() - then
+            latencies = []
+            journeys = []
+            for query in batch:
+                then = time.perf_counter()
+                journeys.append(find(query))
+                latencies.append(time.perf_counter() - then)
+            p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1e3
+            differ = sum(not _same_journey(a, b, query)
+                         for a, b, query in zip(expected, journeys, batch))
+            results['query'][engine] = {'load_seconds': load_seconds, 'queries': queries,
+                                        'p50_ms': p50, 'p90_ms': p90, 'p99_ms': p99,
+                                        'max_ms': max(latencies) * 1e3, 'differ': differ}
+
+    ingest, graph = results['ingest'], results['graph']
+    print('Ingest   {} files, {:.1f} MB, {} rows in {:.2f}s: {:.2f} MB/s, {:.0f} rows/s, '
+          'peak {:.0f} MB'.format(ingest['files'], ingest['xml_mb'], ingest['rows'],
+                                  ingest['seconds'], ingest['mb_per_second'],
+                                  ingest['rows_per_second'], ingest['peak_rss_mb']))
+    print('Graph    departure board of {} rows in {:.2f}s, {} nodes and {} edges in {:.2f}s, '
+          'peak {:.0f} MB'.format(graph['board_rows'], graph['board_seconds'], graph['nodes'],
+                                  graph['edges'], graph['graph_seconds'], graph['peak_rss_mb']))
+    print('{:<8} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}'.format(
+        'Query', 'load s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'differ'))
+    for engine, query in results['query'].items():
+        print('{:<8} {:>8.2f} {:>8.2f} {:>8.2f} {:>8.2f} {:>8.2f} {:>8}'.format(
+            engine, query['load_seconds'], query['p50_ms'], query['p90_ms'],
+            query['p99_ms'], query['max_ms'], query['differ']))
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    wrong = {engine: query['differ'] for engine, query in results['query'].items()
+             if query['differ']}
+    if wrong:
+        raise click.ClickException('Journeys differ from the Dijkstra search: ' + ', '.join(
+            '{} of {} by {}'.format(n, queries, engine) for engine, n in sorted(wrong.items())))
+
+#' ## Journey server load
+#'
+#' Sends journey queries to a running JourneyServer.py over a number of
+#' concurrent keep-alive connections and reports the latency seen by the
+#' clients with the searches and coalesced requests counted by the server.
+#' A fraction of the requests repeat one of the queries sent just before so
+#' that identical queries are in flight together. With `--reload` the
+#' timetable is reloaded part way through and every request must still
+#' be answered.
+
+async def _http(reader, writer, method, path, payload=None):
+    """
+        Send one HTTP/1.1 request on an open connection
+
+        Returns the status and the JSON response
+    """
+    import json
+
+    body = b'' if payload is None else json.dumps(payload).encode()
+    writer.write('{} {} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n'
+                 'Content-Length: {}\r\n\r\n'.format(method, path, len(body)).encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+@cli.command()
+@click.argument('url', default='http://127.0.0.1:8080')
+@click.option('--connections', default=16, help='Number of concurrent connections')
+@click.option('--requests', 'n_requests', default=2000, help='Number of journey requests')
+@click.option('--duplicates', default=0.3,
+              help='Fraction of requests repeating one of the last queries sent')
+@click.option('--reload', 'reload_at', default=0.0,
+              help='Reload the timetable after this fraction of the requests. 0 never')
+@click.option('--timetable', default=None,
+              help='Timetable to reload. The one being served if not given, otherwise '
+                   'one in the --timetable-dir of the server')
+@click.option('--seed', default=0, help='Random seed for the queries')
+def load(url, connections, n_requests, duplicates, reload_at, timetable, seed):
+    """
+        Generate journey requests to the JourneyServer.py at URL
+    """
+    import asyncio
+    import urllib.parse
+
+    import numpy as np
+
+    address = urllib.parse.urlsplit(url)
+    host, port = address.hostname, address.port or 80
+
+    async def run():
+        reader, writer = await asyncio.open_connection(host, port)
+        _, stations = await _http(reader, writer, 'GET', '/stations')
+        _, before = await _http(reader, writer, 'GET', '/metrics')
+
+        rnd = random.Random(seed)
+        unique = random_queries(stations['stations'], n_requests, seed)
+        batch = []
+        for query in unique:
+            if batch and rnd.random() < duplicates:
+                query = rnd.choice(batch[-connections:])
+            batch.append(query)
+
+        queue = asyncio.Queue()
+        for query in batch:
+            queue.put_nowait(query)
+        latencies, failures = [], []
+        reloaded = asyncio.Event()
+
+        async def client():
+            c_reader, c_writer = await asyncio.open_connection(host, port)
+            while not queue.empty():
+                query = queue.get_nowait()
+                then = time.perf_counter()
+                try:
+                    status, response = await _http(c_reader, c_writer, 'POST', '/journey', query)
+                except (ConnectionError, asyncio.IncompleteReadError) as e:
+                    failures.append(repr(e))
+                    c_reader, c_writer = await asyncio.open_connection(host, port)
+                    continue
+                latencies.append(time.perf_counter() - then)
+                if status != 200:
+                    failures.append(response.get('error'))
+                if reload_at and not reloaded.is_set() and \
+                        len(latencies) >= reload_at * n_requests:
+                    reloaded.set()
+                    asyncio.ensure_future(reload_timetable())
+            c_writer.close()
+
+        reload_result = {}
+
+        async def reload_timetable():
+            r_reader, r_writer = await asyncio.open_connection(host, port)
+            payload = {'timetable': timetable} if timetable else {}
+            _, reload_result['response'] = await _http(r_reader, r_writer, 'POST', '/reload',
+                                                       payload)
+            r_writer.close()
+
+        then = time.perf_counter()
+        await asyncio.gather(*[client() for _ in range(connections)])
+        elapsed = time.perf_counter() - then
+        while reloaded.is_set() and 'response' not in reload_result:
+            await asyncio.sleep(0.05)
+        _, after = await _http(reader, writer, 'GET', '/metrics')
+        writer.close()
+        return latencies, failures, elapsed, before, after, reload_result.get('response')
+
+    latencies, failures, elapsed, before, after, reload_response = asyncio.run(run())
+
+    print('{} requests over {} connections in {:.2f}s: {:.0f} requests/s, {} failed'.format(
+        n_requests, connections, elapsed, len(latencies) / elapsed, len(failures)))
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1e3
+    print('Client   p50 {:.2f} ms, p90 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms'.format(
+        p50, p90, p99, max(latencies) * 1e3))
+    searches = after['searches'] - before['searches']
+    coalesced = after['coalesced'] - before['coalesced']
+    print('Server   {} searches, {} requests coalesced'.format(searches, coalesced))
+    for name in ('request', 'search'):
+        histogram = after['latency'][name]
+        print('{:<8} p50 {:.2f} ms, p90 {:.2f} ms, p99 {:.2f} ms (since the server started)'.format(
+            name.capitalize(), histogram['p50_ms'], histogram['p90_ms'], histogram['p99_ms']))
+    if reload_response is not None:
+        print('Reloaded timetable version {} in {:.2f}s: {}'.format(
+            reload_response.get('version'), reload_response.get('seconds', 0),
+            reload_response.get('timetable', reload_response.get('error'))))
+    for failure in failures[:5]:
+        print('    Failed: {}'.format(failure))
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,475 @@
+#' ---
+#' title: "Connection Scan"
+#' ---
+
+#' This file provides a timetable-native journey planner based on the
+#' Connection Scan Algorithm (CSA) as an alternative to the Dijkstra search
+#' over the time-expanded graph in [ShortestPath.py](ShortestPath.html).
+#'
+#' Every travel edge of the Departures Board graph is a *connection*:
+#' one vehicle moving from one StopPoint to the next. The connections are
+#' sorted once by departure minute into flat NumPy arrays so that a
+#' "Leave After" query only scans the connections departing on or after
+#' the query time and stops as soon as no later connection can improve on
+#' the best arrival found. "Arrive Before" queries scan the same
+#' connections ordered by arrival minute backwards from the query time.
+#'
+#' No nodes or edges are added for the query so the timetable is never
+#' modified once it has been built.
+#'
+#' A timetable with a [ServiceCalendar](ServiceCalendar.html) attached
+#' (see `ServiceCalendar.dated_timetable`) also answers queries with a
+#' `'date'`, skipping the connections of trips not running on that date.
+#'
+#' A query from coordinates (see [StationIndex.py](StationIndex.html)) starts
+#' the scan from every station within walking distance at the minute it
+#' can be reached on foot, and a query to coordinates adds the minutes of
+#' walking from each station to its arrival.
+#'
+#' [Source code](https://github.com/ruaridhw/london-tube/blob/master/2_analysis/python/ConnectionScan.py)
+
+#+ connectionscan, engine='python'
+import numpy as np
+
+from ShortestPath import Journey, Leg, render_journey, walking_journey
+from StationIndex import StationNames, endpoint_label, walking_minutes
+
+# Number of connections converted from NumPy to Python values at a time.
+# Scanning stops early for most queries so there is no point converting
+# the whole remaining timetable up front.
+_CHUNK_SIZE = 4096
+
+_INF = float('inf')
+
+class ConnectionScan(object):
+
+    def __init__(self, stop_names, trip_codes, line_names,
+                 dep_stop, arr_stop, dep_time, arr_time, trip, line,
+                 atco_codes=None, stop_points=None, fuzzy=False,
+                 arr_order=None, arr_time_sorted=None):
+        """
+            stop_names    List of station names indexed by stop code
+            trip_codes    List of VehicleJourneyCodes indexed by trip code
+            line_names    List of line abbreviations indexed by line code
+            dep_stop, arr_stop, dep_time, arr_time, trip, line
+                          Equal length arrays describing each connection
+            atco_codes, stop_points, fuzzy
+                          Station name resolution options. See StationIndex.StationNames
+            arr_order, arr_time_sorted
+                          Ordering of the connections by arrival minute and the
+                          arrival minutes in that order if the arrays are
+                          already sorted by departure minute
+
+            The connections are sorted by departure minute on initialisation
+            and an ordering by arrival minute is kept for "Arrive Before" queries.
+            Presorted arrays (such as memory-mapped arrays opened by
+            TimetableStore.read_timetable) are used as they are without copying.
+        """
+        self.stop_names = list(stop_names)
+        self.trip_codes = list(trip_codes)
+        self.line_names = list(line_names)
+        self.stations = StationNames(self.stop_names, atco_codes, stop_points, fuzzy)
+        self._stop_codes = {name: i for i, name in enumerate(self.stop_names)}
+        # ServiceCalendar.TripCalendar of the trips if queries may have a date
+        self.calendar = None
+
+        if arr_order is None:
+            order = np.lexsort((arr_time, dep_time))
+        else:
+            order = slice(None)
+        self.dep_stop = np.asarray(dep_stop, dtype=np.int32)[order]
+        self.arr_stop = np.asarray(arr_stop, dtype=np.int32)[order]
+        self.dep_time = np.asarray(dep_time, dtype=np.float64)[order]
+        self.arr_time = np.asarray(arr_time, dtype=np.float64)[order]
+        self.trip = np.asarray(trip, dtype=np.int32)[order]
+        self.line = np.asarray(line, dtype=np.int16)[order]
+
+        if arr_order is None:
+            arr_order = np.lexsort((self.dep_time, self.arr_time)).astype(np.int32)
+        self.arr_order = np.asarray(arr_order, dtype=np.int32)
+        if arr_time_sorted is None:
+            arr_time_sorted = self.arr_time[self.arr_order]
+        self.arr_time_sorted = np.asarray(arr_time_sorted, dtype=np.float64)
+
+    @classmethod
+    def from_graph(cls, H, stop_points=None, fuzzy=False):
+        """
+            H      A Departures Board DiGraph as built in the Visualising Data
+                   notebook and loaded in ShortestPath.py
+            stop_points, fuzzy
+                   Station name resolution options. See StationIndex.StationNames
+
+            Every edge other than a 'Stay' edge (or a leftover 'Start'/'End'
+            edge) is a train travelling between two stations
+
+            Returns a ConnectionScan object
+        """
+        codes = {'stop': {}, 'trip': {}, 'line': {}}
+
+        def encode(kind, value):
+            return codes[kind].setdefault(value, len(codes[kind]))
+
+        nodes = H.nodes
+        atco_codes = {}
+        cols = {'dep_stop': [], 'arr_stop': [], 'dep_time': [],
+                'arr_time': [], 'trip': [], 'line': []}
+        for u, v, edge_data in H.edges(data=True):
+            if edge_data['movement'] in ('Stay', 'Start', 'End'):
+                continue
+            u_data = nodes[u]
+            cols['dep_stop'].append(encode('stop', u_data['StopPointName']))
+            cols['arr_stop'].append(encode('stop', nodes[v]['StopPointName']))
+            cols['dep_time'].append(u_data['MinuteOfDay'])
+            cols['arr_time'].append(u_data['MinuteOfDay'] + edge_data['cost'])
+            cols['trip'].append(encode('trip', u_data['VehicleJourneyCode']))
+            cols['line'].append(encode('line', edge_data['movement']))
+            # Node names are of the form VehicleJourneyCode//StopPointRef
+            for n in (u, v):
+                atco_codes[n.rsplit('//', 1)[-1]] = nodes[n]['StopPointName']
+
+        return cls(sorted(codes['stop'], key=codes['stop'].get),
+                   sorted(codes['trip'], key=codes['trip'].get),
+                   sorted(codes['line'], key=codes['line'].get),
+                   atco_codes=atco_codes, stop_points=stop_points, fuzzy=fuzzy, **cols)
+
+    def __len__(self):
+        return len(self.dep_time)
+
+#' ## Station lookup
+
+    def find_stops(self, name):
+        """
+            name   A station name or AtcoCode as provided in a path query
+
+            Returns a list of stop codes
+        """
+        return [self._stop_codes[station] for station in self.stations.resolve(name)]
+
+    def walks(self, path_query, end):
+        """
+            end    'From' or 'To'
+
+            Returns a dictionary of {stop code: minutes walking} of
+            the stops `end` of the query can use. See StationNames.walks
+        """
+        return {self._stop_codes[station]: walk
+                for station, walk in self.stations.walks(path_query, end).items()}
+
+    def active_trips(self, date):
+        """
+            date   Date of a query or None
+
+            Returns a boolean array indexed by trip code of the trips
+            running on `date` or None if every trip can be used
+        """
+        if date is None or self.calendar is None:
+            return None
+        return self.calendar.active_trips(date)
+
+#' ## Scans
+
+    def _iter_connections(self, index, active=None):
+        """
+            index   Array of connection indices in scan order
+            active  Boolean array indexed by trip code of the trips to
+                    scan or None to scan every trip
+
+            Yields (index, dep_stop, arr_stop, dep_time, arr_time, trip) tuples
+            converting the arrays to Python values one chunk at a time
+        """
+        for lo in range(0, len(index), _CHUNK_SIZE):
+            idx = index[lo:lo + _CHUNK_SIZE]
+            if active is not None:
+                idx = idx[active[self.trip[idx]]]
+            yield from zip(idx.tolist(),
+                           self.dep_stop[idx].tolist(), self.arr_stop[idx].tolist(),
+                           self.dep_time[idx].tolist(), self.arr_time[idx].tolist(),
+                           self.trip[idx].tolist())
+
+    def earliest_arrival(self, sources, targets, active=None):
+        """
+            sources   Dictionary of {stop: minute} giving the earliest minute
+                      each origin stop can be left
+            targets   Dictionary of {stop: minutes} giving any extra time
+                      needed to reach the destination from each target stop
+            active    Trips which can be used. See `active_trips`
+
+            Scans forward from the earliest source minute and stops once
+            departures are later than the best arrival at a target.
+
+            Returns a tuple of the best target stop (or None) and a dictionary
+            of {stop: (board connection, alight connection)} for the leg
+            used to reach each stop
+        """
+        best_stops, reached_by = self.earliest_arrivals(sources, [targets], active)
+        return best_stops[0], reached_by
+
+    def earliest_arrivals(self, sources, target_groups, active=None):
+        """
+            sources, active As for `earliest_arrival`
+            target_groups   List of `targets` dictionaries, one per destination
+
+            Shares one forward scan from `sources` between every destination
+            stopping once departures are later than the best arrival of
+            every destination
+
+            Returns a tuple of the list of the best target stop of each
+            group and the dictionary of legs used to reach each stop
+        """
+        earliest = dict(sources)
+        trip_board = {}
+        reached_by = {}
+        best = [_INF] * len(target_groups)
+        best_stops = [None] * len(target_groups)
+        targets_at = {}
+        for group, targets in enumerate(target_groups):
+            for stop, extra in targets.items():
+                targets_at.setdefault(stop, []).append((group, extra))
+        # Latest of the best arrivals of the groups
+        worst = max(best, default=-_INF)
+
+        start = np.searchsorted(self.dep_time, min(sources.values()), 'left')
+        for c, dep_stop, arr_stop, dep_time, arr_time, trip in \
+                self._iter_connections(np.arange(start, len(self), dtype=np.int32), active):
+            if dep_time >= worst:
+                break
+
+            if trip not in trip_board:
+                # Cannot catch a train that has already left
+                if earliest.get(dep_stop, _INF) > dep_time:
+                    continue
+                trip_board[trip] = c
+
+            if arr_time < earliest.get(arr_stop, _INF):
+                earliest[arr_stop] = arr_time
+                reached_by[arr_stop] = (trip_board[trip], c)
+                if arr_stop in targets_at:
+                    for group, extra in targets_at[arr_stop]:
+                        if arr_time + extra < best[group]:
+                            best[group], best_stops[group] = arr_time + extra, arr_stop
+                    worst = max(best)
+
+        return best_stops, reached_by
+
+    def latest_departure(self, sources, targets, active=None):
+        """
+            sources   Dictionary of {stop: minutes} giving any extra time
+                      needed to reach each origin stop
+            targets   Dictionary of {stop: minute} giving the latest minute
+                      each destination stop can be reached
+            active    Trips which can be used. See `active_trips`
+
+            Mirror image of `earliest_arrival` scanning connections by
+            arrival minute backwards from the latest target minute.
+
+            Returns a tuple of the best source stop (or None) and a dictionary
+            of {stop: (board connection, alight connection)} for the leg
+            used to leave each stop
+        """
+        best_stops, leave_by = self.latest_departures([sources], targets, active)
+        return best_stops[0], leave_by
+
+    def latest_departures(self, source_groups, targets, active=None):
+        """
+            source_groups   List of `sources` dictionaries, one per origin
+            targets, active As for `latest_departure`
+
+            Mirror image of `earliest_arrivals` sharing one backward scan
+            to `targets` between every origin
+
+            Returns a tuple of the list of the best source stop of each
+            group and the dictionary of legs used to leave each stop
+        """
+        latest = dict(targets)
+        trip_alight = {}
+        leave_by = {}
+        best = [-_INF] * len(source_groups)
+        best_stops = [None] * len(source_groups)
+        sources_at = {}
+        for group, sources in enumerate(source_groups):
+            for stop, extra in sources.items():
+                sources_at.setdefault(stop, []).append((group, extra))
+        # Earliest of the best departures of the groups
+        worst = min(best, default=_INF)
+
+        end = np.searchsorted(self.arr_time_sorted, max(targets.values()), 'right')
+        for c, dep_stop, arr_stop, dep_time, arr_time, trip in \
+                self._iter_connections(self.arr_order[:end][::-1], active):
+            if arr_time <= worst:
+                break
+
+            if trip not in trip_alight:
+                # No point catching a train that arrives after we want to arrive
+                if latest.get(arr_stop, -_INF) < arr_time:
+                    continue
+                trip_alight[trip] = c
+
+            if dep_time > latest.get(dep_stop, -_INF):
+                latest[dep_stop] = dep_time
+                leave_by[dep_stop] = (c, trip_alight[trip])
+                if dep_stop in sources_at:
+                    for group, extra in sources_at[dep_stop]:
+                        if dep_time - extra > best[group]:
+                            best[group], best_stops[group] = dep_time - extra, dep_stop
+                    worst = min(best)
+
+        return best_stops, leave_by
+
+#' ## Journeys
+
+    def _leg(self, board, alight):
+        return Leg(self.line_names[self.line[board]],
+                   self.stop_names[self.dep_stop[board]], float(self.dep_time[board]),
+                   self.stop_names[self.arr_stop[alight]], float(self.arr_time[alight]))
+
+    def find_journey(self, path_query):
+        """
+            path_query    A query dictionary as per ShortestPath.example_path_query
+
+            Returns a ShortestPath.Journey or None if there is no journey.
+            A Journey without legs is returned if the origin and destination
+            can use the same station
+        """
+        walks = self.walks(path_query, 'From'), self.walks(path_query, 'To')
+        return self._journey(path_query, self.find_legs(path_query, walks), walks)
+
+    def find_legs(self, path_query, walks=None):
+        """
+            walks    The `walks` from and to of the query if already found
+
+            Returns the list of ShortestPath.Leg of the journey for `path_query`
+            or None if there is no journey
+        """
+        if walks is None:
+            walks = self.walks(path_query, 'From'), self.walks(path_query, 'To')
+        from_walks, to_walks = walks
+        if not from_walks or not to_walks:
+            return None
+        if set(from_walks) & set(to_walks):
+            return []
+
+        active = self.active_trips(path_query.get('date'))
+        time = path_query['time']
+        if path_query['leave_after']:
+            return self._earliest_legs({s: time + walk for s, walk in from_walks.items()},
+                                       to_walks, active)
+
+        stop, leave_by = self.latest_departure(from_walks,
+                                               {s: time - walk for s, walk in to_walks.items()},
+                                               active)
+        if stop is None:
+            return None
+        # Of the journeys leaving at the latest possible minute
+        # take the one arriving earliest
+        departure = float(self.dep_time[leave_by[stop][0]])
+        return self._earliest_legs({stop: departure}, to_walks, active)
+
+    def _journey(self, path_query, legs, walks=None):
+        """
+            Returns the Journey of `legs` starting and ending with
+            any walking in `walks`
+        """
+        if legs is None:
+            return None
+        from_walks, to_walks = walks or ({}, {})
+        if not legs:
+            return walking_journey(path_query, walking_minutes((from_walks, to_walks)) or 0)
+        if path_query['leave_after']:
+            start_time = path_query['time']
+        else:
+            start_time = legs[0].board_time - \
+                from_walks.get(self._stop_codes[legs[0].board_stop], 0)
+        destination = legs[-1].alight_stop
+        end_time = legs[-1].alight_time + to_walks.get(self._stop_codes[destination], 0)
+        return Journey(endpoint_label(path_query, 'From'), destination,
+                       start_time, end_time, end_time - start_time, legs)
+
+    def _earliest_legs(self, sources, targets, active=None):
+        """
+            Run `earliest_arrival` and walk backwards from the
+            destination to an origin stop collecting the legs
+        """
+        stop, reached_by = self.earliest_arrival(sources, targets, active)
+        return self._walk_legs(stop, reached_by)
+
+    def _walk_legs(self, stop, reached_by):
+        if stop is None:
+            return None
+
+        legs = []
+        while stop in reached_by:
+            board, alight = reached_by[stop]
+            legs.append(self._leg(board, alight))
+            stop = int(self.dep_stop[board])
+        legs.reverse()
+        return legs
+
+    @staticmethod
+    def group_key(path_query):
+        """
+            Returns the key of the queries which can share a scan with `path_query`
+        """
+        date = path_query.get('date')
+        if path_query['leave_after']:
+            return (True, endpoint_label(path_query, 'From'), path_query['time'], date)
+        return (False, endpoint_label(path_query, 'To'), path_query['time'], date)
+
+    def find_journeys(self, path_queries):
+        """
+            path_queries    A list of query dictionaries
+
+            Leave After queries from the same station (or coordinates) at the
+            same minute share one forward scan and Arrive Before queries to the
+            same station at the same minute share one backward scan, provided
+            they are for the same date.
+
+            Returns the list of Journeys (or None) of each query in order
+        """
+        groups = {}
+        for i, path_query in enumerate(path_queries):
+            groups.setdefault(self.group_key(path_query), []).append(i)
+
+        journeys = [None] * len(path_queries)
+        for (leave_after, name, time, date), members in groups.items():
+            shared_end, other_end = ('From', 'To') if leave_after else ('To', 'From')
+            shared_walks = self.walks(path_queries[members[0]], shared_end)
+            active = self.active_trips(date)
+            searches = []
+            for i in members:
+                other_walks = self.walks(path_queries[i], other_end)
+                if not shared_walks or not other_walks:
+                    continue
+                walks = (shared_walks, other_walks) if leave_after else (other_walks, shared_walks)
+                if set(shared_walks) & set(other_walks):
+                    journeys[i] = self._journey(path_queries[i], [], walks)
+                else:
+                    searches.append((i, walks))
+            if not searches:
+                continue
+
+            if leave_after:
+                best_stops, reached_by = self.earliest_arrivals(
+                    {s: time + walk for s, walk in shared_walks.items()},
+                    [to_walks for i, (from_walks, to_walks) in searches], active)
+                for (i, walks), stop in zip(searches, best_stops):
+                    journeys[i] = self._journey(path_queries[i],
+                                                self._walk_legs(stop, reached_by), walks)
+            else:
+                best_stops, leave_by = self.latest_departures(
+                    [from_walks for i, (from_walks, to_walks) in searches],
+                    {s: time - walk for s, walk in shared_walks.items()}, active)
+                for (i, walks), stop in zip(searches, best_stops):
+                    if stop is not None:
+                        departure = float(self.dep_time[leave_by[stop][0]])
+                        journeys[i] = self._journey(path_queries[i], self._earliest_legs(
+                            {stop: departure}, shared_walks, active), walks)
+        return journeys
+
+    def plan_journey(self, path_query):
+        """
+            Calculate, print and return the Journey for `path_query`
+            in the same format as ShortestPath.print_path
+        """
+        journey = self.find_journey(path_query)
+        print(render_journey(path_query, journey))
+        return journey
@@ -0,0 +1,351 @@
+#' ---
+#' title: "Departures"
+#' ---
+
+#' This file builds the departure board directly from the Feather files
+#' (or [partitioned datasets](TableDataset.html)) output by
+#' [XMLParsing.py](XMLParsing.html) without a database.
+#' It replaces the [FeatherUpload.R](FeatherUpload.html) upload, the variable
+#' creation of [VariableCreation.R](VariableCreation.html) and the
+#' [departureboard](DepartureBoard.html) SQL function with whole-column
+#' pandas operations:
+#'
+#' 1. Each VehicleJourney is joined to the timing links of its JourneyPattern
+#' 2. `JourneyTime` is the RunTime plus any WaitTime of each link, each in
+#'    whole minutes as VariableCreation.R converts them, so that the board
+#'    is the same as the SQL function's even for durations such as PT2M30S
+#' 3. `ArrivalMins_Link` is the DepartureTime of the journey in whole
+#'    minutes past midnight plus the cumulative sum of `JourneyTime`
+#'    within each journey and
+#'    `DepartureMins_Link` is the arrival at the previous link
+#'    (a grouped `cumsum` and `shift` in place of the SQL window functions)
+#' 4. The StopPoint names and locations are joined to both ends of each link
+#'    converting the British National Grid Easting and Northing to WGS84
+#'    Longitude and Latitude
+#'
+#' The result has the columns of the SQL function (see
+#' `DeparturesGraph.departureboard_columns`) and is written as a Feather file.
+#' Given a date, only the journeys running that day according to the
+#' [ServiceCalendar](ServiceCalendar.html) are kept which, unlike the SQL
+#' function, also accounts for bank holidays. Without a date every journey
+#' is kept for use with `ServiceCalendar.dated_timetable`.
+#'
+#' Only the columns used are read from each table and, given a date, the
+#' Lines not running that day are not read at all. With `--line` the board
+#' is built for only the given Lines.
+#'
+#' `$python3 python/Departures.py --date 2017-12-18 ../1_data/1_2_processed_data DepartureBoard20171218.feather`
+#'
+#' [Source code](https://github.com/ruaridhw/london-tube/blob/master/2_analysis/python/Departures.py)
+
+#+ departures, engine='python'
+import click
+import numpy as np
+import pandas as pd
+
+required_tables = ['VehicleJourneys', 'JourneyPatterns', 'JourneyPatternTimingLinks',
+                   'StopPoints', 'Services', 'VehicleJourneys_RegularDayType_DaysOfWeek',
+                   'Services_RegularDayType_DaysOfWeek',
+                   'VehicleJourneys_BankHolidayOperation_DaysOfNonOperation',
+                   'VehicleJourneys_BankHolidayOperation_DaysOfOperation']
+
+# Columns used by `departure_board` and `service_calendar`.
+# Every column is read of the tables not listed
+required_columns = {
+    'VehicleJourneys': ['VehicleJourneyCode', 'ServiceRef', 'LineRef', 'JourneyPatternRef',
+                        'DepartureTime'],
+    'JourneyPatterns': ['JourneyPattern', 'JourneyPatternSectionRefs'],
+    'JourneyPatternTimingLinks': ['JourneyPatternSections', 'From_SequenceNumber',
+                                  'From_StopPointRef', 'To_SequenceNumber', 'To_StopPointRef',
+                                  'RunTime', 'WaitTime'],
+    'StopPoints': ['AtcoCode', 'Descriptor_CommonName', 'Place_NptgLocalityRef',
+                   'Place_Location_Easting', 'Place_Location_Northing'],
+    'Services': ['ServiceCode', 'OpPeriod_StartDate', 'OpPeriod_EndDate']
+}
+
+def read_tables(data_dir, tablenames=required_tables, columns=required_columns, lines=None,
+                timetable_date=None):
+    """
+        data_dir          Directory of Feather files or datasets output by XMLParsing.py
+        tablenames        Names of the tables to read
+        columns           Dictionary of {tablename: list of columns to read}
+                          or None to read every column
+        lines             Line codes to read or None for every Line
+        timetable_date    ISO formatted date. Lines not running on it are not read
+
+        Returns a dictionary of {tablename: DataFrame} with the rows of every
+        Line of each table concatenated. Tables without any files are None
+    """
+    from TableDataset import read_tables
+
+    return read_tables(data_dir, tablenames, columns, lines, timetable_date)
+
+def bng_to_wgs84(easting, northing):
+    """
+        Convert British National Grid (OSGB36) Eastings and Northings to
+        WGS84 Longitudes and Latitudes in degrees as `VariableCreation.modify_StopPoints`
+        does with the proj4 EPSG:27700 definition
+
+        The inverse Transverse Mercator projection gives OSGB36 latitudes
+        and longitudes on the Airy 1830 ellipsoid which are moved to the
+        GRS80 ellipsoid of WGS84 with the seven parameter Helmert transform
+        (accurate to a few metres)
+    """
+    E = np.asarray(easting, dtype=np.float64)
+    N = np.asarray(northing, dtype=np.float64)
+
+    # Airy 1830 ellipsoid and National Grid projection
+    a, b = 6377563.396, 6356256.909
+    F0 = 0.9996012717
+    lat0, lon0 = np.radians(49), np.radians(-2)
+    N0, E0 = -100000, 400000
+    e2 = 1 - (b * b) / (a * a)
+    n = (a - b) / (a + b)
+
+    def meridional_arc(lat):
+        dlat, slat = lat - lat0, lat + lat0
+        return b * F0 * ((1 + n + 5 / 4 * n ** 2 + 5 / 4 * n ** 3) * dlat
+                         - (3 * n + 3 * n ** 2 + 21 / 8 * n ** 3) * np.sin(dlat) * np.cos(slat)
+                         + (15 / 8 * n ** 2 + 15 / 8 * n ** 3) * np.sin(2 * dlat) * np.cos(2 * slat)
+                         - 35 / 24 * n ** 3 * np.sin(3 * dlat) * np.cos(3 * slat))
+
+    lat = lat0 + (N - N0) / (a * F0)
+    for _ in range(10):
+        lat = lat + (N - N0 - meridional_arc(lat)) / (a * F0)
+
+    sin_lat, cos_lat, tan_lat = np.sin(lat), np.cos(lat), np.tan(lat)
+    nu = a * F0 / np.sqrt(1 - e2 * sin_lat ** 2)
+    rho = a * F0 * (1 - e2) / (1 - e2 * sin_lat ** 2) ** 1.5
+    eta2 = nu / rho - 1
+    dE = E - E0
+    VII = tan_lat / (2 * rho * nu)
+    VIII = tan_lat / (24 * rho * nu ** 3) * (5 + 3 * tan_lat ** 2 + eta2 - 9 * tan_lat ** 2 * eta2)
+    IX = tan_lat / (720 * rho * nu ** 5) * (61 + 90 * tan_lat ** 2 + 45 * tan_lat ** 4)
+    X = 1 / (cos_lat * nu)
+    XI = 1 / (cos_lat * 6 * nu ** 3) * (nu / rho + 2 * tan_lat ** 2)
+    XII = 1 / (cos_lat * 120 * nu ** 5) * (5 + 28 * tan_lat ** 2 + 24 * tan_lat ** 4)
+    XIIA = 1 / (cos_lat * 5040 * nu ** 7) * (61 + 662 * tan_lat ** 2 + 1320 * tan_lat ** 4
+                                             + 720 * tan_lat ** 6)
+    lat = lat - VII * dE ** 2 + VIII * dE ** 4 - IX * dE ** 6
+    lon = lon0 + X * dE - XI * dE ** 3 + XII * dE ** 5 - XIIA * dE ** 7
+
+    # OSGB36 to cartesian coordinates
+    nu = a / np.sqrt(1 - e2 * np.sin(lat) ** 2)
+    x = nu * np.cos(lat) * np.cos(lon)
+    y = nu * np.cos(lat) * np.sin(lon)
+    z = (1 - e2) * nu * np.sin(lat)
+
+    # Helmert transform from OSGB36 to WGS84
+    tx, ty, tz = 446.448, -125.157, 542.060
+    s = -20.4894e-6
+    rx, ry, rz = np.radians(np.array([0.1502, 0.2470, 0.8421]) / 3600)
+    x, y, z = (tx + (1 + s) * x - rz * y + ry * z,
+               ty + rz * x + (1 + s) * y - rx * z,
+               tz - ry * x + rx * y + (1 + s) * z)
+
+    # Cartesian coordinates to latitude and longitude on the GRS80 ellipsoid
+    a, b = 6378137.000, 6356752.3141
+    e2 = 1 - (b * b) / (a * a)
+    p = np.sqrt(x ** 2 + y ** 2)
+    lat = np.arctan2(z, p * (1 - e2))
+    for _ in range(10):
+        nu = a / np.sqrt(1 - e2 * np.sin(lat) ** 2)
+        lat = np.arctan2(z + e2 * nu * np.sin(lat), p)
+    return np.degrees(np.arctan2(y, x)), np.degrees(lat)
+
+def wgs84_to_bng(longitude, latitude):
+    """
+        Convert WGS84 Longitudes and Latitudes in degrees to British National
+        Grid (OSGB36) Eastings and Northings in metres. The inverse of
+        `bng_to_wgs84` with the signs of the Helmert parameters reversed
+        followed by the Transverse Mercator projection
+    """
+    lon = np.radians(np.asarray(longitude, dtype=np.float64))
+    lat = np.radians(np.asarray(latitude, dtype=np.float64))
+
+    # Latitude and longitude on the GRS80 ellipsoid to cartesian coordinates
+    a, b = 6378137.000, 6356752.3141
+    e2 = 1 - (b * b) / (a * a)
+    nu = a / np.sqrt(1 - e2 * np.sin(lat) ** 2)
+    x = nu * np.cos(lat) * np.cos(lon)
+    y = nu * np.cos(lat) * np.sin(lon)
+    z = (1 - e2) * nu * np.sin(lat)
+
+    # Helmert transform from WGS84 to OSGB36
+    tx, ty, tz = -446.448, 125.157, -542.060
+    s = 20.4894e-6
+    rx, ry, rz = np.radians(np.array([-0.1502, -0.2470, -0.8421]) / 3600)
+    x, y, z = (tx + (1 + s) * x - rz * y + ry * z,
+               ty + rz * x + (1 + s) * y - rx * z,
+               tz - ry * x + rx * y + (1 + s) * z)
+
+    # Cartesian coordinates to latitude and longitude on the Airy 1830 ellipsoid
+    a, b = 6377563.396, 6356256.909
+    e2 = 1 - (b * b) / (a * a)
+    p = np.sqrt(x ** 2 + y ** 2)
+    lat = np.arctan2(z, p * (1 - e2))
+    for _ in range(10):
+        nu = a / np.sqrt(1 - e2 * np.sin(lat) ** 2)
+        lat = np.arctan2(z + e2 * nu * np.sin(lat), p)
+    lon = np.arctan2(y, x)
+
+    # Transverse Mercator projection of the National Grid
+    F0 = 0.9996012717
+    lat0, lon0 = np.radians(49), np.radians(-2)
+    N0, E0 = -100000, 400000
+    n = (a - b) / (a + b)
+    sin_lat, cos_lat, tan_lat = np.sin(lat), np.cos(lat), np.tan(lat)
+    nu = a * F0 / np.sqrt(1 - e2 * sin_lat ** 2)
+    rho = a * F0 * (1 - e2) / (1 - e2 * sin_lat ** 2) ** 1.5
+    eta2 = nu / rho - 1
+    dlat, slat = lat - lat0, lat + lat0
+    M = b * F0 * ((1 + n + 5 / 4 * n ** 2 + 5 / 4 * n ** 3) * dlat
+                  - (3 * n + 3 * n ** 2 + 21 / 8 * n ** 3) * np.sin(dlat) * np.cos(slat)
+                  + (15 / 8 * n ** 2 + 15 / 8 * n ** 3) * np.sin(2 * dlat) * np.cos(2 * slat)
+                  - 35 / 24 * n ** 3 * np.sin(3 * dlat) * np.cos(3 * slat))
+    I = M + N0
+    II = nu / 2 * sin_lat * cos_lat
+    III = nu / 24 * sin_lat * cos_lat ** 3 * (5 - tan_lat ** 2 + 9 * eta2)
+    IIIA = nu / 720 * sin_lat * cos_lat ** 5 * (61 - 58 * tan_lat ** 2 + tan_lat ** 4)
+    IV = nu * cos_lat
+    V = nu / 6 * cos_lat ** 3 * (nu / rho - tan_lat ** 2)
+    VI = nu / 120 * cos_lat ** 5 * (5 - 18 * tan_lat ** 2 + tan_lat ** 4 + 14 * eta2
+                                    - 58 * tan_lat ** 2 * eta2)
+    dlon = lon - lon0
+    northing = I + II * dlon ** 2 + III * dlon ** 4 + IIIA * dlon ** 6
+    easting = E0 + IV * dlon + V * dlon ** 3 + VI * dlon ** 5
+    return easting, northing
+
+def stop_points(df):
+    """
+        df    StopPoints table output by XMLParsing.py
+
+        Returns the AtcoCode, CommonName, NptgLocalityRef, Longitude and Latitude
+        of each StopPoint as `VariableCreation.modify_StopPoints` does
+    """
+    longitude, latitude = bng_to_wgs84(pd.to_numeric(df['Place_Location_Easting']),
+                                       pd.to_numeric(df['Place_Location_Northing']))
+    return pd.DataFrame({'AtcoCode': df['AtcoCode'].values,
+                         'CommonName': df['Descriptor_CommonName'].values,
+                         'NptgLocalityRef': df['Place_NptgLocalityRef'].values,
+                         'Longitude': longitude,
+                         'Latitude': latitude}).drop_duplicates('AtcoCode')
+
+def service_calendar(tables):
+    """
+        Returns the ServiceCalendar of the journeys in `tables`
+    """
+    from ServiceCalendar import ServiceCalendar
+
+    return ServiceCalendar.from_tables(
+        tables['VehicleJourneys'], tables['Services'],
+        tables.get('VehicleJourneys_RegularDayType_DaysOfWeek'),
+        tables.get('Services_RegularDayType_DaysOfWeek'),
+        tables.get('VehicleJourneys_BankHolidayOperation_DaysOfNonOperation'),
+        tables.get('VehicleJourneys_BankHolidayOperation_DaysOfOperation'))
+
+def whole_minutes(seconds):
+    """
+        The whole minutes of an array of seconds as VariableCreation.R
+        truncates durations and times of day. NaN stays NaN
+    """
+    return np.floor_divide(seconds, 60)
+
+def departure_board(tables, timetable_date=None, calendar=None):
+    """
+        tables            Dictionary of tables as returned by `read_tables`
+        timetable_date    ISO formatted date to keep the journeys of or None
+                          to keep every journey
+        calendar          ServiceCalendar to filter with. Built from `tables`
+                          if not given
+
+        Returns a DataFrame with the columns of the departureboard SQL function
+    """
+    from DeparturesGraph import departureboard_columns
+    from TfLTimetable import TfLTimetable
+
+    journeys = tables['VehicleJourneys']
+    if journeys is None:
+        # Every Line was skipped by `read_tables` as not running on the date
+        return pd.DataFrame(columns=departureboard_columns)
+    if timetable_date is not None:
+        if calendar is None:
+            calendar = service_calendar(tables)
+        running = np.array(calendar.journeys, dtype=object)[calendar.runs_on(timetable_date)]
+        journeys = journeys[journeys['VehicleJourneyCode'].isin(running)]
+
+    departure_seconds = TfLTimetable.time_of_day_seconds(journeys['DepartureTime'])
+    journeys = pd.DataFrame({
+        'VehicleJourneyCode': journeys['VehicleJourneyCode'].values,
+        # Extract three-letter line abbreviation
+        'Line': journeys['LineRef'].astype(object).str[2:5].values,
+        'DepartureMins': whole_minutes(departure_seconds),
+        'JourneyPatternRef': journeys['JourneyPatternRef'].values
+    })
+    patterns = tables['JourneyPatterns'][['JourneyPattern', 'JourneyPatternSectionRefs']]
+    links = tables['JourneyPatternTimingLinks']
+    links = pd.DataFrame({
+        'JourneyPatternSections': links['JourneyPatternSections'].values,
+        'From_SequenceNumber': pd.to_numeric(links['From_SequenceNumber']).values,
+        'From_StopPointRef': links['From_StopPointRef'].values,
+        'To_SequenceNumber': pd.to_numeric(links['To_SequenceNumber']).values,
+        'To_StopPointRef': links['To_StopPointRef'].values,
+        'JourneyTime': whole_minutes(TfLTimetable.duration_seconds(links['RunTime']))
+                       + np.nan_to_num(whole_minutes(TfLTimetable.duration_seconds(
+                           links['WaitTime'])))
+    })
+
+    df = journeys.merge(patterns, how='inner', left_on='JourneyPatternRef',
+                        right_on='JourneyPattern') \
+                 .merge(links, how='inner', left_on='JourneyPatternSectionRefs',
+                        right_on='JourneyPatternSections') \
+                 .sort_values(['VehicleJourneyCode', 'From_SequenceNumber'], kind='mergesort') \
+                 .reset_index(drop=True)
+
+    # Window functions partitioned by vehicle and ordered by stop sequence
+    by_vehicle = df.groupby('VehicleJourneyCode', sort=False)
+    df['From_VehicleSequenceNumber'] = by_vehicle['From_SequenceNumber'] \
+        .rank(method='min').astype(np.int64)
+    df['To_VehicleSequenceNumber'] = df['From_VehicleSequenceNumber'] + 1
+    df['ArrivalMins_Link'] = df['DepartureMins'] + by_vehicle['JourneyTime'].cumsum()
+    df['DepartureMins_Link'] = by_vehicle['ArrivalMins_Link'].shift(1) \
+        .fillna(df['DepartureMins'])
+    df['Flag_LastStop'] = df['To_SequenceNumber'] == \
+        by_vehicle['To_SequenceNumber'].transform('max')
+
+    stops = stop_points(tables['StopPoints']).set_index('AtcoCode')
+    for end in ('From', 'To'):
+        located = stops.reindex(df[end + '_StopPointRef'])
+        df[end + '_StopPointName'] = located['CommonName'].values
+        df[end + '_Longitude'] = located['Longitude'].values
+        df[end + '_Latitude'] = located['Latitude'].values
+
+    # Text rather than the categoricals written by XMLParsing.py as per the SQL function
+    df = df[departureboard_columns]
+    return df.astype({col: object for col in df.columns if df[col].dtype.name == 'category'})
+
+@click.command()
+@click.argument('data_dir', required=1, type=click.Path(exists=True))
+@click.argument('output_file', required=1, type=click.Path())
+@click.option('--date', 'timetable_date', default=None,
+              help='ISO formatted date to keep the journeys of. Every journey if not given')
+@click.option('--line', 'lines', multiple=True,
+              help='Line code to build the board of. Every Line if not given')
+def main(data_dir, output_file, timetable_date, lines):
+    """
+        Build the departure board from the Feather files or datasets in
+        DATA_DIR and write it to OUTPUT_FILE as a Feather file
+    """
+    import time
+
+    import feather
+
+    then = time.perf_counter()
+    tables = read_tables(data_dir, lines=lines or None, timetable_date=timetable_date)
+    df = departure_board(tables, timetable_date)
+    feather.write_dataframe(df, output_file)
+    print('Wrote {} departures of {} journeys in {:.1f}s'.format(
+        len(df), df['VehicleJourneyCode'].nunique(), time.perf_counter() - then))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+#' ---
+#' title: "Departures Graph"
+#' ---
+
+#' This file builds the time-expanded Departures Board graph used by
+#' [ShortestPath.py](ShortestPath.html) from the output of the
+#' [departureboard](DepartureBoard.html) SQL function or the same table
+#' built without a database by [Departures.py](Departures.html).
+#'
+#' The Visualising Data notebook builds the same graph one database row at a
+#' time with `add_node` and `add_edge` calls on string node ids. Here the
+#' rows are held in a DataFrame and every edge is found with whole-column
+#' sort and shift operations over integer node ids:
+#'
+#' * **Ride** edges join the departure node of a train at a StopPoint to its
+#'   node at the next StopPoint with the `JourneyTime` as cost
+#' * **Stay** edges join each departure at a station to the next departure
+#'   from the same station with the waiting time as cost
+#' * **Transfer** edges join the arrival of a train at its last stop to
+#'   the next departure from that station so that passengers can change
+#'   trains at a terminus, and join each departure to the first departure
+#'   from the same station in the same minute. Stay edges run through the
+#'   departures of a minute in order of VehicleJourneyCode so without the
+#'   latter a train could only be changed to one sorted after it.
+#'   These are also 'Stay' edges. The notebook graph has no such edges
+#'   and is reproduced exactly with `transfers=False`.
+#'
+#' The edges are held as a compressed sparse row (CSR) adjacency and
+#' can be exported to the NetworkX DiGraph read by ShortestPath.py.
+#'
+#' To build and save the graphs for a number of service days:
+#' `$python3 python/DeparturesGraph.py --output-dir ../1_data/1_3_saved_analysis_objects 2017-12-18 2017-12-19`
+#'
+#' or to read the Feather files of XMLParsing.py rather than PostgreSQL:
+#' `$python3 python/DeparturesGraph.py --data-dir ../1_data/1_2_processed_data 2017-12-18`
+#'
+#' The graphs are pickled with `write_gpickle` and read with `read_gpickle`
+#' since NetworkX 3 no longer provides them.
+#'
+#' [Source code](https://github.com/ruaridhw/london-tube/blob/master/2_analysis/python/DeparturesGraph.py)
+
+#+ departuresgraph, engine='python'
+import pickle
+
+import click
+import numpy as np
+import pandas as pd
+
+# Columns returned by the departureboard SQL function
+departureboard_columns = ['VehicleJourneyCode', 'Line', 'From_VehicleSequenceNumber',
+                          'From_StopPointRef', 'From_StopPointName', 'From_Longitude',
+                          'From_Latitude', 'To_VehicleSequenceNumber', 'To_StopPointRef',
+                          'To_StopPointName', 'To_Longitude', 'To_Latitude', 'JourneyTime',
+                          'DepartureMins_Link', 'ArrivalMins_Link', 'Flag_LastStop']
+
+def read_departureboard(timetable_date, host='localhost', database='londontubepython',
+                        user='postgres'):
+    """
+        timetable_date    ISO formatted date eg. '2018-01-15'
+
+        Returns the departureboard SQL function for `timetable_date` as a DataFrame.
+        The password is read by libpq from the PGPASSWORD environment variable
+        or ~/.pgpass
+    """
+    import psycopg2
+
+    conn = psycopg2.connect(host=host, database=database, user=user)
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT * FROM departureboard(%s)', (timetable_date,))
+        df = pd.DataFrame(cur.fetchall(), columns=departureboard_columns)
+        cur.close()
+    finally:
+        conn.close()
+    return df
+
+def write_gpickle(H, path):
+    """
+        Pickles the NetworkX graph `H` to `path`
+    """
+    with open(path, 'wb') as f:
+        pickle.dump(H, f, pickle.HIGHEST_PROTOCOL)
+
+def read_gpickle(path):
+    """
+        Returns the NetworkX graph pickled to `path` by `write_gpickle`
+    """
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+class DeparturesGraph(object):
+
+    # Movement code of waiting and transfer edges.
+    # Ride edges have the code of their line in `movement_names`
+    STAY = 0
+
+    def __init__(self, node_names, node_trip, node_station, node_minute,
+                 trip_names, station_names, movement_names, src, dst, cost, movement):
+        """
+            node_names       Array of string node ids of the form VehicleJourneyCode//StopPointRef
+            node_trip, node_station
+                             Codes into `trip_names` and `station_names` for each node
+                             or -1 for a node without attributes
+            node_minute      MinuteOfDay of each node
+            trip_names, station_names, movement_names
+                             Lists of VehicleJourneyCodes, StopPointNames and
+                             edge movements indexed by code
+            src, dst, cost, movement
+                             Equal length arrays describing each edge in the order
+                             they would be added to a NetworkX graph
+
+            The edges are sorted by source node into a CSR adjacency where the
+            edges leaving node n are at positions indptr[n]:indptr[n + 1]
+            of `indices`, `cost` and `movement`
+        """
+        self.node_names = np.asarray(node_names, dtype=object)
+        self.node_trip = np.asarray(node_trip, dtype=np.int32)
+        self.node_station = np.asarray(node_station, dtype=np.int32)
+        self.node_minute = np.asarray(node_minute, dtype=np.float64)
+        self.trip_names = list(trip_names)
+        self.station_names = list(station_names)
+        self.movement_names = list(movement_names)
+
+        # A stable sort keeps the insertion order of the edges leaving each node
+        order = np.argsort(src, kind='mergesort')
+        self.indptr = np.zeros(len(self.node_names) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=len(self.node_names)), out=self.indptr[1:])
+        self.indices = np.asarray(dst, dtype=np.int32)[order]
+        self.cost = np.asarray(cost, dtype=np.float64)[order]
+        self.movement = np.asarray(movement, dtype=np.int16)[order]
+
+    @classmethod
+    def from_departureboard(cls, df, transfers=True):
+        """
+            df           DataFrame of the departureboard SQL function
+                         as returned by `read_departureboard`
+            transfers    Add transfer edges from the last stop of each train
+
+            Returns a DeparturesGraph
+        """
+        # Group the departures of each station in time order as the
+        # ORDER BY clause of the notebook query does
+        df = df.sort_values(['From_StopPointName', 'DepartureMins_Link', 'VehicleJourneyCode'],
+                            kind='mergesort')
+        n = len(df)
+        vjc = df['VehicleJourneyCode']
+        dep = df['DepartureMins_Link'].values.astype(np.float64)
+        arr = df['ArrivalMins_Link'].values.astype(np.float64)
+        last = df['Flag_LastStop'].values.astype(bool)
+
+        node_ids, node_names = pd.factorize(pd.concat([vjc + '//' + df['From_StopPointRef'],
+                                                       vjc + '//' + df['To_StopPointRef']],
+                                                      ignore_index=True))
+        u, v = node_ids[:n], node_ids[n:]
+        # Stations that are departed from are coded first and in name order
+        stations, station_names = pd.factorize(pd.concat([df['From_StopPointName'],
+                                                          df['To_StopPointName']],
+                                                         ignore_index=True))
+        from_station, to_station = stations[:n], stations[n:]
+        trips, trip_names = pd.factorize(vjc)
+        lines, line_names = pd.factorize(df['Line'])
+
+        # Node attributes. Each row sets the departure node and the arrival node
+        # of a last stop in turn so later rows overwrite earlier ones as add_node does
+        row = np.arange(n)
+        attrs = pd.DataFrame({
+            'node': np.concatenate([u, v[last]]),
+            'position': np.concatenate([2 * row, 2 * row[last] + 1]),
+            'trip': np.concatenate([trips, trips[last]]),
+            'station': np.concatenate([from_station, to_station[last]]),
+            'minute': np.concatenate([dep, arr[last]])
+        }).sort_values('position').drop_duplicates('node', keep='last')
+        node_trip = np.full(len(node_names), -1, dtype=np.int32)
+        node_station = np.full(len(node_names), -1, dtype=np.int32)
+        node_minute = np.full(len(node_names), np.nan)
+        node_trip[attrs['node'].values] = attrs['trip'].values
+        node_station[attrs['node'].values] = attrs['station'].values
+        node_minute[attrs['node'].values] = attrs['minute'].values
+
+        # Ride edges followed by the Stay edge from the previous departure
+        # of the same station on each row
+        stay = np.flatnonzero(from_station[1:] == from_station[:-1]) + 1
+        src = [u, u[stay - 1]]
+        dst = [v, u[stay]]
+        cost = [df['JourneyTime'].values.astype(np.float64), dep[stay] - dep[stay - 1]]
+        movement = [lines + 1, np.full(len(stay), cls.STAY)]
+        position = [2 * row, 2 * stay + 1]
+
+        if transfers and n:
+            # Departure (station, minute) pairs are already sorted so the next
+            # departure after each arrival is found with one searchsorted
+            span = max(dep.max(), arr.max()) - min(dep.min(), arr.min()) + 1
+            dep_key = from_station * span + dep
+            arr_key = to_station[last] * span + arr[last]
+            nxt = np.searchsorted(dep_key, arr_key, 'left')
+            valid = nxt < n
+            valid[valid] = (from_station[nxt[valid]] == to_station[last][valid]) & \
+                           (trips[nxt[valid]] != trips[last][valid])
+            src.append(v[last][valid])
+            dst.append(u[nxt[valid]])
+            cost.append(dep[nxt[valid]] - arr[last][valid])
+            movement.append(np.full(valid.sum(), cls.STAY))
+            position.append(2 * n + np.arange(valid.sum()))
+
+            # Back from each departure to the first of the same station and minute
+            first = np.r_[True, (from_station[1:] != from_station[:-1]) | (dep[1:] != dep[:-1])]
+            head = np.maximum.accumulate(np.where(first, row, 0))
+            tied = np.flatnonzero(u[head] != u)
+            src.append(u[tied])
+            dst.append(u[head[tied]])
+            cost.append(np.zeros(len(tied)))
+            movement.append(np.full(len(tied), cls.STAY))
+            position.append(2 * n + valid.sum() + np.arange(len(tied)))
+
+        order = np.argsort(np.concatenate(position), kind='mergesort')
+        return cls(node_names, node_trip, node_station, node_minute,
+                   list(trip_names), list(station_names), ['Stay'] + list(line_names),
+                   np.concatenate(src)[order], np.concatenate(dst)[order],
+                   np.concatenate(cost)[order], np.concatenate(movement)[order])
+
+    def __len__(self):
+        return len(self.node_names)
+
+    @property
+    def n_edges(self):
+        return len(self.indices)
+
+    def neighbours(self, node):
+        """
+            Returns the arrays of (destination nodes, costs, movement codes)
+            of the edges leaving integer node `node`
+        """
+        lo, hi = self.indptr[node], self.indptr[node + 1]
+        return self.indices[lo:hi], self.cost[lo:hi], self.movement[lo:hi]
+
+    def to_networkx(self):
+        """
+            Returns the graph as a NetworkX DiGraph with the node and
+            edge attributes of the Visualising Data notebook graph
+        """
+        import networkx as nx
+
+        H = nx.DiGraph()
+        names = self.node_names.tolist()
+        for name, trip, station, minute in zip(names, self.node_trip.tolist(),
+                                               self.node_station.tolist(),
+                                               self.node_minute.tolist()):
+            if station < 0:
+                H.add_node(name)
+            else:
+                H.add_node(name, VehicleJourneyCode=self.trip_names[trip],
+                           StopPointName=self.station_names[station], MinuteOfDay=minute)
+
+        src = np.repeat(np.arange(len(self)), np.diff(self.indptr)).tolist()
+        H.add_edges_from((names[u], names[v], {'movement': self.movement_names[m], 'cost': c})
+                         for u, v, c, m in zip(src, self.indices.tolist(),
+                                               self.cost.tolist(), self.movement.tolist()))
+        return H
+
+@click.command()
+@click.argument('timetable_dates', nargs=-1, required=True)
+@click.option('--output-dir', default='.', type=click.Path(exists=True),
+              help='Directory to write the graphs to')
+@click.option('--host', default='localhost', help='PostgreSQL host')
+@click.option('--database', default='londontubepython', help='PostgreSQL database')
+@click.option('--user', default='postgres', help='PostgreSQL user')
+@click.option('--data-dir', type=click.Path(exists=True),
+              help='Build the departure board from the XMLParsing.py output in this '
+                   'directory instead of PostgreSQL')
+@click.option('--no-transfers', is_flag=True,
+              help='Leave out transfer edges to reproduce the notebook graph')
+@click.option('--timetable', is_flag=True,
+              help='Also write the binary timetable read by TimetableStore.py')
+def main(timetable_dates, output_dir, host, database, user, data_dir, no_transfers, timetable):
+    """
+        Build the Departures Board graph for each ISO formatted date in
+        TIMETABLE_DATES and save it as DeparturesGraphYYYYMMDD.gpickle
+    """
+    import os
+    import time
+
+    if data_dir:
+        from Departures import departure_board, read_tables, service_calendar
+        tables = read_tables(data_dir)
+        calendar = service_calendar(tables)
+
+    for timetable_date in timetable_dates:
+        then = time.perf_counter()
+        if data_dir:
+            df = departure_board(tables, timetable_date, calendar)
+        else:
+            df = read_departureboard(timetable_date, host, database, user)
+        graph = DeparturesGraph.from_departureboard(df, transfers=not no_transfers)
+        H = graph.to_networkx()
+        suffix = timetable_date.replace('-', '')
+        write_gpickle(H, os.path.join(output_dir, 'DeparturesGraph{}.gpickle'.format(suffix)))
+        print('{}: {} nodes and {} edges in {:.1f}s'.format(timetable_date, len(graph),
+                                                            graph.n_edges,
+                                                            time.perf_counter() - then))
+
+        if timetable:
+            from ConnectionScan import ConnectionScan
+            from TimetableStore import write_timetable
+
+            write_timetable(ConnectionScan.from_graph(H),
+                            os.path.join(output_dir, 'DeparturesTimetable{}'.format(suffix)),
+                            timetable_date=timetable_date)
+
+if __name__ == '__main__':
+    main()
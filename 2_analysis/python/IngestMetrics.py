@@ -0,0 +1,153 @@
+#' ---
+#' title: "Ingest Metrics"
+#' ---
+
+#' This file provides the metrics recorded while [XMLParsing.py](XMLParsing.html)
+#' ingests the TransXChange files so that a slow drop of timetables can be
+#' traced to the files, tables and XPaths responsible.
+#'
+#' Every metric is a flat dictionary with an `event` and the `run` it belongs
+#' to (the time the run started). The events are
+#'
+#' * **stage**: one call of `TfLTimetable.get_df` (with the seconds spent in
+#'   the XPath of each column), `get_varying_child_tags`, `stream_tables` or
+#'   `to_numeric` for a file with its seconds and rows
+#' * **file**: the total seconds to parse a file, the rows of each table
+#'   and the peak RSS of the process which parsed it
+#' * **write**: the seconds, rows and bytes of each Feather file written
+#' * **run**: the totals of the whole run and the peak RSS of the main process
+#'
+#' Each metric is appended to a JSON lines file and passed to every hook.
+#' A hook is any function taking the dictionary of a metric, for example to
+#' forward it to a metrics collector. Hooks are given to XMLParsing.py as
+#' `--metrics-hook module:function` where `module` is importable.
+#'
+#' Peak RSS is the largest resident memory of a process so far as reported
+#' by `resource.getrusage` so it only grows from one file to the next.
+#'
+#' [Source code](https://github.com/ruaridhw/london-tube/blob/master/2_analysis/python/IngestMetrics.py)
+
+#+ ingestmetrics, engine='python'
+import contextlib
+import datetime
+import importlib
+import json
+import sys
+import time
+
+def peak_rss_mb():
+    """
+        Returns the peak resident memory of this process in MB
+        or None where the resource module is not available
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and kilobytes elsewhere
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / (1 << 10)
+
+def load_hook(spec):
+    """
+        spec    A hook as 'module:function'
+
+        Returns the function
+    """
+    module, _, function = spec.partition(':')
+    if not module or not function:
+        raise ValueError('A metrics hook must be given as module:function, not {!r}'.format(spec))
+    return getattr(importlib.import_module(module), function)
+
+class IngestMetrics(object):
+
+    def __init__(self, file=None, hooks=()):
+        """
+            file     Path of the JSON lines file appended with every metric
+            hooks    List of functions called with every metric
+        """
+        self.run = datetime.datetime.now().isoformat(timespec='seconds')
+        self.hooks = list(hooks)
+        self._file = open(file, 'a') if file is not None else None
+
+    def emit(self, event, **fields):
+        """
+            Record a metric. Returns its dictionary
+        """
+        record = dict(event=event, run=self.run, **fields)
+        if self._file is not None:
+            self._file.write(json.dumps(record, sort_keys=True) + '\n')
+        for hook in self.hooks:
+            hook(record)
+        return record
+
+    @contextlib.contextmanager
+    def timer(self, event, **fields):
+        """
+            Record a metric with the `seconds` spent in the block.
+            The dictionary of fields is yielded so that the block
+            can add to it eg. the number of rows
+        """
+        then = time.perf_counter()
+        yield fields
+        fields['seconds'] = time.perf_counter() - then
+        self.emit(event, **fields)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+#' ## Profiling
+#'
+#' `XMLParsing.py --profile` runs the ingest under `cProfile`. The XPaths are
+#' compiled once and evaluated inside lxml so the profile only shows the time
+#' in `etree.XPath.__call__`. The seconds of each XPath recorded in the stage
+#' metrics are therefore summed across files to rank them alongside the
+#' functions of the profile.
+
+def hot_xpaths(records, limit=20):
+    """
+        records    Iterable of metric dictionaries
+        limit      Number of XPaths to return
+
+        Returns a list of (seconds, calls, table, column) tuples
+        of the slowest XPaths in descending order of seconds
+    """
+    totals = {}
+    for record in records:
+        if record['event'] != 'stage':
+            continue
+        for column, seconds in record.get('xpaths', {}).items():
+            key = (record.get('table') or record.get('path'), column)
+            total = totals.setdefault(key, [0.0, 0])
+            total[0] += seconds
+            total[1] += 1
+    hottest = sorted(((seconds, calls) + key for key, (seconds, calls) in totals.items()),
+                     reverse=True)
+    return hottest[:limit]
+
+def profile_summary(profile, records, limit=20):
+    """
+        profile    A cProfile.Profile which has finished
+        records    Iterable of metric dictionaries of the same run
+
+        Returns the text of a summary of the slowest functions and XPaths
+    """
+    import io
+    import pstats
+
+    out = io.StringIO()
+    out.write('Slowest XPaths (seconds summed over every file)\n\n')
+    out.write('{:>10} {:>7}  {}\n'.format('seconds', 'files', 'table: column'))
+    for seconds, calls, table, column in hot_xpaths(records, limit):
+        out.write('{:>10.3f} {:>7}  {}: {}\n'.format(seconds, calls, table, column))
+    out.write('\nSlowest functions (cumulative seconds)\n\n')
+    pstats.Stats(profile, stream=out).sort_stats('cumulative').print_stats(limit)
+    return out.getvalue()
@@ -0,0 +1,131 @@
+#' ---
+#' title: "Journey Cache"
+#' ---
+
+#' This file provides a cache of journeys in front of the journey planners in
+#' [ShortestPath.py](ShortestPath.html) and [ConnectionScan.py](ConnectionScan.html).
+#'
+#' Queries are keyed on the origin, the destination, the query type,
+#' the bucket of minutes containing the query time, the query date (if any)
+#' and the timetable version.
+#' A cached journey is only returned if it is still the answer to the new
+#' query which is the case when
+#'
+#' * **Leave After**: it was found for an earlier (or equal) time in the bucket
+#'   and its first train leaves no earlier than the new query time
+#' * **Arrive Before**: it was found for a later (or equal) time in the bucket
+#'   and it arrives no later than the new query time
+#'
+#' since any journey available to the new query was also available to the
+#' cached one. A Leave After journey starts at the query time so only its
+#' legs are reused, with the new query time as its `start_time` and `cost`
+#' measured from it. A Leave After journey from coordinates starts with a
+#' walk to the station which is not part of the Journey and a journey
+#' without legs is only the walk from the query time, so these are only
+#' returned for the same query time. Peak hour queries between the same
+#' stations mostly catch one of a few trains in each bucket so a repeated
+#' query is answered with a dictionary lookup. Otherwise the planner is run
+#' and the journey is added to those cached for the key.
+#'
+#' The cache holds the journeys of at most `maxsize` keys, evicting the least
+#' recently used, and is emptied whenever a new timetable is loaded with `load`.
+#'
+#' [Source code](https://github.com/ruaridhw/london-tube/blob/master/2_analysis/python/JourneyCache.py)
+
+#+ journeycache, engine='python'
+import collections
+import itertools
+import threading
+
+from StationIndex import endpoint_label
+
+CacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize', 'version'])
+
+# Default timetable versions
+_versions = itertools.count(1)
+
+class JourneyCache(object):
+
+    def __init__(self, planner, version=None, bucket=5, maxsize=10000):
+        """
+            planner    A ConnectionScan or ShortestPath.JourneyPlanner object
+            version    Identifier of the planner's timetable eg. its date.
+                       A new one is generated if not given
+            bucket     Width in minutes of the query time buckets
+            maxsize    Maximum number of cached keys
+        """
+        self.bucket = bucket
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._journeys = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.load(planner, version)
+
+    def load(self, planner, version=None):
+        """
+            Switch to a new timetable and forget every cached journey
+        """
+        with self._lock:
+            self.planner = planner
+            self.version = next(_versions) if version is None else version
+            self._journeys.clear()
+
+    def _reusable(self, path_query, cached_time, journey):
+        """
+            Is a journey found for `cached_time` also the answer to `path_query`
+        """
+        time = path_query['time']
+        if path_query['leave_after']:
+            if cached_time > time:
+                return False
+            if journey is None or cached_time == time:
+                return True
+            if not journey.legs or 'From_Easting' in path_query or 'From_Latitude' in path_query:
+                return False
+            return journey.legs[0].board_time >= time
+        else:
+            if cached_time < time:
+                return False
+            if journey is None or cached_time == time:
+                return True
+            return bool(journey.legs) and journey.end_time <= time
+
+    def find_journey(self, path_query):
+        """
+            Returns the ShortestPath.Journey of the planner for `path_query`
+            from the cache if possible
+        """
+        with self._lock:
+            version, planner = self.version, self.planner
+            key = (endpoint_label(path_query, 'From'), endpoint_label(path_query, 'To'),
+                   bool(path_query['leave_after']), int(path_query['time'] // self.bucket),
+                   path_query.get('date'), version)
+            for cached_time, journey in self._journeys.get(key, ()):
+                if self._reusable(path_query, cached_time, journey):
+                    self._journeys.move_to_end(key)
+                    self.hits += 1
+                    if journey is not None and path_query['leave_after']:
+                        time = path_query['time']
+                        journey = journey._replace(start_time=time, cost=journey.end_time - time)
+                    return journey
+            self.misses += 1
+
+        journey = planner.find_journey(path_query)
+
+        with self._lock:
+            # Never keep a journey from a timetable replaced while planning
+            if version == self.version:
+                self._journeys.setdefault(key, []).append((path_query['time'], journey))
+                self._journeys.move_to_end(key)
+                if len(self._journeys) > self.maxsize:
+                    self._journeys.popitem(last=False)
+        return journey
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._journeys), self.version)
+
+    def cache_clear(self):
+        with self._lock:
+            self._journeys.clear()
+            self.hits = self.misses = 0
@@ -0,0 +1,484 @@
+#' ---
+#' title: "Journey Server"
+#' ---
+
+#' This file serves journeys from a timetable loaded once over HTTP so that
+#' the planners in [ConnectionScan.py](ConnectionScan.html) can be used by
+#' other services without each loading the timetable.
+#'
+#' The server runs on `asyncio` with only the standard library. The searches
+#' run on a pool of worker threads or processes so the event loop only
+#' parses requests and writes responses. With `--executor process` each
+#' worker loads the timetable itself, which for a directory written by
+#' [TimetableStore.py](TimetableStore.html) only memory-maps its columns
+#' so every worker shares the same pages.
+#'
+#' | Request         | Response                                                |
+#' |-----------------|---------------------------------------------------------|
+#' | `GET /journey`  | The journey of the query given as URL parameters        |
+#' | `POST /journey` | The journey of the query given as a JSON object         |
+#' | `GET /stations` | The names of the stations of the timetable              |
+#' | `GET /metrics`  | Counts and latency histograms since the server started  |
+#' | `POST /reload`  | Load a timetable (or the same one again) and swap it in |
+#' | `GET /health`   | The version and location of the timetable               |
+#'
+#' A query has the keys of `ShortestPath.example_path_query` and optionally
+#' a `date` or coordinates in place of station names (see
+#' [StationIndex.py](StationIndex.html)). The journey is returned as
+#' `ShortestPath.journey_to_dict` or `null` if there is none:
+#'
+#' `$curl 'localhost:8080/journey?From_StopPointName=Bank&To_StopPointName=Victoria&time=540&leave_after=true'`
+#'
+#' Identical queries arriving while one of them is being searched are
+#' coalesced: only the first is sent to the pool and the others wait for its
+#' journey. A client disconnecting does not cancel a search that other
+#' requests are waiting for.
+#'
+#' `POST /reload` (or `SIGHUP`) loads the timetable into a new pool while
+#' the old one keeps answering. Once it is ready the new pool takes every
+#' new request and the old pool is shut down after finishing the searches
+#' already sent to it, so no request is dropped. Queries are only
+#' coalesced with searches of the same timetable version.
+#'
+#' A reload is given a `timetable` in its JSON body only to switch to
+#' another timetable. As loading a GPickle object unpickles it, the server
+#' only loads the timetable it was started with or one inside the directory
+#' given by `--timetable-dir` (relative paths are taken from it) and answers
+#' `403 Forbidden` for any other path:
+#'
+#' `$curl -X POST -d '{"timetable": "DeparturesTimetable20171219"}' localhost:8080/reload`
+#'
+#' The latency histograms count the milliseconds of every request and of
+#' every search in buckets bounded by `latency_buckets` with the estimated
+#' 50th, 90th and 99th percentiles.
+#'
+#' `$python3 python/JourneyServer.py --port 8080 --workers 4 --timetable-dir . DeparturesTimetable20171218`
+#'
+#' Load is generated with `python3 python/Benchmarks.py load http://localhost:8080`.
+#'
+#' [Source code](https://github.com/ruaridhw/london-tube/blob/master/2_analysis/python/JourneyServer.py)
+
+#+ journeyserver, engine='python'
+import asyncio
+import json
+import os
+import time
+import urllib.parse
+
+import click
+
+# Upper bounds in milliseconds of the buckets of the latency histograms
+latency_buckets = [0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+# Keys of a query passed to the planner
+query_keys = ['From_StopPointName', 'To_StopPointName', 'From_Easting', 'From_Northing',
+              'To_Easting', 'To_Northing', 'From_Longitude', 'From_Latitude',
+              'To_Longitude', 'To_Latitude', 'time', 'leave_after', 'date']
+
+status_reasons = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+                  405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+class LatencyHistogram(object):
+
+    def __init__(self, buckets=latency_buckets):
+        """
+            buckets    Increasing upper bounds of the buckets in milliseconds.
+                       Slower values are counted in a final unbounded bucket
+        """
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        i = 0
+        while i < len(self.buckets) and ms > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def quantile(self, q):
+        """
+            Returns the `q` quantile estimated by interpolating within its bucket
+            or None if nothing has been counted
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.max
+
+    def to_dict(self):
+        """
+            Returns the histogram as plain values with the cumulative count
+            of each bucket keyed by its upper bound as Prometheus does
+        """
+        cumulative = 0
+        buckets = {}
+        for bound, n in zip(self.buckets + ['+Inf'], self.counts):
+            cumulative += n
+            buckets[str(bound)] = cumulative
+        return {'count': self.count,
+                'mean_ms': self.total / self.count if self.count else None,
+                'max_ms': self.max,
+                'p50_ms': self.quantile(0.5),
+                'p90_ms': self.quantile(0.9),
+                'p99_ms': self.quantile(0.99),
+                'buckets': buckets}
+
+def load_planner(timetable, stop_points_file=None, fuzzy=False):
+    """
+        timetable           A timetable directory or GPickle object.
+                            See TimetableStore.load_timetable
+        stop_points_file    Optional Feather file of the StopPoints table
+                            output by XMLParsing.py
+
+        Returns a ConnectionScan object
+    """
+    from TimetableStore import load_timetable
+
+    stop_points = None
+    if stop_points_file is not None:
+        import feather
+        stop_points = feather.read_dataframe(stop_points_file)
+    return load_timetable(timetable, stop_points=stop_points, fuzzy=fuzzy)
+
+# Planner of each worker process
+_planner = None
+
+def _init_worker(timetable, stop_points_file, fuzzy):
+    global _planner
+    _planner = load_planner(timetable, stop_points_file, fuzzy)
+
+def _search(path_query, planner=None):
+    """
+        planner    The planner to use or None for the planner of this worker process
+
+        Returns the journey of `path_query` as plain values
+        with the seconds spent searching
+    """
+    from ShortestPath import journey_to_dict
+
+    then = time.perf_counter()
+    journey = journey_to_dict((_planner if planner is None else planner).find_journey(path_query))
+    return journey, time.perf_counter() - then
+
+def _worker_ready():
+    return os.getpid()
+
+def parse_query(fields):
+    """
+        fields    Dictionary of the query from URL parameters (as text)
+                  or a JSON object
+
+        Returns the path query or raises ValueError if it is not valid
+    """
+    path_query = {key: fields[key] for key in query_keys if key in fields}
+    for end in ('From', 'To'):
+        if not any(key.startswith(end + '_') for key in path_query):
+            raise ValueError('The query has no {}_StopPointName or coordinates'.format(end))
+    for key in path_query:
+        if key.endswith(('_Easting', '_Northing', '_Longitude', '_Latitude')):
+            path_query[key] = float(path_query[key])
+    if 'time' not in path_query or 'leave_after' not in path_query:
+        raise ValueError('The query needs a time and leave_after')
+    path_query['time'] = float(path_query['time'])
+    leave_after = path_query['leave_after']
+    if isinstance(leave_after, str):
+        leave_after = leave_after.strip().lower() in ('true', 't', '1', 'yes')
+    path_query['leave_after'] = bool(leave_after)
+    return path_query
+
+class TimetablePool(object):
+
+    def __init__(self, timetable, version, executor='thread', workers=1,
+                 stop_points_file=None, fuzzy=False):
+        """
+            timetable    Location of the timetable
+            version      Number of the timetable since the server started
+            executor     'thread' to share one planner between worker threads
+                         or 'process' for a planner in each worker process
+            workers      Number of workers
+
+            Loads the timetable and starts the workers. This blocks until
+            they are ready so it is run outside the event loop
+        """
+        import concurrent.futures
+        import multiprocessing
+
+        self.timetable = timetable
+        self.version = version
+        self.loaded = time.time()
+        planner = load_planner(timetable, stop_points_file, fuzzy)
+        self.station_names = sorted(planner.stop_names)
+        if executor == 'thread':
+            self.planner = planner
+            self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        else:
+            # Spawned rather than forked from a process running threads
+            self.planner = None
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker, initargs=(timetable, stop_points_file, fuzzy))
+            try:
+                # Start the workers so that a timetable which fails to load is never swapped in
+                for future in [self.executor.submit(_worker_ready) for _ in range(workers)]:
+                    future.result()
+            except Exception:
+                self.executor.shutdown()
+                raise
+
+    def search(self, path_query):
+        """
+            Returns a concurrent.futures.Future of the result of `_search`
+        """
+        return self.executor.submit(_search, path_query, self.planner)
+
+    def shutdown(self):
+        """
+            Waits for the searches already submitted and stops the workers
+        """
+        self.executor.shutdown(wait=True)
+
+class JourneyServer(object):
+
+    def __init__(self, timetable, executor='thread', workers=1, stop_points_file=None,
+                 fuzzy=False, timetable_dir=None):
+        """
+            timetable        Location of the timetable served first
+            timetable_dir    Optional directory of the other timetables
+                             that POST /reload may load
+        """
+        self.timetable = timetable
+        self.first_timetable = timetable
+        self.timetable_dir = timetable_dir
+        self.executor = executor
+        self.workers = workers
+        self.stop_points_file = stop_points_file
+        self.fuzzy = fuzzy
+        self.pool = None
+        self.versions = 0
+        self.started = time.time()
+        self.counts = {'requests': 0, 'searches': 0, 'coalesced': 0, 'errors': 0, 'reloads': 0}
+        self.latency = {'request': LatencyHistogram(), 'search': LatencyHistogram()}
+        # {(version, query): asyncio.Future} of the searches in flight
+        self._in_flight = {}
+        self._reload_lock = None
+
+    async def reload(self, timetable=None):
+        """
+            Load `timetable` (the current one if not given) in a new pool and
+            swap it in. The old pool finishes its searches in the background.
+            Returns the new TimetablePool
+        """
+        loop = asyncio.get_running_loop()
+        async with self._reload_lock:
+            timetable = timetable or self.timetable
+            pool = await loop.run_in_executor(
+                None, lambda: TimetablePool(timetable, self.versions + 1, self.executor,
+                                            self.workers, self.stop_points_file, self.fuzzy))
+            old, self.pool = self.pool, pool
+            self.versions, self.timetable = pool.version, timetable
+            if old is not None:
+                self.counts['reloads'] += 1
+                loop.run_in_executor(None, old.shutdown)
+            print('Loaded timetable version {}: {}'.format(pool.version, timetable))
+            return pool
+
+    def reloadable(self, timetable):
+        """
+            Returns the location of `timetable` if POST /reload may load it,
+            being the timetable the server started with or one inside
+            `timetable_dir`, otherwise None
+        """
+        if self.timetable_dir is not None:
+            timetable = os.path.join(self.timetable_dir, timetable)
+        path = os.path.realpath(timetable)
+        if path == os.path.realpath(self.first_timetable):
+            return timetable
+        if self.timetable_dir is not None:
+            directory = os.path.realpath(self.timetable_dir)
+            if path != directory and os.path.commonpath([path, directory]) == directory:
+                return timetable
+        return None
+
+    async def find_journey(self, path_query):
+        """
+            Returns the journey of `path_query` as plain values, joining an
+            identical search in flight if there is one
+        """
+        pool = self.pool
+        key = (pool.version, json.dumps(path_query, sort_keys=True))
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.counts['coalesced'] += 1
+        else:
+            self.counts['searches'] += 1
+            future = asyncio.wrap_future(pool.search(path_query))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda f: self._searched(key, f))
+        # Shielded so that a client going away does not cancel the search of the others
+        journey, seconds = await asyncio.shield(future)
+        return journey
+
+    def _searched(self, key, future):
+        del self._in_flight[key]
+        if not future.cancelled() and future.exception() is None:
+            self.latency['search'].add(1e3 * future.result()[1])
+
+    def metrics(self):
+        return dict(self.counts, version=self.pool.version, timetable=self.pool.timetable,
+                    in_flight=len(self._in_flight), uptime=time.time() - self.started,
+                    latency={name: histogram.to_dict()
+                             for name, histogram in self.latency.items()})
+
+    async def respond(self, method, path, params, body):
+        """
+            Returns the status and JSON response of a request
+        """
+        if path == '/journey':
+            if method == 'GET':
+                fields = params
+            elif method == 'POST':
+                fields = json.loads(body.decode() or '{}')
+                if not isinstance(fields, dict):
+                    raise ValueError('The query must be a JSON object')
+            else:
+                return 405, {'error': 'Use GET or POST'}
+            return 200, {'journey': await self.find_journey(parse_query(fields))}
+        elif path == '/reload':
+            if method != 'POST':
+                return 405, {'error': 'Use POST'}
+            fields = json.loads(body.decode() or '{}')
+            if not isinstance(fields, dict):
+                raise ValueError('The reload must be a JSON object')
+            timetable = fields.get('timetable')
+            if timetable:
+                if not isinstance(timetable, str):
+                    raise ValueError('The timetable must be a path')
+                path = self.reloadable(timetable)
+                if path is None:
+                    return 403, {'error': 'Only the timetable being served or one in the '
+                                          'timetable directory can be loaded'}
+                if not os.path.exists(path):
+                    raise ValueError('No timetable at {}'.format(timetable))
+                timetable = path
+            then = time.perf_counter()
+            pool = await self.reload(timetable)
+            return 200, {'version': pool.version, 'timetable': pool.timetable,
+                         'seconds': time.perf_counter() - then}
+        elif path == '/metrics':
+            return 200, self.metrics()
+        elif path == '/stations':
+            return 200, {'stations': self.pool.station_names}
+        elif path == '/health':
+            return 200, {'status': 'ok', 'version': self.pool.version,
+                         'timetable': self.pool.timetable}
+        return 404, {'error': 'No such path: {}'.format(path)}
+
+    async def handle(self, reader, writer):
+        """
+            Serve the HTTP/1.1 requests of one connection until it is closed
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                then = time.perf_counter()
+                self.counts['requests'] += 1
+                url = urllib.parse.urlsplit(target)
+                params = dict(urllib.parse.parse_qsl(url.query))
+                try:
+                    status, response = await self.respond(method, url.path, params, body)
+                except (ValueError, KeyError) as e:
+                    status, response = 400, {'error': str(e)}
+                except Exception as e:
+                    status, response = 500, {'error': repr(e)}
+                if status != 200:
+                    self.counts['errors'] += 1
+                if url.path == '/journey':
+                    self.latency['request'].add(1e3 * (time.perf_counter() - then))
+
+                keep_alive = headers.get('connection', '').lower() != 'close' and \
+                    version == 'HTTP/1.1'
+                payload = json.dumps(response).encode()
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\n'
+                             'Content-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+                                 status, status_reasons[status], len(payload),
+                                 'keep-alive' if keep_alive else 'close').encode() + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host, port):
+        """
+            Loads the timetable and starts listening on `port` (0 for any free port)
+
+            Returns the asyncio.Server
+        """
+        self._reload_lock = asyncio.Lock()
+        await self.reload()
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def serve(self, host, port):
+        import signal
+
+        loop = asyncio.get_running_loop()
+        server = await self.start(host, port)
+        try:
+            loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(self.reload()))
+        except (AttributeError, NotImplementedError):
+            pass
+        print('Serving journeys on http://{}:{}'.format(host, port))
+        async with server:
+            await server.serve_forever()
+
+@click.command()
+@click.argument('timetable', required=1, type=click.Path(exists=True))
+@click.option('--host', default='127.0.0.1', help='Address to listen on')
+@click.option('--port', default=8080, help='Port to listen on')
+@click.option('--executor', type=click.Choice(['thread', 'process']), default='thread',
+              help='Run searches in a thread or process pool')
+@click.option('--workers', default=4, help='Number of workers')
+@click.option('--stop-points', type=click.Path(exists=True),
+              help='Feather file of the StopPoints table for coordinate and fuzzy queries')
+@click.option('--fuzzy', is_flag=True, help='Resolve misspelt station names')
+@click.option('--timetable-dir', type=click.Path(exists=True, file_okay=False),
+              help='Directory of the other timetables that POST /reload may load')
+def main(timetable, host, port, executor, workers, stop_points, fuzzy, timetable_dir):
+    """
+        Serve the journeys of TIMETABLE, a directory written by
+        TimetableStore.py or a Departures Board GPickle object, over HTTP
+    """
+    server = JourneyServer(timetable, executor, workers, stop_points, fuzzy, timetable_dir)
+    try:
+        asyncio.run(server.serve(host, port))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+#' ---
+#' title: "Service Calendar"
+#' ---
+
+#' This file resolves which VehicleJourneys run on which dates from the
+#' Operating Profile tables scraped by `TfLTimetable.get_varying_child_tags`
+#' in place of the `DaysOfWeek_Groups` table and the date filter of the
+#' [departureboard](DepartureBoard.html) SQL function.
+#'
+#' A journey runs on a date when
+#'
+#' 1. The date is within the Operating Period of its Service
+#' 2. The day of the week is in both the `RegularDayType` of its Service and
+#'    its own `RegularDayType` (if either is missing it is not restricted)
+#' 3. The date is not one of its bank holiday `DaysOfNonOperation`
+#'
+#' or the date is one of its bank holiday `DaysOfOperation` within the period.
+#' England and Wales bank holidays (including Easter) are calculated for
+#' every year of the calendar.
+#'
+#' The rules are evaluated once for every date of the calendar and stored as
+#' a bitmask of active days for each journey, so finding the journeys running
+#' on any date is a lookup of one bit per journey.
+#'
+#' `dated_timetable` combines a calendar with a [ConnectionScan](ConnectionScan.html)
+#' timetable of every journey so that one loaded timetable answers queries
+#' with a `'date'` for any day. Connections after midnight are duplicated
+#' 24 hours earlier as part of a copy of their journey which runs on the
+#' following day, so the late trains of the previous service day are found
+#' by queries early in the morning.
+#'
+#' [Source code](https://github.com/ruaridhw/london-tube/blob/master/2_analysis/python/ServiceCalendar.py)
+
+#+ servicecalendar, engine='python'
+import datetime
+
+import numpy as np
+
+weekdays = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+# Bit i is set for the days of each DaysOfWeek group where Monday is day 0
+day_groups = dict({day: 1 << i for i, day in enumerate(weekdays)},
+                  MondayToFriday=0b0011111,
+                  MondayToSaturday=0b0111111,
+                  MondayToSunday=0b1111111,
+                  NotSaturday=0b1011111,
+                  Weekend=0b1100000)
+
+bank_holiday_names = ['NewYearsDay', 'NewYearsDayHoliday', 'GoodFriday', 'EasterMonday',
+                      'MayDay', 'SpringBank', 'LateSummerBankHolidayNotScotland',
+                      'ChristmasEve', 'ChristmasDay', 'ChristmasDayHoliday',
+                      'BoxingDay', 'BoxingDayHoliday', 'NewYearsEve']
+
+# Bank holiday groups of the TransXChange schema
+bank_holiday_groups = {
+    'AllBankHolidays': ['NewYearsDay', 'NewYearsDayHoliday', 'GoodFriday', 'EasterMonday',
+                        'MayDay', 'SpringBank', 'LateSummerBankHolidayNotScotland',
+                        'ChristmasDay', 'ChristmasDayHoliday', 'BoxingDay', 'BoxingDayHoliday'],
+    'AllHolidaysExceptChristmas': ['NewYearsDay', 'NewYearsDayHoliday', 'GoodFriday',
+                                   'EasterMonday', 'MayDay', 'SpringBank',
+                                   'LateSummerBankHolidayNotScotland'],
+    'HolidayMondays': ['EasterMonday', 'MayDay', 'SpringBank', 'LateSummerBankHolidayNotScotland'],
+    'Christmas': ['ChristmasDay', 'BoxingDay'],
+    'DisplacementHolidays': ['NewYearsDayHoliday', 'ChristmasDayHoliday', 'BoxingDayHoliday'],
+    'EarlyRunOff': ['ChristmasEve', 'NewYearsEve']
+}
+
+def holiday_mask(names):
+    """
+        Returns the bitmask of bank holidays and bank holiday groups in `names`
+    """
+    mask = 0
+    for name in names:
+        for holiday in bank_holiday_groups.get(name, [name]):
+            if holiday in bank_holiday_names:
+                mask |= 1 << bank_holiday_names.index(holiday)
+    return mask
+
+def easter_sunday(year):
+    """
+        Date of Easter Sunday using the anonymous Gregorian algorithm
+    """
+    a, b, c = year % 19, year // 100, year % 100
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return datetime.date(year, month, day + 1)
+
+def bank_holidays(year):
+    """
+        Returns a dictionary of {date: bitmask of bank_holiday_names}
+        of England and Wales for `year`
+    """
+    def first_monday(month):
+        date = datetime.date(year, month, 1)
+        return date + datetime.timedelta((7 - date.weekday()) % 7)
+
+    def last_monday(month):
+        date = datetime.date(year, month + 1, 1) - datetime.timedelta(1)
+        return date - datetime.timedelta(date.weekday())
+
+    def next_weekday(date, taken=()):
+        while date.weekday() >= 5 or date in taken:
+            date += datetime.timedelta(1)
+        return date
+
+    easter = easter_sunday(year)
+    new_year = datetime.date(year, 1, 1)
+    christmas = datetime.date(year, 12, 25)
+    boxing_day = datetime.date(year, 12, 26)
+    holidays = {
+        'NewYearsDay': new_year,
+        'GoodFriday': easter - datetime.timedelta(2),
+        'EasterMonday': easter + datetime.timedelta(1),
+        'MayDay': first_monday(5),
+        'SpringBank': last_monday(5),
+        'LateSummerBankHolidayNotScotland': last_monday(8),
+        'ChristmasEve': datetime.date(year, 12, 24),
+        'ChristmasDay': christmas,
+        'BoxingDay': boxing_day,
+        'NewYearsEve': datetime.date(year, 12, 31)
+    }
+    # Substitute days when a holiday falls on a weekend
+    if new_year.weekday() >= 5:
+        holidays['NewYearsDayHoliday'] = next_weekday(new_year)
+    if christmas.weekday() >= 5:
+        holidays['ChristmasDayHoliday'] = next_weekday(christmas, {boxing_day})
+    if boxing_day.weekday() >= 5:
+        holidays['BoxingDayHoliday'] = next_weekday(boxing_day,
+                                                    {holidays.get('ChristmasDayHoliday')})
+
+    dates = {}
+    for name, date in holidays.items():
+        dates[date] = dates.get(date, 0) | holiday_mask([name])
+    return dates
+
+def to_date(value):
+    """
+        Convert an ISO formatted date string or a datetime to a date
+    """
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.datetime.strptime(str(value)[:10], '%Y-%m-%d').date()
+
+class ServiceCalendar(object):
+
+    def __init__(self, journeys, start_date, days):
+        """
+            journeys      List of VehicleJourneyCodes
+            start_date    First date of the calendar
+            days          uint8 array of shape (len(journeys), n_days / 8) where
+                          the bits of row i packed with np.packbits are set for
+                          the days on which journey i runs
+        """
+        self.journeys = list(journeys)
+        self.start_date = to_date(start_date)
+        self.days = np.asarray(days, dtype=np.uint8)
+        self.n_days = self.days.shape[1] * 8
+        self._journey_codes = {journey: i for i, journey in enumerate(self.journeys)}
+
+    @classmethod
+    def from_tables(cls, vehicle_journeys, services, journey_days_of_week=None,
+                    service_days_of_week=None, journey_non_operation=None,
+                    journey_operation=None):
+        """
+            vehicle_journeys   VehicleJourneys table with VehicleJourneyCode and ServiceRef
+            services           Services table with ServiceCode, OpPeriod_StartDate
+                               and OpPeriod_EndDate
+            journey_days_of_week, service_days_of_week
+                               VehicleJourneys_ and Services_RegularDayType_DaysOfWeek tables
+            journey_non_operation, journey_operation
+                               VehicleJourneys_BankHolidayOperation_DaysOfNonOperation
+                               and _DaysOfOperation tables
+
+            The tables are as output by XMLParsing.py. Any of the
+            Operating Profile tables may be None.
+
+            Returns a ServiceCalendar covering every Operating Period
+        """
+        import pandas as pd
+
+        journeys = vehicle_journeys.drop_duplicates('VehicleJourneyCode')
+        codes = pd.Index(journeys['VehicleJourneyCode'])
+        service_codes = pd.Index(services.drop_duplicates('ServiceCode')['ServiceCode'])
+        service = service_codes.get_indexer(journeys['ServiceRef'])
+
+        def combine(table, key, column, index, mask, default):
+            """
+                OR together the masks of every row of `table` for each key in `index`
+            """
+            masks = np.full(len(index), default, dtype=np.int64)
+            if table is not None and len(table):
+                rows = index.get_indexer(table[key])
+                values = np.array([mask([value]) for value in table[column]], dtype=np.int64)
+                known = rows >= 0
+                restricted = np.zeros(len(index), dtype=bool)
+                restricted[rows[known]] = True
+                masks[restricted] = 0
+                np.bitwise_or.at(masks, rows[known], values[known])
+            return masks
+
+        def day_mask(values):
+            return day_groups.get(values[0], 0)
+
+        # Journey and Service days of the week. Unrestricted if missing
+        journey_days = combine(journey_days_of_week, 'VehicleJourneys', 'DaysOfWeek',
+                               codes, day_mask, 0b1111111)
+        service_days = combine(service_days_of_week, 'Services', 'DaysOfWeek',
+                               service_codes, day_mask, 0b1111111)
+        weekday_mask = journey_days & np.where(service >= 0, service_days[service], 0b1111111)
+
+        holidays_off = combine(journey_non_operation, 'VehicleJourneys', 'DaysOfNonOperation',
+                               codes, holiday_mask, 0)
+        holidays_on = combine(journey_operation, 'VehicleJourneys', 'DaysOfOperation',
+                              codes, holiday_mask, 0)
+
+        # Operating Periods as day numbers
+        periods = services.drop_duplicates('ServiceCode')
+        starts = pd.to_datetime(periods['OpPeriod_StartDate'])
+        ends = pd.to_datetime(periods['OpPeriod_EndDate'])
+        start_date = starts.min().date()
+        end_date = max(starts.max(), ends.max() if ends.notnull().any() else starts.max()).date()
+        n_days = (end_date - start_date).days + 1
+        period_start = (starts - starts.min()).dt.days.values
+        # A missing end date runs to the end of the calendar
+        period_end = (ends - starts.min()).dt.days.fillna(n_days - 1).values.astype(np.int64)
+        first = np.where(service >= 0, period_start[service], n_days)
+        last = np.where(service >= 0, period_end[service], -1)
+
+        dates = [start_date + datetime.timedelta(d) for d in range(n_days)]
+        holidays = {}
+        for year in range(start_date.year, end_date.year + 1):
+            holidays.update(bank_holidays(year))
+        date_weekday = np.array([date.weekday() for date in dates])
+        date_holidays = np.array([holidays.get(date, 0) for date in dates], dtype=np.int64)
+
+        # Evaluate the rules for every journey and date at once
+        day = np.arange(n_days)
+        in_period = (first[:, None] <= day[None, :]) & (day[None, :] <= last[:, None])
+        active = in_period & ((weekday_mask[:, None] >> date_weekday[None, :]) & 1).astype(bool)
+        active &= (holidays_off[:, None] & date_holidays[None, :]) == 0
+        active |= in_period & ((holidays_on[:, None] & date_holidays[None, :]) != 0)
+
+        return cls(codes, start_date, np.packbits(active, axis=1))
+
+    @classmethod
+    def from_directory(cls, data_dir):
+        """
+            data_dir    Directory of Feather files or datasets output by XMLParsing.py
+
+            Returns a ServiceCalendar of every Line in `data_dir`
+        """
+        from TableDataset import read_table
+
+        def read(tablename, columns=None):
+            return read_table(data_dir, tablename, columns)
+
+        return cls.from_tables(read('VehicleJourneys', ['VehicleJourneyCode', 'ServiceRef']),
+                               read('Services', ['ServiceCode', 'OpPeriod_StartDate',
+                                                 'OpPeriod_EndDate']),
+                               read('VehicleJourneys_RegularDayType_DaysOfWeek'),
+                               read('Services_RegularDayType_DaysOfWeek'),
+                               read('VehicleJourneys_BankHolidayOperation_DaysOfNonOperation'),
+                               read('VehicleJourneys_BankHolidayOperation_DaysOfOperation'))
+
+    def runs_on(self, date):
+        """
+            Returns a boolean array of the journeys running on `date`
+        """
+        day = (to_date(date) - self.start_date).days
+        if not 0 <= day < self.n_days:
+            return np.zeros(len(self.journeys), dtype=bool)
+        return (self.days[:, day >> 3] >> (7 - (day & 7)) & 1).astype(bool)
+
+    def journey_index(self, journey_codes):
+        """
+            Returns the row of each of `journey_codes` in the calendar or -1 if not found
+        """
+        return np.array([self._journey_codes.get(code, -1) for code in journey_codes],
+                        dtype=np.int64)
+
+class TripCalendar(object):
+
+    def __init__(self, calendar, trip_codes):
+        """
+            calendar      A ServiceCalendar
+            trip_codes    VehicleJourneyCodes of the trips of a timetable built
+                          by dated_timetable where the second half are
+                          copies of the first running on the following day
+
+            Trips not found in the calendar run every day
+        """
+        self.calendar = calendar
+        self.rows = calendar.journey_index(trip_codes[:len(trip_codes) // 2])
+        self._active = {}
+
+    def active_trips(self, date):
+        """
+            Returns a boolean array indexed by trip code of the trips
+            of a dated_timetable running on `date`
+        """
+        date = to_date(date)
+        if date not in self._active:
+            known = self.rows >= 0
+            active = []
+            for day in (date, date - datetime.timedelta(1)):
+                runs = np.ones(len(self.rows), dtype=bool)
+                runs[known] = self.calendar.runs_on(day)[self.rows[known]]
+                active.append(runs)
+            self._active[date] = np.concatenate(active)
+        return self._active[date]
+
+def dated_timetable(cs, calendar):
+    """
+        cs          A ConnectionScan of every journey of the calendar
+        calendar    A ServiceCalendar
+
+        Returns a new ConnectionScan answering queries with a 'date' where
+        connections departing after midnight are also added 24 hours earlier
+        as part of a copy of their trip running on the following day
+    """
+    from ConnectionScan import ConnectionScan
+
+    n_trips = len(cs.trip_codes)
+    late = np.flatnonzero(cs.dep_time >= 24 * 60)
+    dated = ConnectionScan(cs.stop_names, cs.trip_codes + cs.trip_codes, cs.line_names,
+                           np.concatenate([cs.dep_stop, cs.dep_stop[late]]),
+                           np.concatenate([cs.arr_stop, cs.arr_stop[late]]),
+                           np.concatenate([cs.dep_time, cs.dep_time[late] - 24 * 60]),
+                           np.concatenate([cs.arr_time, cs.arr_time[late] - 24 * 60]),
+                           np.concatenate([cs.trip, cs.trip[late] + n_trips]),
+                           np.concatenate([cs.line, cs.line[late]]))
+    dated.stations = cs.stations
+    dated.calendar = TripCalendar(calendar, dated.trip_codes)
+    return dated
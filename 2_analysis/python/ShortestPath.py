@@ -15,10 +15,41 @@
 #' on a separate branch from master to keep
 #' the master clone size small.
 #'
+#' A planned journey is returned as a `Journey` record holding a list of
+#' `Leg`s, one per train, which `render_journey` turns into the text
+#' printed by `print_path`. `journey_to_dict` gives plain values for
+#' serialising a journey. [JourneyServer.py](JourneyServer.html) serves
+#' journeys over HTTP from a timetable loaded once.
+#'
+#' A query can start or end at coordinates rather than a station (see
+#' [StationIndex.py](StationIndex.html)). The Start and End edges then join
+#' the departures and arrivals of the stations within walking distance with
+#' the minutes of walking added to their costs. If the origin and the
+#' destination can use the same station the journey is walked without
+#' taking a train.
+#'
+#' `JourneyPlanner` directs the search towards the destination with A* and
+#' the station to station lower bounds of [StationBounds.py](StationBounds.html)
+#' so that it settles far fewer nodes than Dijkstra's algorithm for the
+#' same journey cost.
+#'
 #' [Source code](https://github.com/ruaridhw/london-tube/blob/master/2_analysis/python/ShortestPath.py)
 
 #+ shortestpath, engine='python'
-import networkx as nx
+import collections
+import heapq
+import math
+
+from StationBounds import StationBounds
+from StationIndex import StationIndex, endpoint_label, walking_minutes
+
+# One train ridden from boarding to alighting
+Leg = collections.namedtuple('Leg', ['line', 'board_stop', 'board_time',
+                                     'alight_stop', 'alight_time'])
+
+# A planned journey. `cost` is the minutes between `start_time` and `end_time`
+Journey = collections.namedtuple('Journey', ['origin', 'destination', 'start_time',
+                                             'end_time', 'cost', 'legs'])
 
 example_path_query = {
     'From_StopPointName': 'Bank',
@@ -27,59 +58,104 @@ example_path_query = {
     'leave_after': True
 }
 
-def setup_shortest_path(path_query):
-    """
-        Add the Start and End nodes to the network for the given query
-        Connect them to the departures and arrivals for the relevant stations
+def setup_shortest_path(H, path_query, index=None, walks=None):
     """
+        Find the departures and arrivals of the relevant stations that
+        the Start and End of the query connect to
 
-    # For "Leave After" query, assign the leaving time to the start node
-    # and leave arriving time as unknown
-    if path_query['leave_after'] == True:
+        index    A StationIndex of H. Building the index is as expensive
+                 as scanning the graph so it should be reused across queries
+        walks    The `StationIndex.walks` of the query if already found
+
+        The network is only read so any number of queries can be set up
+        concurrently against the same graph
 
-        H.add_node('Start', StopPointName = path_query['From_StopPointName'],
-                   MinuteOfDay = path_query['time'], movement = 'Departure')
+        Returns two dictionaries of {node: cost} for the Start and End edges
+    """
+    if index is None:
+        index = StationIndex(H)
+    if walks is None:
+        walks = index.walks(path_query)
+    from_walks, to_walks = walks
+    time = path_query['time']
 
-        H.add_node('End', StopPointName = path_query['To_StopPointName'],
-                   MinuteOfDay = None, movement = 'Arrival')
+    # For "Leave After" query, cannot catch a train that has already left
+    # (or leaves before the station can be reached)
+    if path_query['leave_after'] == True:
+        start_costs = {n: minute - time for station, walk in from_walks.items()
+                       for minute, n in index.departures_between(station, after=time + walk)}
+        end_costs = {n: walk for station, walk in to_walks.items()
+                     for minute, n in index.arrivals_between(station, after=time)}
 
-    # For "Arrive Before" query, assign the arriving time to the end node
-    # and leave departure time as unknown
+    # For "Arrive Before" query, no point catching a train that leaves after we want to arrive
     else:
-        H.add_node('Start', StopPointName = path_query['From_StopPointName'],
-                   MinuteOfDay = None, movement = 'Departure')
+        start_costs = {n: walk for station, walk in from_walks.items()
+                       for minute, n in index.departures_between(station, before=time)}
+        end_costs = {n: time - minute for station, walk in to_walks.items()
+                     for minute, n in index.arrivals_between(station, before=time - walk)}
 
-        H.add_node('End', StopPointName = path_query['To_StopPointName'],
-                   MinuteOfDay = path_query['time'], movement = 'Arrival')
+    return start_costs, end_costs
 
-    for n, n_data in H.nodes(data=True):
-        # Don't want to add an edge from 'Start' to 'End', 'End' to 'End' or 'Start' to 'Start'
-        if n == 'Start' or n == 'End':
-            continue
+def shortest_path(H, start_costs, end_costs, lower_bound=None, stats=None):
+    """
+        Dijkstra's algorithm from a virtual Start node joined to each node in
+        `start_costs` to a virtual End node joined from each node in `end_costs`
 
-        if path_query['leave_after'] == True:
-            # Cannot catch a train that has already left
-            if n_data['MinuteOfDay'] >= path_query['time']:
+        Equivalent to `nx.shortest_path(H, 'Start', 'End', weight='cost')` after
+        adding the Start and End edges but without modifying H
 
-                if path_query['From_StopPointName'] in n_data['StopPointName']:
-                    H.add_edge('Start', n, movement = 'Start',
-                               cost = n_data['MinuteOfDay'] - path_query['time'])
+        lower_bound    Optional function of a node giving a consistent lower
+                       bound of its cost to End (see StationBounds) which
+                       turns the search into A*. Nodes with an infinite
+                       bound are never added
+        stats          Optional dictionary given the number of nodes `settled`
 
-                if path_query['To_StopPointName'] in n_data['StopPointName']:
-                    H.add_edge(n, 'End', movement = 'End',
-                               cost = 0)
-        else:
+        Returns the list of nodes on the shortest path (excluding Start and End)
+        or None if End cannot be reached
+    """
+    if lower_bound is None:
+        lower_bound = lambda n: 0.0
+    end = object()
+    settled = {}
+    # Ties are settled in order of the cost so far. The End is ranked by the
+    # cost of its arrival so that the earliest of equally good arrivals is used
+    heap = [(cost + lower_bound(n), cost, i, cost, n, None)
+            for i, (n, cost) in enumerate(start_costs.items())]
+    heap = [item for item in heap if item[0] < math.inf]
+    heapq.heapify(heap)
+    counter = len(start_costs)
+
+    while heap:
+        _, _, _, cost, u, previous = heapq.heappop(heap)
+        if u in settled:
+            continue
+        settled[u] = previous
+        if u is end:
+            break
 
-            # No point catching a train that leaves after we want to arrive
-            if n_data['MinuteOfDay'] <= path_query['time']:
+        if u in end_costs:
+            heapq.heappush(heap, (cost + end_costs[u], cost, counter, cost + end_costs[u], end, u))
+            counter += 1
+        for v, edge_data in H.succ[u].items():
+            if v not in settled and v != 'End':
+                v_cost = cost + edge_data['cost']
+                priority = v_cost + lower_bound(v)
+                if priority < math.inf:
+                    heapq.heappush(heap, (priority, v_cost, counter, v_cost, v, u))
+                    counter += 1
 
-                if path_query['From_StopPointName'] in n_data['StopPointName']:
-                    H.add_edge('Start', n, movement = 'Start',
-                               cost = 0)
+    if stats is not None:
+        stats['settled'] = len(settled)
+    if end not in settled:
+        return None
 
-                if path_query['To_StopPointName'] in n_data['StopPointName']:
-                    H.add_edge(n, 'End', movement = 'End',
-                               cost = path_query['time'] - n_data['MinuteOfDay'])
+    path = []
+    u = settled[end]
+    while u is not None:
+        path.append(u)
+        u = settled[u]
+    path.reverse()
+    return path
 
 def minutes_to_time(minutes_past_midnight):
     """
@@ -90,65 +166,193 @@ def minutes_to_time(minutes_past_midnight):
     return '{:02.0f}:{:02.0f}:{:02.0f}'.format(hours, minutes, int(seconds))
 
 
-def print_path(path):
+def journey_from_path(H, path, path_query, walks=None):
     """
-        Iterate through a journey's shortest path and print only the relevant information
-        ie. When to board a train, change trains or leave a station
+        Convert a shortest path of nodes to a Journey in one pass over the path.
+        The Journey starts and ends with any walking in `walks`
+        (see StationIndex.walks)
+        Returns None if `path` is None
     """
-    for u,v in zip(path,path[1:]):
-        u_data = H.nodes(data=True)[u]
-        v_data = H.nodes(data=True)[v]
-        edge_data = H[u][v]
+    if path is None:
+        return None
 
-        # Starting information
-        if edge_data['movement'] == 'Start':
-            print('Start journey from {} at {}\n'.format(u_data['StopPointName'],
-                                                  minutes_to_time(v_data['MinuteOfDay'] - edge_data['cost'])))
+    # Read the node and adjacency dictionaries directly rather than
+    # building a view of the graph for every hop
+    nodes, succ = H._node, H._succ
+    legs = []
+    previous_movement = 'Start'
+    for u, v in zip(path, path[1:]):
+        movement = succ[u][v]['movement']
 
         # Changing onto a train from waiting at a platform
-        elif previous_edge['movement'] == 'Start' or \
-             (previous_edge['movement'] == 'Stay' and previous_edge['movement'] != edge_data['movement']):
-            print('Board the {:>7} line train from {} at {}'.format(edge_data['movement'],
-                                                             u_data['StopPointName'],
-                                                             minutes_to_time(u_data['MinuteOfDay'])))
+        if (previous_movement == 'Start' or previous_movement == 'Stay') and movement != 'Stay':
+            board_line, board_data = movement, nodes[u]
 
         # Changing off a train from travelling through any number of stops
-        elif edge_data['movement'] != previous_edge['movement'] and edge_data['movement'] == 'Stay':
-            print('Disembark the {:>3} line train at {} at {}'.format(previous_edge['movement'],
-                                                               u_data['StopPointName'], 
-                                                               minutes_to_time(u_data['MinuteOfDay'])))
+        elif movement == 'Stay' and previous_movement != 'Stay' and previous_movement != 'Start':
+            legs.append(Leg(board_line, board_data['StopPointName'], board_data['MinuteOfDay'],
+                            nodes[u]['StopPointName'], nodes[u]['MinuteOfDay']))
+
+        previous_movement = movement
+
+    end_data = nodes[path[-1]]
+    if previous_movement != 'Stay' and previous_movement != 'Start':
+        legs.append(Leg(board_line, board_data['StopPointName'], board_data['MinuteOfDay'],
+                        end_data['StopPointName'], end_data['MinuteOfDay']))
+
+    from_walks, to_walks = walks or ({}, {})
+    if path_query['leave_after'] == True:
+        start_time = path_query['time']
+    else:
+        start_data = nodes[path[0]]
+        start_time = start_data['MinuteOfDay'] - from_walks.get(start_data['StopPointName'], 0)
+    end_time = end_data['MinuteOfDay'] + to_walks.get(end_data['StopPointName'], 0)
+    return Journey(endpoint_label(path_query, 'From'), end_data['StopPointName'], start_time,
+                   end_time, end_time - start_time, legs)
+
+def walking_journey(path_query, minutes):
+    """
+        Returns the Journey without legs of walking for `minutes` between
+        the origin and destination of `path_query`
+    """
+    time = path_query['time']
+    start_time = time if path_query['leave_after'] else time - minutes
+    return Journey(endpoint_label(path_query, 'From'), endpoint_label(path_query, 'To'),
+                   start_time, start_time + minutes, minutes, [])
 
-        # Finishing information
-        elif edge_data['movement'] == 'End':
-            print('\nFinish journey at {} at {}'.format(u_data['StopPointName'],
-                                                 minutes_to_time(u_data['MinuteOfDay'])))
+def render_journey(path_query, journey):
+    """
+        Returns the text of only the relevant information of a journey
+        ie. When to board a train, change trains or leave a station
+    """
+    if journey is None:
+        return 'No journey found from {} to {}'.format(endpoint_label(path_query, 'From'),
+                                                      endpoint_label(path_query, 'To'))
+
+    lines = ['Start journey from {} at {}\n'.format(journey.origin,
+                                                    minutes_to_time(journey.start_time))]
+    for previous_leg, leg in zip([None] + journey.legs, journey.legs):
+        if previous_leg is not None:
+            lines.append('Disembark the {:>3} line train at {} at {}'.format(
+                previous_leg.line, previous_leg.alight_stop,
+                minutes_to_time(previous_leg.alight_time)))
+        lines.append('Board the {:>7} line train from {} at {}'.format(
+            leg.line, leg.board_stop, minutes_to_time(leg.board_time)))
+    lines.append('\nFinish journey at {} at {}'.format(journey.destination,
+                                                       minutes_to_time(journey.end_time)))
+    return '\n'.join(lines)
+
+def journey_to_dict(journey):
+    """
+        Returns a Journey as a dictionary of plain values for serialising eg. to JSON
+    """
+    if journey is None:
+        return None
+    return dict(journey._asdict(), legs=[leg._asdict() for leg in journey.legs])
+
+def print_path(H, path, path_query):
+    """
+        Iterate through a journey's shortest path and print only the relevant information
+        ie. When to board a train, change trains or leave a station
+    """
+    print(render_journey(path_query, journey_from_path(H, path, path_query)))
+
+class JourneyPlanner(object):
+
+    def __init__(self, H, stop_points=None, fuzzy=False, astar=True):
+        """
+            H             A Departures Board DiGraph
+            stop_points   Optional StopPoints DataFrame for station name
+                          resolution and queries from or to coordinates
+            fuzzy         Enable fuzzy station name resolution. See StationIndex
+            astar         Direct the search with the StationBounds of H
+                          rather than running Dijkstra's algorithm
 
-        previous_edge = edge_data
+            Wraps a loaded graph which is only ever read by the planner
+            so that one in-memory timetable can be shared by queries
+            running concurrently in threads or an asyncio executor
+        """
+        self.H = H
+        self.index = StationIndex(H, stop_points, fuzzy)
+        self.bounds = StationBounds(H) if astar else None
+
+    def find_path(self, path_query, stats=None):
+        """
+            stats    Optional dictionary given the number of nodes `settled`
+
+            Returns the shortest path of nodes for `path_query`
+            or None if there is no journey
+        """
+        return self._find_path(path_query, self.index.walks(path_query), stats)
+
+    def _find_path(self, path_query, walks, stats=None):
+        start_costs, end_costs = setup_shortest_path(self.H, path_query, self.index, walks)
+        lower_bound = None
+        if self.bounds is None:
+            pass
+        elif path_query['leave_after']:
+            lower_bound = self.bounds.lower_bound(walks[1])
+        else:
+            lower_bound = self.bounds.arrive_before_bound(self.H, walks[1], path_query['time'])
+        return shortest_path(self.H, start_costs, end_costs, lower_bound, stats)
+
+    def find_journey(self, path_query):
+        """
+            Returns the Journey for `path_query` or None if there is no journey.
+            A Journey without legs is returned if the origin and destination
+            can use the same station
+        """
+        walks = self.index.walks(path_query)
+        walk = walking_minutes(walks)
+        if walk is not None:
+            return walking_journey(path_query, walk)
+        return journey_from_path(self.H, self._find_path(path_query, walks), path_query, walks)
+
+    def plan_journey(self, path_query):
+        """
+            Calculate, print and return the Journey for `path_query`
+        """
+        journey = self.find_journey(path_query)
+        print(render_journey(path_query, journey))
+        return journey
 
 def plan_journey(H, path_query):
     """
-        Add Start and End nodes to the network temporarily based on `path_query`
-        Calculate and print shortest path
-        Remove Start and End nodes (along with any induced edges) to 'clean' network for next query
+        Calculate, print and return the Journey for a single `path_query`
+        See JourneyPlanner for repeated queries against the same graph
     """
-    setup_shortest_path(path_query)
-    path = nx.shortest_path(H, source='Start', target='End', weight='cost')
-    print_path(path)
-    H.remove_nodes_from(['Start', 'End'])
+    # The StationBounds of A* only pay for themselves over many queries
+    return JourneyPlanner(H, astar=False).plan_journey(path_query)
 
 if __name__ == '__main__':
-    
-    # Location of NetworkX GPickle object
-    file = "../../1_data/1_3_saved_analysis_objects/DeparturesGraph20171218.gpickle"
-    
-    H = nx.read_gpickle(file)
-    
+    import os
+
+    # Location of the binary timetable exported from the
+    # NetworkX GPickle object by TimetableStore.py
+    timetable = "../../1_data/1_3_saved_analysis_objects/DeparturesTimetable20171218"
+
+    if os.path.isdir(timetable):
+        # Memory-map the sorted connections which takes milliseconds
+        from TimetableStore import read_timetable
+        cs = read_timetable(timetable)
+    else:
+        # Location of NetworkX GPickle object
+        file = "../../1_data/1_3_saved_analysis_objects/DeparturesGraph20171218.gpickle"
+
+        from DeparturesGraph import read_gpickle
+        H = read_gpickle(file)
+
+        # Sort the timetable into connections once rather than
+        # adding and removing Start and End nodes for every query
+        from ConnectionScan import ConnectionScan
+        cs = ConnectionScan.from_graph(H)
+
     query = example_path_query
-    plan_journey(H, query)
-    
+    cs.plan_journey(query)
+
     print('\n')
     query['To_StopPointName'] = 'Mile End'
-    plan_journey(H, query)
+    cs.plan_journey(query)
 
 #> Start journey from Bank at 09:00:00
 #>
@@ -0,0 +1,127 @@
+#' ---
+#' title: "Station Bounds"
+#' ---
+
+#' This file precomputes lower bounds on the minutes between every pair of
+#' stations to direct the search of the journey planner in
+#' [ShortestPath.py](ShortestPath.html) towards the destination.
+#'
+#' Dijkstra's algorithm settles the departures of a time-expanded graph in
+#' order of cost so it settles every departure reachable sooner than the
+#' destination, which for a full day graph is most of the network even for
+#' a two stop journey. A* instead settles nodes in order of their cost plus
+#' a lower bound on the cost remaining to the destination, so departures
+#' heading away from it are left unsettled.
+#'
+#' The bounds come from the static topology of the network: the distinct
+#' links between stations listed by the [inbound_graph](InboundGraph.html)
+#' view (in both directions) weighted by the fastest any train covers them,
+#' which is the smallest `JourneyTime` of the JourneyPatternTimingLinks of
+#' the link. Both are read from the ride and transfer edges of the
+#' Departures Board graph itself so that every link a search can use is
+#' included and the bounds hold for exactly the graph being searched.
+#' Waiting at a station costs at least nothing so no journey between two
+#' stations can be faster than the shortest path between them in this
+#' static graph, found for every pair at once with the Floyd-Warshall
+#' algorithm.
+#'
+#' The bound of a node is the shortest static path from its station to a
+#' station of the destination plus the cost of the End edge from there.
+#' Since every edge costs at least the difference of the bounds of its ends
+#' the bound is consistent, so A* settles each node at most once and finds
+#' a journey of the same cost as Dijkstra's algorithm. Nodes whose station
+#' cannot reach the destination at all have an infinite bound and are never
+#' added to the search.
+#'
+#' # Arrive Before
+#'
+#' Every edge of the Departures Board costs the minutes between the
+#' `MinuteOfDay` of its nodes and the End edge of an Arrive Before query
+#' costs the minutes from the arrival to the query time. So the cost from
+#' any node to the End is exactly the query time less its `MinuteOfDay`
+#' whichever way it goes, and the search is only a matter of which
+#' departures can arrive in time. The static bounds answer that: a node
+#' whose `MinuteOfDay` plus the bound of its station (and the walk from the
+#' destination station) is after the query time can never arrive in time
+#' and is not searched. The other nodes take the exact cost as their bound
+#' so they are settled in order of their departure from the origin, latest
+#' first.
+#'
+#' [Source code](https://github.com/ruaridhw/london-tube/blob/master/2_analysis/python/StationBounds.py)
+
+#+ stationbounds, engine='python'
+import numpy as np
+
+class StationBounds(object):
+
+    def __init__(self, H):
+        """
+            H    A Departures Board DiGraph
+
+            Finds the fastest link between each pair of stations joined by
+            an edge of H and the shortest static path between every pair
+        """
+        nodes = H.nodes
+        self.stations = sorted({nodes[n]['StopPointName'] for n in nodes
+                                if n not in ('Start', 'End')})
+        self._codes = {station: i for i, station in enumerate(self.stations)}
+        self.node_station = {n: self._codes[nodes[n]['StopPointName']] for n in nodes
+                             if n not in ('Start', 'End')}
+
+        n_stations = len(self.stations)
+        distances = np.full((n_stations, n_stations), np.inf)
+        for u, v, cost in H.edges(data='cost'):
+            if u in ('Start', 'End') or v in ('Start', 'End'):
+                continue
+            a, b = self.node_station[u], self.node_station[v]
+            if a != b and cost < distances[a, b]:
+                distances[a, b] = cost
+        np.fill_diagonal(distances, 0.0)
+
+        for k in range(n_stations):
+            np.minimum(distances, distances[:, k, None] + distances[None, k, :], out=distances)
+        self.distances = distances
+
+    def station_bounds(self, end_costs):
+        """
+            end_costs    Dictionary of {station: least cost of the End edge}
+                         of the destination stations
+
+            Returns an array of the lower bound of the cost
+            from each station to the End of the search
+        """
+        bounds = np.full(len(self.stations), np.inf)
+        for station, cost in end_costs.items():
+            code = self._codes.get(station)
+            if code is not None:
+                np.minimum(bounds, self.distances[:, code] + cost, out=bounds)
+        return bounds
+
+    def lower_bound(self, end_costs):
+        """
+            Returns a function of a node giving the lower bound of the
+            cost from the node to the End of the search. See `station_bounds`
+        """
+        bounds = self.station_bounds(end_costs).tolist()
+        node_station = self.node_station
+        return lambda n: bounds[node_station[n]]
+
+    def arrive_before_bound(self, H, walks, time):
+        """
+            H        The Departures Board DiGraph of the bounds
+            walks    Dictionary of {station: minutes walking} of the destination
+            time     The latest arrival of the query
+
+            Returns a function of a node giving the lower bound of the cost
+            from the node to the End of an Arrive Before query.
+            See "Arrive Before"
+        """
+        bounds = self.station_bounds(walks).tolist()
+        node_station = self.node_station
+        nodes = H.nodes
+
+        def lower_bound(n):
+            minute = nodes[n]['MinuteOfDay']
+            return time - minute if minute + bounds[node_station[n]] <= time else np.inf
+
+        return lower_bound
@@ -0,0 +1,386 @@
+#' ---
+#' title: "Station Index"
+#' ---
+
+#' This file provides the station lookups used by the journey planners in
+#' [ShortestPath.py](ShortestPath.html) and [ConnectionScan.py](ConnectionScan.html).
+#'
+#' `StationNames` resolves the station given in a path query to the
+#' canonical station names of the timetable. A query can name a station by
+#' its AtcoCode, its exact name or the leading words of its name so that
+#' "Hyde Park" finds "Hyde Park Corner" but "Bank" no longer also matches
+#' "Bankside" as the previous substring test did. An optional fuzzy match
+#' against the StopPoints table catches abbreviations such as "Liverpool St".
+#' The last `max_resolved` names queried are remembered so that a repeated
+#' name is not resolved again however many different names are queried.
+#'
+#' A query can also start or end at a point rather than a station by giving
+#' `From_Easting` and `From_Northing` (British National Grid metres) or
+#' `From_Longitude` and `From_Latitude` (WGS84 degrees) in place of
+#' `From_StopPointName`, and likewise for `To_`. Given a StopPoints table
+#' with the Eastings and Northings extracted by XMLParsing.py, the StopPoints
+#' of the timetable are held in `StationLocations`: a grid of square cells
+#' keyed by their column and row. The stations within walking distance of a
+#' point are found by only measuring the StopPoints in the cells overlapping
+#' the circle around it, and the nearest stations by searching rings of
+#' cells outwards until no unsearched cell can be nearer. Each station found
+#' is joined to the point by the minutes of walking the straight line
+#' between them at `walk_speed`.
+#'
+#' `StationIndex` holds the departure and arrival nodes of each station of a
+#' Departures Board graph sorted by `MinuteOfDay` so that the Start and End
+#' edges of a query are found with a bisect on the query time rather than
+#' a scan of every node in the graph.
+#'
+#' [Source code](https://github.com/ruaridhw/london-tube/blob/master/2_analysis/python/StationIndex.py)
+
+#+ stationindex, engine='python'
+import bisect
+import difflib
+import functools
+import re
+
+import numpy as np
+
+# Walking speed in metres per minute (about 3 mph)
+walk_speed = 80.0
+# Furthest distance in metres walked to or from a station. The nearest
+# station is used if none is within this distance
+max_walk = 1000.0
+# Number of the most recently queried names whose resolution is kept
+max_resolved = 10000
+
+def normalise_name(name):
+    """
+        Lower case a station name and strip punctuation and
+        any trailing "Station" or "Underground Station"
+    """
+    name = name.lower().replace('&', ' and ')
+    name = re.sub(r'[^a-z0-9]+', ' ', name).strip()
+    name = re.sub(r'( underground)?( station)$', '', name)
+    return name
+
+def query_location(path_query, end):
+    """
+        path_query    A query dictionary
+        end           'From' or 'To'
+
+        Returns the (Easting, Northing) of `end` of the query or
+        None if it names a station
+    """
+    if end + '_Easting' in path_query:
+        return float(path_query[end + '_Easting']), float(path_query[end + '_Northing'])
+    if end + '_Latitude' in path_query:
+        from Departures import wgs84_to_bng
+
+        easting, northing = wgs84_to_bng(path_query[end + '_Longitude'],
+                                         path_query[end + '_Latitude'])
+        return float(easting), float(northing)
+    return None
+
+def endpoint_label(path_query, end):
+    """
+        Returns the station name or the coordinates given for `end` of the
+        query as a string identifying it eg. in cache keys and Journeys
+    """
+    if end + '_Easting' in path_query:
+        return '{:.0f}E {:.0f}N'.format(float(path_query[end + '_Easting']),
+                                        float(path_query[end + '_Northing']))
+    if end + '_Latitude' in path_query:
+        return '{:.6f}, {:.6f}'.format(float(path_query[end + '_Latitude']),
+                                       float(path_query[end + '_Longitude']))
+    return path_query[end + '_StopPointName']
+
+def walking_minutes(walks):
+    """
+        walks    Tuple of the `walks` from and to of a query
+
+        Returns the fewest minutes walking from the origin to the destination
+        through a station both can use, or None if they share no station
+    """
+    from_walks, to_walks = walks
+    shared = set(from_walks) & set(to_walks)
+    if not shared:
+        return None
+    return min(from_walks[station] + to_walks[station] for station in shared)
+
+class StationLocations(object):
+
+    def __init__(self, stations, eastings, northings, cell=500.0):
+        """
+            stations      Station name of each StopPoint
+            eastings, northings
+                          British National Grid coordinates of each StopPoint
+            cell          Width in metres of the square cells of the grid
+        """
+        self.stations = np.asarray(stations, dtype=object)
+        self.x = np.asarray(eastings, dtype=np.float64)
+        self.y = np.asarray(northings, dtype=np.float64)
+        self.cell = float(cell)
+
+        # Group the StopPoints by the (column, row) of their cell
+        cols = np.floor(self.x / self.cell).astype(np.int64)
+        rows = np.floor(self.y / self.cell).astype(np.int64)
+        self.grid = {}
+        for i, key in enumerate(zip(cols.tolist(), rows.tolist())):
+            self.grid.setdefault(key, []).append(i)
+        self.grid = {key: np.array(points) for key, points in self.grid.items()}
+        if len(self.x):
+            self._bounds = (cols.min(), cols.max(), rows.min(), rows.max())
+
+    def __len__(self):
+        return len(self.x)
+
+    def _nearest_stations(self, points, easting, northing, k=None):
+        """
+            Returns a list of (distance, station) of the nearest of `points`
+            of each station sorted by distance. Only the first `k` if given
+        """
+        distances = np.hypot(self.x[points] - easting, self.y[points] - northing)
+        order = np.argsort(distances, kind='mergesort')
+        found = []
+        seen = set()
+        for distance, station in zip(distances[order].tolist(), self.stations[points[order]].tolist()):
+            if station not in seen:
+                seen.add(station)
+                found.append((distance, station))
+                if len(found) == k:
+                    break
+        return found
+
+    def within(self, easting, northing, radius):
+        """
+            Returns a list of (distance, station) of the stations with a
+            StopPoint within `radius` metres sorted by distance
+        """
+        col_lo, col_hi = int(np.floor((easting - radius) / self.cell)), \
+            int(np.floor((easting + radius) / self.cell))
+        row_lo, row_hi = int(np.floor((northing - radius) / self.cell)), \
+            int(np.floor((northing + radius) / self.cell))
+        cells = [self.grid[(col, row)] for col in range(col_lo, col_hi + 1)
+                 for row in range(row_lo, row_hi + 1) if (col, row) in self.grid]
+        if not cells:
+            return []
+        return [(distance, station) for distance, station in
+                self._nearest_stations(np.concatenate(cells), easting, northing)
+                if distance <= radius]
+
+    def nearest(self, easting, northing, k=1):
+        """
+            Returns a list of (distance, station) of the `k` nearest
+            stations sorted by distance
+        """
+        if not len(self):
+            return []
+        col0, row0 = int(np.floor(easting / self.cell)), int(np.floor(northing / self.cell))
+        col_lo, col_hi, row_lo, row_hi = self._bounds
+        # Rings needed to cover every cell of the grid from the query cell
+        last_ring = max(col0 - col_lo, col_hi - col0, row0 - row_lo, row_hi - row0, 0)
+
+        cells = []
+        found = []
+        for ring in range(last_ring + 1):
+            if ring == 0:
+                ring_cells = [(col0, row0)]
+            else:
+                cols = range(col0 - ring, col0 + ring + 1)
+                rows = range(row0 - ring + 1, row0 + ring)
+                ring_cells = [(col, row0 - ring) for col in cols] + \
+                    [(col, row0 + ring) for col in cols] + \
+                    [(col0 - ring, row) for row in rows] + [(col0 + ring, row) for row in rows]
+            added = [self.grid[key] for key in ring_cells if key in self.grid]
+            if added:
+                cells.extend(added)
+                found = self._nearest_stations(np.concatenate(cells), easting, northing, k)
+
+            # Every StopPoint outside the searched square is at least this far away
+            outside = min(easting - (col0 - ring) * self.cell,
+                          (col0 + ring + 1) * self.cell - easting,
+                          northing - (row0 - ring) * self.cell,
+                          (row0 + ring + 1) * self.cell - northing)
+            if len(found) >= k and found[k - 1][0] <= outside:
+                break
+        return found[:k]
+
+class StationNames(object):
+
+    def __init__(self, names, atco_codes=None, stop_points=None, fuzzy=False):
+        """
+            names         Canonical station names of a timetable
+            atco_codes    Optional dictionary of {AtcoCode: canonical name}
+            stop_points   Optional StopPoints DataFrame as output by XMLParsing.py
+                          whose common names are added as aliases of the
+                          canonical name with the same AtcoCode and whose
+                          Eastings and Northings locate the stations
+            fuzzy         Fall back to the closest matching name if
+                          no name matches exactly or by leading words
+        """
+        self.names = sorted(set(names))
+        self.atco_codes = dict(atco_codes or {})
+        self.fuzzy = fuzzy
+
+        # Normalised name or alias -> canonical names
+        self.aliases = {}
+        for name in self.names:
+            self.aliases.setdefault(normalise_name(name), set()).add(name)
+
+        # StationLocations of the StopPoints if the StopPoints have coordinates
+        self.locations = None
+
+        if stop_points is not None:
+            name_col = 'CommonName' if 'CommonName' in stop_points else 'Descriptor_CommonName'
+            for code, common_name in zip(stop_points['AtcoCode'], stop_points[name_col]):
+                if code in self.atco_codes:
+                    self.aliases.setdefault(normalise_name(common_name), set()) \
+                        .add(self.atco_codes[code])
+
+            if 'Place_Location_Easting' in stop_points:
+                import pandas as pd
+
+                located = pd.DataFrame({
+                    'AtcoCode': stop_points['AtcoCode'].astype(object).values,
+                    'Easting': pd.to_numeric(stop_points['Place_Location_Easting']).values,
+                    'Northing': pd.to_numeric(stop_points['Place_Location_Northing']).values
+                }).dropna()
+                located = located[located['AtcoCode'].isin(list(self.atco_codes))]
+                if len(located):
+                    self.locations = StationLocations(located['AtcoCode'].map(self.atco_codes),
+                                                      located['Easting'], located['Northing'])
+
+        self._resolved = functools.lru_cache(maxsize=max_resolved)(self._resolve)
+
+    def resolve(self, name):
+        """
+            name    A station name or AtcoCode as provided in a path query
+
+            Tries in turn
+            1. An AtcoCode
+            2. A canonical station name
+            3. A normalised name or alias
+            4. Every station whose leading words are the words of `name`
+            5. The closest fuzzy match (if enabled)
+
+            Returns a sorted list of canonical station names which is empty
+            if nothing matches
+        """
+        return self._resolved(name)
+
+    def _resolve(self, name):
+        if name in self.atco_codes:
+            stations = {self.atco_codes[name]}
+        elif name in self.aliases.get(normalise_name(name), ()):
+            stations = {name}
+        else:
+            key = normalise_name(name)
+            stations = self.aliases.get(key, set())
+
+            if not stations and key:
+                for alias, alias_stations in self.aliases.items():
+                    if alias.startswith(key + ' '):
+                        stations = stations | alias_stations
+
+            if not stations and key and self.fuzzy:
+                match = difflib.get_close_matches(key, self.aliases, n=1, cutoff=0.6)
+                if match:
+                    stations = self.aliases[match[0]]
+
+        return sorted(stations)
+
+    def walks(self, path_query, end):
+        """
+            path_query    A query dictionary
+            end           'From' or 'To'
+
+            Returns a dictionary of {canonical station name: minutes walking}
+            of the stations `end` of the query can use. The minutes are 0 for
+            a named station. A point uses the stations within `max_walk` of
+            it or else the nearest station
+        """
+        location = query_location(path_query, end)
+        if location is None:
+            return {station: 0 for station in self.resolve(path_query[end + '_StopPointName'])}
+        if self.locations is None:
+            raise ValueError('Queries from or to coordinates need the StopPoints table '
+                             'with Eastings and Northings')
+        near = self.locations.within(location[0], location[1], max_walk) or \
+            self.locations.nearest(location[0], location[1])
+        return {station: distance / walk_speed for distance, station in near}
+
+class StationIndex(object):
+
+    def __init__(self, H, stop_points=None, fuzzy=False):
+        """
+            H             A Departures Board DiGraph
+            stop_points   Optional StopPoints DataFrame for name resolution
+            fuzzy         Enable fuzzy name resolution. See StationNames
+
+            Departure nodes have an outgoing travel edge and arrival nodes
+            have an incoming travel edge so the intermediate stops of a
+            train are both
+        """
+        nodes = H.nodes
+        departures = {}
+        arrivals = {}
+        atco_codes = {}
+        for u, v, edge_data in H.edges(data=True):
+            if edge_data['movement'] in ('Stay', 'Start', 'End'):
+                continue
+            for n, index in ((u, departures), (v, arrivals)):
+                station = nodes[n]['StopPointName']
+                index.setdefault(station, set()).add(n)
+                # Node names are of the form VehicleJourneyCode//StopPointRef
+                atco_codes[n.rsplit('//', 1)[-1]] = station
+
+        self.departures = {station: self._sort(H, ns) for station, ns in departures.items()}
+        self.arrivals = {station: self._sort(H, ns) for station, ns in arrivals.items()}
+        self.stations = StationNames(set(departures) | set(arrivals), atco_codes,
+                                     stop_points, fuzzy)
+
+    @staticmethod
+    def _sort(H, station_nodes):
+        """
+            Returns a tuple of a list of minutes and a list of nodes
+            both ordered by MinuteOfDay
+        """
+        ordered = sorted((H.nodes[n]['MinuteOfDay'], n) for n in station_nodes)
+        return [minute for minute, n in ordered], [n for minute, n in ordered]
+
+    @staticmethod
+    def _between(index, station, after, before):
+        """
+            Returns the (minute, node) pairs of `station` in `index`
+            with after <= minute <= before
+        """
+        minutes, station_nodes = index.get(station, ([], []))
+        lo = 0 if after is None else bisect.bisect_left(minutes, after)
+        hi = len(minutes) if before is None else bisect.bisect_right(minutes, before)
+        return zip(minutes[lo:hi], station_nodes[lo:hi])
+
+    def resolve(self, name):
+        return self.stations.resolve(name)
+
+    def walks(self, path_query):
+        """
+            Returns a tuple of the StationNames.walks from and to
+        """
+        return self.stations.walks(path_query, 'From'), self.stations.walks(path_query, 'To')
+
+    def departures_between(self, name, after=None, before=None):
+        """
+            name    A station name or AtcoCode resolved by StationNames
+
+            Returns a list of (minute, node) departures
+            from the station between `after` and `before` inclusive
+        """
+        return [d for station in self.resolve(name)
+                for d in self._between(self.departures, station, after, before)]
+
+    def arrivals_between(self, name, after=None, before=None):
+        """
+            name    A station name or AtcoCode resolved by StationNames
+
+            Returns a list of (minute, node) arrivals
+            at the station between `after` and `before` inclusive
+        """
+        return [a for station in self.resolve(name)
+                for a in self._between(self.arrivals, station, after, before)]
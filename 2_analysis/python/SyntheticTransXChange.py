@@ -0,0 +1,241 @@
+#' ---
+#' title: "Synthetic TransXChange"
+#' ---
+
+#' This script writes synthetic TransXChange timetables for benchmarking
+#' the extraction and journey planning code without downloading the
+#' TfL timetables.
+#'
+#' Each synthetic line is a chain of stops served inbound and outbound by
+#' a number of journey patterns and vehicle journeys. A few stops of every
+#' line are shared with other lines to act as interchanges. The files
+#' follow the structure of the TfL tube timetables closely enough to be
+#' read by every XPath in [TfLTimetable.py](TfLTimetable.html) and are
+#' named `tfl_1-{line}-...xml` so they are picked up by
+#' [XMLParsing.py](XMLParsing.html).
+#'
+#' `$python3 python/SyntheticTransXChange.py --lines 4 --stops 30 --vehicle-journeys 200 OUTPUT_DIR`
+#'
+#' [Source code](https://github.com/ruaridhw/london-tube/blob/master/2_analysis/python/SyntheticTransXChange.py)
+
+#+ synthetictransxchange, engine='python'
+import os
+import random
+
+import click
+from lxml import etree
+
+ns = 'http://www.transxchange.org.uk/'
+
+# Day of week groups and bank holidays used for the Operating Profiles
+days_of_week = ['MondayToFriday', 'Saturday', 'Sunday']
+bank_holidays = ['ChristmasDay', 'BoxingDay', 'NewYearsDay', 'GoodFriday', 'EasterMonday']
+
+def line_code(i):
+    """
+        Returns a three letter line abbreviation for the i-th synthetic line
+    """
+    letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    return 'X' + letters[i // 26 % 26] + letters[i % 26]
+
+def sub(parent, tag, text=None, **attrib):
+    """
+        Append a TransXChange child element with optional text
+    """
+    e = etree.SubElement(parent, '{%s}%s' % (ns, tag), **attrib)
+    if text is not None:
+        e.text = str(text)
+    return e
+
+def duration(seconds):
+    """
+        Format a number of seconds as an ISO 8601 duration eg. PT2M30S
+    """
+    minutes, seconds = divmod(int(seconds), 60)
+    return 'PT{}M{}'.format(minutes, '{}S'.format(seconds) if seconds else '')
+
+def make_network(n_lines, n_stops, n_interchanges, seed=0):
+    """
+        Returns a dictionary of {line: [stop index, ...]} where the first
+        n_lines * n_stops stop indices are unique to each line and
+        `n_interchanges` stops of each line are replaced by a stop of another line
+    """
+    rnd = random.Random(seed)
+    network = {}
+    for i in range(n_lines):
+        stops = list(range(i * n_stops, (i + 1) * n_stops))
+        if n_lines > 1:
+            for position in rnd.sample(range(n_stops), min(n_interchanges, n_stops)):
+                other = rnd.choice([j for j in range(n_lines) if j != i])
+                candidate = rnd.randrange(other * n_stops, (other + 1) * n_stops)
+                if candidate not in stops:
+                    stops[position] = candidate
+        network[line_code(i)] = stops
+    return network
+
+def stop_atco(stop):
+    return '940GZZSY{:04d}'.format(stop)
+
+def stop_name(stop):
+    return 'Synthetic Stop {}'.format(stop)
+
+def write_timetable(path, line, file_no, stops, n_patterns, n_journeys, seed=0):
+    """
+        path          File to write
+        line          Three letter line abbreviation
+        file_no       Number of this file within the line, used to make ids unique
+        stops         List of stop indices served by the line
+        n_patterns    Number of journey patterns per direction
+        n_journeys    Number of vehicle journeys in the file
+
+        Writes one TransXChange file with a single Service
+    """
+    rnd = random.Random('{}-{}-{}'.format(seed, line, file_no))
+    prefix = '{}-{}'.format(line, file_no)
+    root = etree.Element('{%s}TransXChange' % ns, nsmap={None: ns})
+
+    localities = sub(root, 'NptgLocalities')
+    for locality in sorted({stop // 10 for stop in stops}):
+        annotated = sub(localities, 'AnnotatedNptgLocalityRef')
+        sub(annotated, 'NptgLocalityRef', 'N{:07d}'.format(locality))
+        sub(annotated, 'LocalityName', 'Synthetic Locality {}'.format(locality))
+
+    stop_points = sub(root, 'StopPoints')
+    for stop in stops:
+        stop_point = sub(stop_points, 'StopPoint')
+        sub(stop_point, 'AtcoCode', stop_atco(stop))
+        descriptor = sub(stop_point, 'Descriptor')
+        sub(descriptor, 'CommonName', stop_name(stop))
+        place = sub(stop_point, 'Place')
+        sub(place, 'NptgLocalityRef', 'N{:07d}'.format(stop // 10))
+        location = sub(place, 'Location')
+        # Lay the stops out around central London on the British National Grid
+        sub(location, 'Easting', 520000 + (stop * 7919) % 20000)
+        sub(location, 'Northing', 170000 + (stop * 104729) % 20000)
+
+    # Each pattern runs between two stops of the line in one direction
+    patterns = []
+    for direction, sequence in (('inbound', stops), ('outbound', stops[::-1])):
+        for p in range(n_patterns):
+            first = 0 if p == 0 else rnd.randrange(0, max(len(sequence) // 3, 1))
+            last = len(sequence) if p == 0 else rnd.randrange(2 * len(sequence) // 3, len(sequence)) + 1
+            patterns.append((direction, p, sequence[first:last]))
+
+    route_sections = sub(root, 'RouteSections')
+    routes = sub(root, 'Routes')
+    journey_sections = sub(root, 'JourneyPatternSections')
+    run_times = {}
+    for direction, p, sequence in patterns:
+        pattern_id = '{}-{}-{}'.format(prefix, direction, p)
+        route_section = sub(route_sections, 'RouteSection', id='RS_' + pattern_id)
+        journey_section = sub(journey_sections, 'JourneyPatternSection', id='JPS_' + pattern_id)
+        for k, (a, b) in enumerate(zip(sequence, sequence[1:])):
+            link_id = '{}-{}'.format(pattern_id, k + 1)
+            route_link = sub(route_section, 'RouteLink', id='RL_1-{}-{}'.format(line, link_id))
+            sub(sub(route_link, 'From'), 'StopPointRef', stop_atco(a))
+            sub(sub(route_link, 'To'), 'StopPointRef', stop_atco(b))
+            if rnd.random() < 0.8:
+                sub(route_link, 'Distance', rnd.randint(400, 3000))
+            sub(route_link, 'Direction', direction)
+
+            timing_link = sub(journey_section, 'JourneyPatternTimingLink', id='JPTL_' + link_id)
+            link_from = sub(timing_link, 'From', SequenceNumber=str(k + 1))
+            sub(link_from, 'Activity', 'pickUp' if k == 0 else 'pickUpAndSetDown')
+            sub(link_from, 'StopPointRef', stop_atco(a))
+            link_to = sub(timing_link, 'To', SequenceNumber=str(k + 2))
+            if rnd.random() < 0.2:
+                sub(link_to, 'WaitTime', duration(30 * rnd.randint(1, 2)))
+            sub(link_to, 'Activity', 'setDown' if k == len(sequence) - 2 else 'pickUpAndSetDown')
+            sub(link_to, 'StopPointRef', stop_atco(b))
+            sub(timing_link, 'RouteLinkRef', 'RL_1-{}-{}'.format(line, link_id))
+            run_time = run_times.setdefault((a, b), 60 * rnd.randint(1, 4) + 30 * rnd.randint(0, 1))
+            sub(timing_link, 'RunTime', duration(run_time))
+
+        route = sub(routes, 'Route', id='R_' + pattern_id)
+        sub(route, 'Description', '{} {} pattern {}'.format(line, direction, p))
+        sub(route, 'RouteSectionRef', 'RS_' + pattern_id)
+
+    service_code = '1-{}-_-y05-{}'.format(line, file_no)
+    services = sub(root, 'Services')
+    service = sub(services, 'Service')
+    sub(service, 'ServiceCode', service_code)
+    line_element = sub(sub(service, 'Lines'), 'Line', id='1-{}-_-y05-{}'.format(line, file_no))
+    sub(line_element, 'LineName', line)
+    period = sub(service, 'OperatingPeriod')
+    sub(period, 'StartDate', '2017-12-01')
+    sub(period, 'EndDate', '2018-06-30')
+    profile = sub(service, 'OperatingProfile')
+    sub(sub(sub(profile, 'RegularDayType'), 'DaysOfWeek'), 'MondayToSunday')
+    sub(service, 'Description', 'Synthetic {} line'.format(line))
+    standard_service = sub(service, 'StandardService')
+    sub(standard_service, 'Origin', stop_name(stops[0]))
+    sub(standard_service, 'Destination', stop_name(stops[-1]))
+    for direction, p, sequence in patterns:
+        pattern_id = '{}-{}-{}'.format(prefix, direction, p)
+        journey_pattern = sub(standard_service, 'JourneyPattern', id='JP_' + pattern_id)
+        sub(journey_pattern, 'Direction', direction)
+        sub(journey_pattern, 'RouteRef', 'R_' + pattern_id)
+        sub(journey_pattern, 'JourneyPatternSectionRefs', 'JPS_' + pattern_id)
+
+    vehicle_journeys = sub(root, 'VehicleJourneys')
+    for j in range(n_journeys):
+        direction, p, sequence = patterns[j % len(patterns)]
+        pattern_id = '{}-{}-{}'.format(prefix, direction, p)
+        vehicle_journey = sub(vehicle_journeys, 'VehicleJourney')
+        sub(vehicle_journey, 'PrivateCode', 'PC-{}-{}'.format(prefix, j))
+        sub(vehicle_journey, 'OperatorRef', 'OId_LUL')
+        profile = sub(vehicle_journey, 'OperatingProfile')
+        sub(sub(sub(profile, 'RegularDayType'), 'DaysOfWeek'), days_of_week[j % len(days_of_week)])
+        if rnd.random() < 0.5:
+            non_operation = sub(sub(profile, 'BankHolidayOperation'), 'DaysOfNonOperation')
+            for holiday in rnd.sample(bank_holidays, 2):
+                sub(non_operation, holiday)
+        # VehicleJourneyCode must be the 4th child. See TfLTimetable.get_varying_child_tags
+        sub(vehicle_journey, 'VehicleJourneyCode', 'VJ_{}-{}'.format(prefix, j))
+        sub(vehicle_journey, 'ServiceRef', service_code)
+        sub(vehicle_journey, 'LineRef', '1-{}-_-y05-{}'.format(line, file_no))
+        sub(vehicle_journey, 'JourneyPatternRef', 'JP_' + pattern_id)
+        # Spread the departures from 05:00 to 00:30 the next morning
+        departure = 5 * 3600 + int((19.5 * 3600) * j / max(n_journeys, 1)) // 60 * 60
+        sub(vehicle_journey, 'DepartureTime', '{:02d}:{:02d}:00'.format(
+            departure // 3600 % 24, departure // 60 % 60))
+
+    etree.ElementTree(root).write(path, xml_declaration=True, encoding='utf-8',
+                                  pretty_print=True)
+
+def generate(output_dir, n_lines=4, n_stops=30, n_interchanges=3, n_files=2,
+             n_patterns=2, n_journeys=200, seed=0):
+    """
+        Write `n_files` synthetic TransXChange files for each of `n_lines` lines
+        to `output_dir`
+
+        Returns the list of files written
+    """
+    network = make_network(n_lines, n_stops, n_interchanges, seed)
+    files = []
+    for line, stops in sorted(network.items()):
+        for file_no in range(n_files):
+            path = os.path.join(output_dir, 'tfl_1-{}-_-y05-{}.xml'.format(line, file_no + 1))
+            write_timetable(path, line, file_no + 1, stops, n_patterns, n_journeys, seed)
+            files.append(path)
+    return files
+
+@click.command()
+@click.argument('output_dir', required=1, type=click.Path(exists=True))
+@click.option('--lines', default=4, help='Number of lines')
+@click.option('--stops', default=30, type=click.IntRange(min=2), help='Number of stops per line')
+@click.option('--interchanges', default=3, help='Number of stops per line shared with other lines')
+@click.option('--files', default=2, help='Number of files per line')
+@click.option('--patterns', default=2, help='Number of journey patterns per direction in each file')
+@click.option('--vehicle-journeys', default=200, help='Number of vehicle journeys in each file')
+@click.option('--seed', default=0, help='Random seed')
+def main(output_dir, lines, stops, interchanges, files, patterns, vehicle_journeys, seed):
+    """
+        Write synthetic TransXChange timetables to OUTPUT_DIR
+    """
+    written = generate(output_dir, lines, stops, interchanges, files, patterns,
+                       vehicle_journeys, seed)
+    print('Wrote {} files to {}'.format(len(written), output_dir))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+#' ---
+#' title: "Table Dataset"
+#' ---
+
+#' This file writes and reads the tables output by [XMLParsing.py](XMLParsing.html)
+#' as partitioned Parquet datasets in place of one Feather file per Line and
+#' table.
+#'
+#' With the Feather output every consumer opens and concatenates the file of
+#' every Line to get one table even when it only needs a few Lines or
+#' columns. `XMLParsing.py --format parquet` instead writes a directory for
+#' each table holding one Parquet file for each Line in a hive style
+#' partition:
+#'
+#' ```
+#' VehicleJourneys/LineCode=BAK/part-0.parquet
+#' VehicleJourneys/LineCode=CEN/part-0.parquet
+#' ...
+#' StopPoints/LineCode=ALL/part-0.parquet
+#' ```
+#'
+#' The partition column is `LineCode` since the Services table already has a
+#' `Line` column. Each file is columnar with the categoricals of XMLParsing.py
+#' kept as dictionaries and the minimum and maximum of every column of each
+#' row group stored in its footer.
+#'
+#' `read_table` reads a table of either layout with
+#'
+#' * **columns**: only the given columns are read from disk
+#' * **lines**: only the partitions (or Feather files) of the given Lines are
+#'   opened. The tables common to every Line (see `XMLParsing.common_keys`)
+#'   are always read
+#' * **date**: the Lines without a Service whose Operating Period covers the
+#'   date are skipped. The Operating Periods are read from the Services table
+#'   with the date pushed down to the statistics of its row groups. Rows of
+#'   the remaining Lines are not filtered so that the
+#'   [ServiceCalendar](ServiceCalendar.html) built from them gives the same
+#'   journeys on that date as one built from every Line
+#'
+#' [Source code](https://github.com/ruaridhw/london-tube/blob/master/2_analysis/python/TableDataset.py)
+
+#+ tabledataset, engine='python'
+import glob
+import os
+import shutil
+
+# Name of the hive partition of each Line
+partition_column = 'LineCode'
+
+# Partition of the tables common to every Line
+common_line = 'ALL'
+
+# Rows of each row group and so the granularity of its statistics
+row_group_size = 1 << 16
+
+def is_dataset(data_dir, tablename):
+    """
+        Returns True if `tablename` is written as a partitioned dataset in `data_dir`
+    """
+    return os.path.isdir(os.path.join(data_dir, tablename))
+
+def partition_path(data_dir, tablename, line):
+    return os.path.join(data_dir, tablename, '{}={}'.format(partition_column, line),
+                        'part-0.parquet')
+
+def write_partition(df, data_dir, tablename, line):
+    """
+        df           DataFrame of the table for one Line
+        data_dir     Directory of the datasets
+        tablename    Name of the table
+        line         Line code or common_line
+
+        Replaces the partition of `line` in the dataset of `tablename`.
+        Returns the path of the file written
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    path = partition_path(data_dir, tablename, line)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), path,
+                   row_group_size=row_group_size, write_statistics=True)
+    return path
+
+def remove_partition(data_dir, tablename, line):
+    """
+        Removes the partition of `line` from the dataset of `tablename` if it exists
+    """
+    partition = os.path.dirname(partition_path(data_dir, tablename, line))
+    if os.path.isdir(partition):
+        shutil.rmtree(partition)
+
+def table_lines(data_dir, tablename):
+    """
+        Returns the sorted list of the Lines of `tablename` in `data_dir` in either layout
+    """
+    if is_dataset(data_dir, tablename):
+        prefix = partition_column + '='
+        return sorted(name[len(prefix):] for name in os.listdir(os.path.join(data_dir, tablename))
+                      if name.startswith(prefix))
+    suffix = '-{}.feather'.format(tablename)
+    return sorted(os.path.basename(f)[:-len(suffix)]
+                  for f in glob.glob(os.path.join(data_dir, '*' + suffix)))
+
+def open_dataset(data_dir, tablename, lines=None):
+    """
+        lines    Line codes of the partitions to open or None for every Line
+
+        Returns the pyarrow Dataset of `tablename`. The files of other Lines
+        are not opened.
+
+        A numeric column is written as integers in the Lines where it has no
+        missing values and as floats elsewhere (see `XMLParsing.encode_table`)
+        so the schema is unified across partitions rather than taken from
+        the first
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    if lines is None:
+        lines = table_lines(data_dir, tablename)
+    paths = [partition_path(data_dir, tablename, line) for line in sorted(lines)]
+    partitioning = ds.partitioning(pa.schema([(partition_column, pa.string())]), flavor='hive')
+    base_dir = os.path.join(data_dir, tablename)
+    dataset = ds.dataset(paths, format='parquet', partitioning=partitioning,
+                         partition_base_dir=base_dir)
+    schemas = [fragment.physical_schema for fragment in dataset.get_fragments()]
+    if len(schemas) < 2:
+        return dataset
+    schema = pa.unify_schemas(schemas, promote_options='permissive')
+    return ds.dataset(paths, format='parquet', partitioning=partitioning,
+                      partition_base_dir=base_dir,
+                      schema=schema.append(pa.field(partition_column, pa.string())))
+
+def idle_lines(data_dir, date):
+    """
+        date    ISO formatted date
+
+        Returns the set of Lines with Services none of whose Operating
+        Periods cover `date`. A missing end date is open ended
+    """
+    if is_dataset(data_dir, 'Services'):
+        import pyarrow.dataset as ds
+
+        start, end = ds.field('OpPeriod_StartDate'), ds.field('OpPeriod_EndDate')
+        running = (start.is_null() | (start <= date)) & (end.is_null() | (end >= date))
+        table = open_dataset(data_dir, 'Services').to_table(columns=[partition_column],
+                                                             filter=running)
+        running_lines = set(table.column(partition_column).to_pylist())
+    else:
+        services = read_table(data_dir, 'Services',
+                              columns=['OpPeriod_StartDate', 'OpPeriod_EndDate', partition_column])
+        if services is None:
+            return set()
+        start, end = services['OpPeriod_StartDate'], services['OpPeriod_EndDate']
+        running = (start.isnull() | (start <= date)) & (end.isnull() | (end >= date))
+        running_lines = set(services.loc[running, partition_column])
+    return set(table_lines(data_dir, 'Services')) - running_lines
+
+def read_table(data_dir, tablename, columns=None, lines=None, date=None):
+    """
+        data_dir     Directory of the output of XMLParsing.py in either layout
+        tablename    Name of the table
+        columns      List of columns to read or None for every column.
+                     May include partition_column
+        lines        Iterable of the Line codes to read or None for every Line
+        date         ISO formatted date. Lines not running on it are skipped
+
+        Returns a DataFrame of the rows of every Line read
+        or None if the table has none
+    """
+    import pandas as pd
+
+    read_lines = set(table_lines(data_dir, tablename))
+    if lines is not None:
+        read_lines &= set(lines) | {common_line}
+    if date is not None:
+        read_lines -= idle_lines(data_dir, date)
+    if not read_lines:
+        return None
+
+    if is_dataset(data_dir, tablename):
+        dataset = open_dataset(data_dir, tablename, read_lines)
+        if columns is None:
+            columns = [name for name in dataset.schema.names if name != partition_column]
+        return dataset.to_table(columns=columns).to_pandas()
+
+    import feather
+
+    file_columns = None if columns is None else [col for col in columns if col != partition_column]
+    dfs = []
+    for line in sorted(read_lines):
+        df = feather.read_dataframe(os.path.join(data_dir, '{}-{}.feather'.format(line, tablename)),
+                                    columns=file_columns)
+        if columns is not None and partition_column in columns:
+            df[partition_column] = line
+            df = df[columns]
+        dfs.append(df)
+    return pd.concat(dfs, ignore_index=True)
+
+def read_tables(data_dir, tablenames, columns=None, lines=None, date=None):
+    """
+        columns    Dictionary of {tablename: list of columns}. Tables not
+                   in it have every column read
+
+        Returns a dictionary of {tablename: DataFrame} as returned by `read_table`
+    """
+    columns = columns or {}
+    if date is not None:
+        # Only read the Operating Periods once
+        skip = idle_lines(data_dir, date)
+        lines = set(lines if lines is not None else
+                    {line for tablename in tablenames for line in table_lines(data_dir, tablename)})
+        lines -= skip
+    return {tablename: read_table(data_dir, tablename, columns.get(tablename), lines)
+            for tablename in tablenames}
@@ -31,6 +31,11 @@
 #' [Source code](https://github.com/ruaridhw/london-tube/blob/master/2_analysis/python/TfLTimetable.py)
 
 #+ tlftimetable_class, engine='python'
+import re
+import time
+from collections import OrderedDict
+
+import numpy as np
 import pandas as pd
 from lxml import etree
 
@@ -39,6 +44,9 @@ _DEBUG_ = False
 class TfLTimetable(etree._ElementTree):
     # Define TransXChange schema namespace
     ns = {'txc': 'http://www.transxchange.org.uk/'}
+
+    # Compiled XPaths shared by every instance. See compile_paths
+    _compiled = {}
     
     def __init__(self, file):
         """
@@ -60,7 +68,8 @@ class TfLTimetable(etree._ElementTree):
         """
         return self.xpath(path, namespaces=self.ns)
     
-    def get_tag(self, e):
+    @classmethod
+    def get_tag(cls, e):
         """
             e      An lxml node element
             
@@ -69,7 +78,7 @@ class TfLTimetable(etree._ElementTree):
             
             Returns the tag name as a string
         """
-        return e.tag.lstrip('{'+self.ns['txc']+'}')
+        return e.tag.lstrip('{'+cls.ns['txc']+'}')
 
     def get_varying_child_tags(self, path):
         """
@@ -91,47 +100,59 @@ class TfLTimetable(etree._ElementTree):
         tables = {}
         colnames = {}
         for e in self.get_xpath(path):
+            for tablename, cols, row in self.get_profile_rows(e):
+                colnames[tablename] = cols
+                if tablename not in tables:
+                    tables[tablename] = [row]
+                else:
+                    tables[tablename].append(row)
 
-            id_parent = e.getparent().getparent()
+        # Store DataFrame in dictionary keyed by tablename
+        for tablename, data in tables.items():
+            tables[tablename] = pd.DataFrame.from_records(data, columns = colnames[tablename])
 
-            # Extract the relevant id to store the extracted child tags against
-            if 'VehicleJourney' in id_parent.tag:
-                id_value = id_parent[3].text # VehicleJourneyCode is the 4th node of the parent
-                category = 'VehicleJourneys'
-            elif 'Service' in id_parent.tag:
-                id_value = id_parent[0].text # ServiceCode is the 1st node of the parent
-                category = 'Services'
-            else:
-                raise ValueError('This XPath is not yet supported')
+        return tables
 
-            if _DEBUG_: print(id_value)
+    @classmethod
+    def get_profile_rows(cls, e):
+        """
+            e      A child node of an Operating Profile
+                   (RegularDayType, BankHolidayOperation, ...)
 
-            # Loop through the types of profiles (RegularDayType, BankHolidayOperation, ...)
-            # creating a new table and column names for each
-            for profile in e:
-                tablename = category + '_' + self.get_tag(profile.getparent()) + '_' + \
-                    self.get_tag(profile)
-                colnames[tablename] = [category, self.get_tag(profile)]
+            Returns a list of (tablename, colnames, (id_value, cell_value))
+            tuples for each child tag found. See get_varying_child_tags
+        """
+        id_parent = e.getparent().getparent()
 
-                if _DEBUG_: print(col_name)
+        # Extract the relevant id to store the extracted child tags against
+        if 'VehicleJourney' in id_parent.tag:
+            id_value = id_parent[3].text # VehicleJourneyCode is the 4th node of the parent
+            category = 'VehicleJourneys'
+        elif 'Service' in id_parent.tag:
+            id_value = id_parent[0].text # ServiceCode is the 1st node of the parent
+            category = 'Services'
+        else:
+            raise ValueError('This XPath is not yet supported')
 
-                # Loop through the child tags extracting out the tag name and adding
-                # it to the newly created table
-                for child in profile.iterchildren():
-                    cell_value = self.get_tag(child)
+        if _DEBUG_: print(id_value)
 
-                    if tablename not in tables:
-                        tables[tablename] = [(id_value, cell_value)]
-                    else:
-                        tables[tablename].append((id_value, cell_value))
+        rows = []
+        # Loop through the types of profiles (RegularDayType, BankHolidayOperation, ...)
+        # creating a new table and column names for each
+        for profile in e:
+            tablename = category + '_' + cls.get_tag(profile.getparent()) + '_' + \
+                cls.get_tag(profile)
+            colnames = [category, cls.get_tag(profile)]
 
-                    if _DEBUG_: print(cell_value)
+            # Loop through the child tags extracting out the tag name and adding
+            # it to the newly created table
+            for child in profile.iterchildren():
+                cell_value = cls.get_tag(child)
+                rows.append((tablename, colnames, (id_value, cell_value)))
 
-        # Store DataFrame in dictionary keyed by tablename
-        for tablename, data in tables.items():
-            tables[tablename] = pd.DataFrame.from_records(data, columns = colnames[tablename])
+                if _DEBUG_: print(cell_value)
 
-        return tables
+        return rows
 
     def get_occasional_child_node(self, path):
         """
@@ -162,13 +183,80 @@ class TfLTimetable(etree._ElementTree):
             col.append(val[0] if len(val) > 0 else None)
         return col
 
-    def get_df(self, dict_of_paths):
+    def get_df(self, dict_of_paths, root=None, timings=None):
+        """
+            dict_of_paths    A dictionary of XPaths all corresponding
+                             to a single table.
+                             See TfLTimetable.NptgLocalities et al.
+            root             The XPath to the row nodes of the table.
+                             Looked up in TfLTimetable.required_roots if
+                             dict_of_paths is one of the required tables
+            timings          Optional dictionary updated with the seconds
+                             spent in the XPath of each column
+
+            Finds the row nodes of the table once and evaluates a precompiled
+            XPath relative to each row for every column. A row missing a
+            value gets an explicit None so the columns always line up.
+
+            Falls back to `get_df_by_column` if the root is not known.
+
+            Returns a single dataframe where each column corresponds to
+            the keys of dict_of_paths
+        """
+        if root is None:
+            for table, paths in self.required_xpaths.items():
+                if paths == dict_of_paths:
+                    root = self.required_roots[table]
+                    break
+            else:
+                return self.get_df_by_column(dict_of_paths)
+
+        root_xpath, col_xpaths = self.compile_paths(root, dict_of_paths)
+        nodes = root_xpath(self)
+        cols = OrderedDict()
+        for var, xpath in col_xpaths:
+            then = time.perf_counter()
+            col = []
+            for node in nodes:
+                val = xpath(node)
+                col.append(val[0] if len(val) > 0 else None)
+            cols[var] = col
+            if timings is not None:
+                timings[var] = time.perf_counter() - then
+
+        return pd.DataFrame(cols, columns=list(cols))
+
+    @classmethod
+    def compile_paths(cls, root, dict_of_paths):
+        """
+            root             The XPath to the row nodes of a table
+            dict_of_paths    A dictionary of XPaths starting with `root`
+
+            Compiles the root XPath and each column XPath relative to a row
+            (see row_paths) once per table. Values are returned as plain
+            strings which do not keep a reference to the tree.
+
+            Returns a tuple of the root etree.XPath and a list of
+            (column name, etree.XPath) tuples
+        """
+        key = (root, tuple(dict_of_paths.items()))
+        if key not in cls._compiled:
+            col_xpaths = [(var, etree.XPath(path, namespaces=cls.ns, smart_strings=False))
+                          for var, path in cls.row_paths(root, dict_of_paths).items()]
+            cls._compiled[key] = (etree.XPath(root, namespaces=cls.ns), col_xpaths)
+        return cls._compiled[key]
+
+    def get_df_by_column(self, dict_of_paths):
         """
             dict_of_paths    A dictionary of XPaths all corresponding
                              to a single table and should therefore be
                              equal in the number of returned rows for
                              each path.
                              See TfLTimetable.NptgLocalities et al.
+
+            The original extraction method which runs one XPath over the whole
+            document per column. Kept for tables without a known root and
+            for comparison with `get_df` in Benchmarks.py.
             
             Dispatches Case 1, 2 or 3 depending on any special characters
             foun in the incumbent XPath.
@@ -197,9 +285,206 @@ class TfLTimetable(etree._ElementTree):
             else:
                 cols.append((var, self.get_xpath(path)))
             
-        df = pd.DataFrame.from_items(cols)
+        df = pd.DataFrame(OrderedDict(cols))
         return df
 
+#' ## Streaming
+#'
+#' Parsing a whole file into an ElementTree keeps every node in memory which
+#' for bus-scale TransXChange files with hundreds of thousands of
+#' VehicleJourneys needs gigabytes. The methods below instead use
+#' `etree.iterparse` to handle each row node (StopPoint, JourneyPatternTimingLink,
+#' VehicleJourney, ...) as soon as it closes, extract its columns with XPaths
+#' relative to the row and then clear it, so peak memory does not depend on
+#' the size of the file.
+#'
+#' These are class methods and do not require parsing the file on initialisation.
+
+    @classmethod
+    def row_paths(cls, root, dict_of_paths):
+        """
+            root             The XPath to the row nodes of a table.
+                             See TfLTimetable.required_roots
+            dict_of_paths    A dictionary of XPaths starting with `root`
+
+            Converts each XPath into one relative to a row node.
+            The special characters handled by `get_df` become valid XPath:
+            a tilde is a child step and parent::node() the id of the parent.
+
+            Returns a dictionary of relative XPaths keyed as per dict_of_paths
+        """
+        paths = {}
+        for var, path in dict_of_paths.items():
+            path = path[len(root):].lstrip('/~').replace('~', '/')
+            if path.endswith('parent::node()'):
+                path = '../@id'
+            paths[var] = path
+        return paths
+
+    @classmethod
+    def iter_rows(cls, file):
+        """
+            file    Path to a TransXChange Timetable XML file
+
+            Yields a (tablename, colnames, row) tuple for every row of
+            every table in required_xpaths and every Operating Profile table
+            in the order the row nodes close in the file.
+            Missing values are None.
+        """
+        ns = '{' + cls.ns['txc'] + '}'
+
+        # Index the tables by the tag of their row nodes
+        records = {}
+        for table, root in cls.required_roots.items():
+            steps = [step.split(':')[-1] for step in root.split('/')[1:]]
+            root_xpath, col_xpaths = cls.compile_paths(root, cls.required_xpaths[table])
+            records.setdefault(steps[-1], []).append(
+                (table, steps, [var for var, xpath in col_xpaths],
+                 [xpath for var, xpath in col_xpaths]))
+        profiles = [[step.split(':')[-1] for step in path.split('/')[1:-2]]
+                    for path in cls.op_prof_paths]
+
+        # Intermediate nodes such as RouteSection are cleared as well unless
+        # they are inside another row node that is still being parsed
+        containers = set()
+        for row_nodes in records.values():
+            for table, steps, colnames, paths in row_nodes:
+                if not any(step in records for step in steps[:-1]):
+                    containers.update(steps[1:-1])
+        row_tags = [ns + tag for tag in records]
+
+        for event, elem in etree.iterparse(file, events=('end',),
+                                           tag=row_tags + [ns + tag for tag in containers]):
+            tag = elem.tag[len(ns):]
+            for table, steps, colnames, paths in records.get(tag, ()):
+                if cls._is_at(elem, steps):
+                    row = []
+                    for xpath in paths:
+                        val = xpath(elem)
+                        row.append(val[0] if len(val) > 0 else None)
+                    yield table, colnames, tuple(row)
+
+            for steps in profiles:
+                if tag == steps[-1] and cls._is_at(elem, steps):
+                    for e in elem.iterfind('txc:OperatingProfile/*', namespaces=cls.ns):
+                        yield from cls.get_profile_rows(e)
+
+            # Free the node and the already handled siblings before it
+            if next(elem.iterancestors(*row_tags), None) is None:
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+
+    @staticmethod
+    def _is_at(elem, steps):
+        """
+            Returns True if the tags of `elem` and its ancestors are `steps`
+            directly beneath the document root
+        """
+        for step in reversed(steps):
+            if elem is None or etree.QName(elem).localname != step:
+                return False
+            elem = elem.getparent()
+        return elem is not None and elem.getparent() is None
+
+    @classmethod
+    def stream_tables(cls, file):
+        """
+            file    Path to a TransXChange Timetable XML file
+
+            Streaming equivalent of calling `get_df` for every table in
+            required_xpaths and `get_varying_child_tags` for every path
+            in op_prof_paths
+
+            Returns a dictionary of DataFrames keyed by tablename
+        """
+        rows = {table: [] for table in cls.required_xpaths}
+        colnames = {table: list(paths) for table, paths in cls.required_xpaths.items()}
+        for table, cols, row in cls.iter_rows(file):
+            if table not in rows:
+                rows[table] = []
+                colnames[table] = cols
+            rows[table].append(row)
+
+        return {table: pd.DataFrame.from_records(data, columns=colnames[table])
+                for table, data in rows.items()}
+
+#' ## Numeric columns
+#'
+#' Durations such as the RunTime of a JourneyPatternTimingLink are extracted
+#' as ISO 8601 strings (PT2M30S) and times of day as HH:MM:SS strings.
+#' `to_numeric` converts these columns to seconds as floats with NaN for
+#' missing values.
+#'
+#' The columns have few distinct values (every RunTime of the tube
+#' timetables is a whole number of minutes) so each string is only parsed
+#' once: the column is factorised into codes and unique values, the uniques
+#' are parsed and the seconds of every row are taken from them by code.
+
+    _duration = re.compile(r'^P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+(?:\.\d*)?)S)?)?$')
+    _time_of_day = re.compile(r'^(\d+):(\d+)(?::(\d+(?:\.\d*)?))?$')
+
+    @staticmethod
+    def _parse_uniques(values, pattern, multipliers):
+        """
+            values         Array-like of strings or None
+            pattern        Compiled regex with one group per multiplier
+            multipliers    Seconds per unit of each group
+
+            Returns a float64 array of seconds. Values that are already
+            numeric are returned as they are
+        """
+        values = pd.Series(values)
+        if values.dtype.kind in 'iuf':
+            return values.values.astype(np.float64)
+        codes, uniques = pd.factorize(values.astype(object))
+        seconds = np.empty(len(uniques) + 1)
+        for i, value in enumerate(uniques):
+            match = pattern.match(str(value).strip())
+            if match is None or not any(match.groups()):
+                seconds[i] = np.nan
+            else:
+                seconds[i] = sum(float(group) * multiplier
+                                 for group, multiplier in zip(match.groups(), multipliers)
+                                 if group is not None)
+        # Missing values have code -1 which takes the final NaN
+        seconds[-1] = np.nan
+        return seconds[codes]
+
+    @classmethod
+    def duration_seconds(cls, values):
+        """
+            values    Array-like of ISO 8601 durations such as PT1H2M30S
+
+            Returns a float64 array of seconds with NaN for missing values
+        """
+        return cls._parse_uniques(values, cls._duration, (86400, 3600, 60, 1))
+
+    @classmethod
+    def time_of_day_seconds(cls, values):
+        """
+            values    Array-like of times of day such as 05:32:00
+
+            Returns a float64 array of seconds past midnight with NaN for missing values
+        """
+        return cls._parse_uniques(values, cls._time_of_day, (3600, 60, 1))
+
+    @classmethod
+    def to_numeric(cls, tables):
+        """
+            tables    Dictionary of DataFrames keyed by tablename as
+                      returned by `stream_tables`
+
+            Converts the columns in numeric_columns to seconds in place
+
+            Returns `tables`
+        """
+        for table, converters in cls.numeric_columns.items():
+            if table in tables:
+                for col, converter in converters.items():
+                    tables[table][col] = getattr(cls, converter)(tables[table][col])
+        return tables
+
 #' ## XPaths
 #'
 #' Contains the XPath definitions of the columns for each table within a
@@ -318,6 +603,27 @@ class TfLTimetable(etree._ElementTree):
         "VehicleJourneys": VehicleJourneys
     }
 
+#' The row nodes of each table used when streaming a file with `iter_rows`
+
+    required_roots = {
+        "NptgLocalities": root_localities,
+        "StopPoints": root_stops,
+        "RouteLinks": root_routelinks,
+        "Routes": root_routes,
+        "JourneyPatternTimingLinks": root_journeysections,
+        "Services": root_services,
+        "JourneyPatterns": root_journeypatterns,
+        "VehicleJourneys": root_vehiclejourneys
+    }
+
+#' Columns converted to seconds by `to_numeric` and the method converting each
+
+    numeric_columns = {
+        "JourneyPatternTimingLinks": {"RunTime": "duration_seconds",
+                                      "WaitTime": "duration_seconds"},
+        "VehicleJourneys": {"DepartureTime": "time_of_day_seconds"}
+    }
+
 #' Defines the Operating Profile XPaths which require scraping via `get_varying_child_tags`
 #' rather than `get_df` as per all other XPaths.
 
@@ -0,0 +1,156 @@
+#' ---
+#' title: "Timetable Store"
+#' ---
+
+#' This file provides an exporter and loader for a compact binary
+#' timetable format used in place of the Departures Board GPickle object.
+#'
+#' Unpickling the NetworkX graph creates millions of Python node and edge
+#' dictionaries which dominates the start up time and memory of every process
+#' that plans journeys. The same timetable is stored here as a directory of
+#' columns, one `.npy` file per connection attribute, with integer codes for
+#' the stops, vehicle journeys and lines:
+#'
+#' | File                  | Type    | Description                              |
+#' |-----------------------|---------|------------------------------------------|
+#' | `dep_stop.npy`        | int32   | Stop code of the departure station       |
+#' | `arr_stop.npy`        | int32   | Stop code of the arrival station         |
+#' | `dep_time.npy`        | float64 | Departure minute past midnight           |
+#' | `arr_time.npy`        | float64 | Arrival minute past midnight             |
+#' | `trip.npy`            | int32   | Vehicle journey code                     |
+#' | `line.npy`            | int16   | Line code                                |
+#' | `arr_order.npy`       | int32   | Connection order by arrival minute       |
+#' | `arr_time_sorted.npy` | float64 | Arrival minutes in `arr_order`           |
+#' | `meta.json`           |         | Names for each code and format version   |
+#' | `calendar_days.npy`   | uint8   | Optional packed days each journey runs   |
+#'
+#' The connections are saved already sorted by departure minute so
+#' loading only memory-maps the columns. Opening a timetable takes
+#' milliseconds and the pages are shared through the OS page cache by
+#' every process that opens the same directory.
+#'
+#' To convert a GPickle object:
+#' `$python3 python/TimetableStore.py DeparturesGraph20171218.gpickle DeparturesTimetable20171218`
+#'
+#' A timetable answering queries for any date is made from the graphs of
+#' several dates (which together hold every journey) and the
+#' [ServiceCalendar](ServiceCalendar.html) of the XMLParsing.py output:
+#' `$python3 python/TimetableStore.py --calendar data DeparturesGraph2017121*.gpickle DeparturesTimetable`
+#'
+#' [Source code](https://github.com/ruaridhw/london-tube/blob/master/2_analysis/python/TimetableStore.py)
+
+#+ timetablestore, engine='python'
+import json
+import os
+
+import click
+import numpy as np
+
+from ConnectionScan import ConnectionScan
+
+FORMAT_VERSION = 1
+
+columns = ['dep_stop', 'arr_stop', 'dep_time', 'arr_time', 'trip', 'line',
+           'arr_order', 'arr_time_sorted']
+
+def write_timetable(cs, path, **meta):
+    """
+        cs      A ConnectionScan object
+        path    Directory to write the timetable to. Created if it does not exist
+        meta    Any further values to store in meta.json such as the timetable date
+    """
+    os.makedirs(path, exist_ok=True)
+    for col in columns:
+        np.save(os.path.join(path, col + '.npy'), np.ascontiguousarray(getattr(cs, col)))
+    if cs.calendar is not None:
+        calendar = cs.calendar.calendar
+        np.save(os.path.join(path, 'calendar_days.npy'), calendar.days)
+        meta = dict(meta,
+                    calendar_start=calendar.start_date.isoformat(),
+                    calendar_journeys=calendar.journeys)
+
+    meta = dict(meta,
+                format_version=FORMAT_VERSION,
+                n_connections=len(cs),
+                stop_names=cs.stop_names,
+                trip_codes=cs.trip_codes,
+                line_names=cs.line_names,
+                atco_codes=cs.stations.atco_codes)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+def read_meta(path):
+    """
+        Returns the dictionary stored in meta.json of a timetable directory
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta['format_version'] != FORMAT_VERSION:
+        raise ValueError('Timetable format version {} is not supported'
+                         .format(meta['format_version']))
+    return meta
+
+def read_timetable(path, mmap=True, stop_points=None, fuzzy=False):
+    """
+        path          Directory written by write_timetable
+        mmap          Memory-map the columns read-only rather than reading them into memory
+        stop_points, fuzzy
+                      Station name resolution options. See StationIndex.StationNames
+
+        Returns a ConnectionScan object
+    """
+    meta = read_meta(path)
+    arrays = {col: np.load(os.path.join(path, col + '.npy'),
+                           mmap_mode='r' if mmap else None)
+              for col in columns}
+    cs = ConnectionScan(meta['stop_names'], meta['trip_codes'], meta['line_names'],
+                        atco_codes=meta['atco_codes'], stop_points=stop_points,
+                        fuzzy=fuzzy, **arrays)
+    if 'calendar_start' in meta:
+        from ServiceCalendar import ServiceCalendar, TripCalendar
+        days = np.load(os.path.join(path, 'calendar_days.npy'))
+        calendar = ServiceCalendar(meta['calendar_journeys'], meta['calendar_start'], days)
+        cs.calendar = TripCalendar(calendar, cs.trip_codes)
+    return cs
+
+def load_timetable(path, mmap=True, stop_points=None, fuzzy=False):
+    """
+        path    A timetable directory written by write_timetable
+                or a Departures Board NetworkX GPickle object
+
+        Returns a ConnectionScan object
+    """
+    if os.path.isdir(path):
+        return read_timetable(path, mmap, stop_points, fuzzy)
+
+    from DeparturesGraph import read_gpickle
+
+    return ConnectionScan.from_graph(read_gpickle(path), stop_points, fuzzy)
+
+@click.command()
+@click.argument('gpickle_files', nargs=-1, required=1, type=click.Path(exists=True))
+@click.argument('output_dir', required=1, type=click.Path())
+@click.option('--calendar', type=click.Path(exists=True),
+              help='Directory of XMLParsing.py output to build a ServiceCalendar from')
+def main(gpickle_files, output_dir, calendar):
+    """
+        Convert Departures Board NetworkX GPickle objects to
+        the binary timetable format read by `read_timetable`
+
+        The graphs of several dates are combined into one timetable
+        of every journey which should be used with --calendar
+    """
+    import networkx as nx
+
+    from DeparturesGraph import read_gpickle
+
+    H = nx.compose_all([read_gpickle(f) for f in gpickle_files])
+    cs = ConnectionScan.from_graph(H)
+    if calendar:
+        from ServiceCalendar import ServiceCalendar, dated_timetable
+        cs = dated_timetable(cs, ServiceCalendar.from_directory(calendar))
+    write_timetable(cs, output_dir, source=[os.path.basename(f) for f in gpickle_files])
+    print('Wrote {} connections to {}'.format(len(cs), output_dir))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+#' ---
+#' title: "Travel Times"
+#' ---
+
+#' This file computes travel-time matrices between every pair of stations
+#' for every departure minute in a window. Running one
+#' [ConnectionScan](ConnectionScan.html) query per origin, destination and
+#' minute would take hundreds of thousands of queries.
+#'
+#' Instead the profile variant of the Connection Scan Algorithm scans the
+#' connections once, backwards from the end of the day, for each destination
+#' station. The scan keeps a *profile* for every station: the Pareto set of
+#' (departure minute, arrival minute) pairs for reaching the destination.
+#' A profile answers "when do I arrive if I leave this station at minute t"
+#' for every t at once so a single sweep gives the travel times from all
+#' stations at all minutes to that destination. Each destination is
+#' independent so the sweeps run in a process pool.
+#'
+#' The result is a float32 array of travel minutes indexed by
+#' `[origin station, destination station, departure minute]` with `inf`
+#' where the destination cannot be reached. It includes any wait at the origin.
+#'
+#' `$python3 python/TravelTimes.py --start 07:00 --end 10:00 --step 5 --jobs 4 DeparturesTimetable20171218 TravelTimes20171218`
+#'
+#' writes `TravelTimes20171218.npy` with the station names and minutes of
+#' each axis in `TravelTimes20171218.json`.
+#'
+#' [Source code](https://github.com/ruaridhw/london-tube/blob/master/2_analysis/python/TravelTimes.py)
+
+#+ traveltimes, engine='python'
+import bisect
+import json
+import os
+
+import click
+import numpy as np
+
+_INF = float('inf')
+
+def profiles(cs, target, earliest=-_INF):
+    """
+        cs          A ConnectionScan object
+        target      Stop code of the destination station
+        earliest    No journeys leaving before this minute are needed so
+                    connections departing earlier are not scanned
+
+        Scans the connections in decreasing order of departure minute.
+        The arrival minute at the target of each connection is the earliest of
+        1. Its own arrival minute if it arrives at the target
+        2. Staying seated on the same train
+        3. Changing to the best journey from its arrival station
+           leaving no earlier than it arrives
+
+        Returns a list indexed by stop code of (departures, arrivals) arrays
+        both in increasing order where departing at departures[i] reaches
+        the target at arrivals[i] at the earliest
+    """
+    n_stops = len(cs.stop_names)
+    # Both are appended to in decreasing order of departure minute.
+    # Departures are negated so that they can be bisected
+    neg_deps = [[] for _ in range(n_stops)]
+    arrs = [[] for _ in range(n_stops)]
+    trip_arrival = {}
+
+    start = np.searchsorted(cs.dep_time, earliest, 'left')
+    for c, dep_stop, arr_stop, dep_time, arr_time, trip in \
+            cs._iter_connections(np.arange(len(cs) - 1, start - 1, -1, dtype=np.int32)):
+        best = arr_time if arr_stop == target else trip_arrival.get(trip, _INF)
+        if best > arr_time:
+            k = bisect.bisect_right(neg_deps[arr_stop], -arr_time)
+            if k and arrs[arr_stop][k - 1] < best:
+                best = arrs[arr_stop][k - 1]
+        if best == _INF:
+            continue
+        trip_arrival[trip] = best
+
+        # Only keep the pair if it improves on leaving later
+        stop_arrs = arrs[dep_stop]
+        if dep_stop != target and (not stop_arrs or best < stop_arrs[-1]):
+            if stop_arrs and neg_deps[dep_stop][-1] == -dep_time:
+                stop_arrs[-1] = best
+            else:
+                neg_deps[dep_stop].append(-dep_time)
+                stop_arrs.append(best)
+
+    return [(-np.array(neg_deps[s][::-1]), np.array(arrs[s][::-1])) for s in range(n_stops)]
+
+def travel_times_to(cs, target, minutes):
+    """
+        cs         A ConnectionScan object
+        target     Stop code of the destination station
+        minutes    Array of departure minutes
+
+        Returns a float32 array of travel minutes indexed by [origin stop code, minute]
+    """
+    minutes = np.asarray(minutes, dtype=np.float64)
+    times = np.full((len(cs.stop_names), len(minutes)), np.inf, dtype=np.float32)
+    for stop, (deps, arrs) in enumerate(profiles(cs, target, minutes.min())):
+        if len(deps):
+            i = np.searchsorted(deps, minutes, 'left')
+            reachable = i < len(deps)
+            times[stop, reachable] = arrs[i[reachable]] - minutes[reachable]
+    times[target] = 0
+    return times
+
+# Timetable of each worker process
+_cs = None
+
+def _init_worker(path):
+    from TimetableStore import load_timetable
+
+    global _cs
+    _cs = load_timetable(path)
+
+def _travel_times_to(args):
+    return travel_times_to(_cs, *args)
+
+def travel_time_matrix(path, minutes, jobs=1):
+    """
+        path       Location of the timetable. See TimetableStore.load_timetable
+        minutes    Array of departure minutes
+        jobs       Number of processes each sweeping a share of the
+                   destinations. 0 uses every core
+
+        Returns the station names and a float32 array of travel minutes
+        indexed by [origin, destination, minute]
+    """
+    import concurrent.futures
+
+    _init_worker(path)
+    n_stops = len(_cs.stop_names)
+    tasks = [(target, minutes) for target in range(n_stops)]
+    if jobs == 1:
+        columns = map(_travel_times_to, tasks)
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(jobs or os.cpu_count(),
+                                                          initializer=_init_worker,
+                                                          initargs=(path,))
+        columns = executor.map(_travel_times_to, tasks, chunksize=4)
+
+    matrix = np.empty((n_stops, n_stops, len(minutes)), dtype=np.float32)
+    for target, times in enumerate(columns):
+        matrix[:, target, :] = times
+    if jobs != 1:
+        executor.shutdown()
+    return list(_cs.stop_names), matrix
+
+def to_minutes(hh_mm):
+    """
+        Convert a time of the form HH:MM to minutes past midnight
+    """
+    hours, minutes = hh_mm.split(':')
+    return int(hours) * 60 + int(minutes)
+
+@click.command()
+@click.argument('timetable', required=1, type=click.Path(exists=True))
+@click.argument('output', required=1, type=click.Path())
+@click.option('--start', default='07:00', help='First departure time HH:MM')
+@click.option('--end', default='10:00', help='Last departure time HH:MM (inclusive)')
+@click.option('--step', default=1, help='Minutes between departure times')
+@click.option('--jobs', '-j', default=1, help='Number of processes. 0 uses every core')
+@click.option('--feather', is_flag=True,
+              help='Also write the reachable travel times as a long Feather table')
+def main(timetable, output, start, end, step, jobs, feather):
+    """
+        Compute the travel time between every pair of stations of TIMETABLE
+        for each departure minute and save them to OUTPUT.npy
+    """
+    import time
+
+    minutes = np.arange(to_minutes(start), to_minutes(end) + 1, step, dtype=np.float64)
+    then = time.perf_counter()
+    stations, matrix = travel_time_matrix(timetable, minutes, jobs)
+    print('{} x {} stations x {} minutes in {:.1f}s'.format(len(stations), len(stations),
+                                                          len(minutes),
+                                                          time.perf_counter() - then))
+
+    np.save(output + '.npy', matrix)
+    with open(output + '.json', 'w') as f:
+        json.dump({'stations': stations, 'minutes': minutes.tolist()}, f)
+
+    if feather:
+        import feather as ft
+        import pandas as pd
+
+        origin, destination, minute = np.nonzero(np.isfinite(matrix))
+        ft.write_dataframe(pd.DataFrame({
+            'From_StopPointName': np.array(stations, dtype=object)[origin],
+            'To_StopPointName': np.array(stations, dtype=object)[destination],
+            'MinuteOfDay': minutes[minute],
+            'TravelTime': matrix[origin, destination, minute]
+        }), output + '.feather')
+
+if __name__ == '__main__':
+    main()
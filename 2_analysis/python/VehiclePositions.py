@@ -0,0 +1,179 @@
+#' ---
+#' title: "Vehicle Positions"
+#' ---
+
+#' This file finds the position of every train running at a point in time
+#' from the departure board (see [Departures.py](Departures.html) or the
+#' [departureboard](DepartureBoard.html) SQL function) for the tube
+#' animations.
+#'
+#' NumberOfTrainsPointInTime.sql answers this for one minute by grouping the
+#' whole departures table by vehicle and joining it back to itself, so an
+#' animation needs a database query for every frame. The links of every
+#' train tile its journey: each starts at the `DepartureMins_Link` of the
+#' link and ends at the `ArrivalMins_Link`, which is the departure of the next
+#' link. A train is running at time `t` if one of its links has
+#' `DepartureMins_Link <= t < ArrivalMins_Link` and it is then between the
+#' From and To StopPoints of that link.
+#'
+#' The links are held in an interval index: NumPy arrays sorted by
+#' `DepartureMins_Link`. Since no link is longer than the longest
+#' `JourneyTime`, every link active at `t` departs in the window
+#' `(t - longest, t]` which is found with two binary searches and then
+#' filtered on `ArrivalMins_Link`. The position of a train is interpolated
+#' linearly between the longitudes and latitudes of the From and To
+#' StopPoints by the fraction of the link's time that has passed. Any
+#' WaitTime at the To StopPoint is part of the link's `JourneyTime` so it
+#' is spread over the link rather than spent at the station. A train
+#' arriving at a StopPoint exactly at `t` is placed at the start of its next
+#' link where the SQL query places it at the end of the last, which is the
+#' same place.
+#'
+#' `frames` finds the positions of every frame of an animation at once.
+#' The frames during which each link is active are a range of frame
+#' numbers computed from its departure and arrival so every
+#' (frame, link) pair is generated by one `np.repeat` without a search
+#' per frame.
+#'
+#' To write the positions of every minute from 05:00 to midnight:
+#' `$python3 python/VehiclePositions.py --start 300 --end 1440 DepartureBoard20171218.feather positions.feather`
+#'
+#' [Source code](https://github.com/ruaridhw/london-tube/blob/master/2_analysis/python/VehiclePositions.py)
+
+#+ vehiclepositions, engine='python'
+import click
+import numpy as np
+import pandas as pd
+
+# Columns of the DataFrames returned by VehiclePositions
+position_columns = ['VehicleJourneyCode', 'Line', 'From_StopPointName', 'To_StopPointName',
+                    'Progress', 'Longitude', 'Latitude']
+
+class VehiclePositions(object):
+
+    def __init__(self, df):
+        """
+            df    Departure board DataFrame with the columns of
+                  DeparturesGraph.departureboard_columns
+        """
+        df = df.sort_values('DepartureMins_Link', kind='mergesort')
+        self.dep = df['DepartureMins_Link'].values.astype(np.float64)
+        self.arr = df['ArrivalMins_Link'].values.astype(np.float64)
+        self.longest = (self.arr - self.dep).max() if len(df) else 0.0
+        self.from_lon = df['From_Longitude'].values.astype(np.float64)
+        self.from_lat = df['From_Latitude'].values.astype(np.float64)
+        self.to_lon = df['To_Longitude'].values.astype(np.float64)
+        self.to_lat = df['To_Latitude'].values.astype(np.float64)
+
+        # Text columns as codes into their unique values.
+        # Missing values have the code -1 and so take the None appended at the end
+        self._codes = {}
+        self._uniques = {}
+        for col in ['VehicleJourneyCode', 'Line', 'From_StopPointName', 'To_StopPointName']:
+            codes, uniques = pd.factorize(df[col])
+            self._codes[col] = codes
+            self._uniques[col] = np.append(np.asarray(uniques, dtype=object), None)
+
+    def __len__(self):
+        return len(self.dep)
+
+    def active_links(self, t):
+        """
+            Returns the positions in the index of the links active at minute `t`
+        """
+        lo = np.searchsorted(self.dep, t - self.longest, side='right')
+        hi = np.searchsorted(self.dep, t, side='right')
+        candidates = np.arange(lo, hi)
+        return candidates[self.arr[candidates] > t]
+
+    def _positions(self, links, t):
+        """
+            links    Array of positions in the index
+            t        Array of minutes (or a scalar) at which each link is active
+
+            Returns a DataFrame of position_columns
+        """
+        duration = self.arr[links] - self.dep[links]
+        progress = np.divide(t - self.dep[links], duration, out=np.zeros(len(links)),
+                             where=duration > 0)
+        df = pd.DataFrame({col: uniques[self._codes[col][links]]
+                           for col, uniques in self._uniques.items()})
+        df['Progress'] = progress
+        from_lon, from_lat = self.from_lon[links], self.from_lat[links]
+        df['Longitude'] = from_lon + progress * (self.to_lon[links] - from_lon)
+        df['Latitude'] = from_lat + progress * (self.to_lat[links] - from_lat)
+        return df[position_columns]
+
+    def at(self, t):
+        """
+            t    Minutes past midnight
+
+            Returns a DataFrame with one row for each train running at `t`
+            with its line, the StopPoints it is between, the fraction of the
+            link travelled and its interpolated longitude and latitude
+        """
+        return self._positions(self.active_links(t), t).reset_index(drop=True)
+
+    def count(self, t):
+        """
+            Returns the number of trains running at minute `t`
+        """
+        return len(self.active_links(t))
+
+    def frames(self, start, end, step=1):
+        """
+            start    Minute of the first frame
+            end      Minute after the last frame
+            step     Minutes between frames
+
+            Returns a DataFrame of the positions of every train at every
+            frame, as returned by `at`, with the columns `Frame` (numbered
+            from 0) and `Minute` in front, sorted by frame
+        """
+        n_frames = int(np.ceil((end - start) / step))
+        # First and one past the last frame at which each link is active,
+        # widened by a frame either side for rounding and then checked exactly
+        first = np.clip(np.ceil((self.dep - start) / step) - 1, 0, n_frames).astype(np.int64)
+        last = np.clip(np.ceil((self.arr - start) / step) + 1, 0, n_frames).astype(np.int64)
+        counts = np.maximum(last - first, 0)
+
+        links = np.repeat(np.arange(len(self)), counts)
+        offsets = np.arange(len(links)) - np.repeat(np.cumsum(counts) - counts, counts)
+        frame = np.repeat(first, counts) + offsets
+        minute = start + frame * step
+        active = (self.dep[links] <= minute) & (minute < self.arr[links])
+        links, frame, minute = links[active], frame[active], minute[active]
+
+        order = np.argsort(frame, kind='mergesort')
+        links, frame, minute = links[order], frame[order], minute[order]
+
+        df = self._positions(links, minute)
+        df.insert(0, 'Minute', minute)
+        df.insert(0, 'Frame', frame)
+        return df.reset_index(drop=True)
+
+@click.command()
+@click.argument('departure_board', required=1, type=click.Path(exists=True))
+@click.argument('output_file', required=1, type=click.Path())
+@click.option('--start', default=300.0, help='Minute of the first frame')
+@click.option('--end', default=1440.0, help='Minute after the last frame')
+@click.option('--step', default=1.0, help='Minutes between frames')
+def main(departure_board, output_file, start, end, step):
+    """
+        Write the position of every train at every frame from START to END
+        using the Feather DEPARTURE_BOARD written by Departures.py
+        to OUTPUT_FILE as a Feather file
+    """
+    import time
+
+    import feather
+
+    then = time.perf_counter()
+    positions = VehiclePositions(feather.read_dataframe(departure_board))
+    df = positions.frames(start, end, step)
+    feather.write_dataframe(df, output_file)
+    print('Wrote {} positions in {} frames in {:.1f}s'.format(
+        len(df), df['Frame'].nunique(), time.perf_counter() - then))
+
+if __name__ == '__main__':
+    main()
@@ -29,18 +29,316 @@
 #' tube lines, these are held in memory throughout the iteration in
 #' `output_tables_common` without being written to disk after each line
 #' and dumped to a single file with the prefix "ALL" in place of the line code.
+#' Each is gathered in a `KeyedTable` which keeps the first row seen for
+#' every AtcoCode or NptgLocalityRef and reports any later row with the same
+#' key but different attributes rather than keeping both.
+#'
+#' The RunTime and WaitTime of JourneyPatternTimingLinks and the DepartureTime
+#' of VehicleJourneys are output as seconds rather than as text.
 #'
 #' To enable efficient transition between Python and R, the DFs are
 #' serialised into the Feather format.
+#' With `--format parquet` each table is instead written as a Parquet dataset
+#' partitioned by Line so that readers can load only the Lines and columns
+#' they need. See [TableDataset.py](TableDataset.html).
+#'
+#' # Encoding
+#'
+#' Most text columns repeat a few values many times (stop codes, journey
+#' pattern ids, Activity values, line codes, ...) so they are written as
+#' categoricals (dictionary encoded in Feather and read by R as factors).
+#' Every column of stop codes, in StopPoints, RouteLinks and
+#' JourneyPatternTimingLinks, shares one dictionary of every stop code in the
+#' input so that they can be compared and joined by code across tables and
+#' Lines. The dictionary is kept in the manifest (see below) and every Line is
+#' rewritten if it changes. Sequence numbers, Eastings, Northings and
+#' Distances are written as integers (or floats if any are missing).
+#'
+#' # Incremental ingest
+#'
+#' Each weekly drop of timetables usually changes only a handful of files.
+#' The tables scraped from every file are cached in a hidden `.ingest_cache`
+#' directory of the output directory alongside a `manifest.json` holding the
+#' SHA-1 of each file's contents and the stop codes it contains. On later
+#' runs only new or changed files are parsed, the tables of deleted files
+#' are dropped and only the Line files containing an added, changed or
+#' deleted file are rewritten.
+#' Use `--full` to ignore the cache and parse every file. Every file is
+#' also parsed again when `--format` changes.
+#'
+#' # Metrics
+#'
+#' The seconds and rows of each stage of parsing every file, the peak memory
+#' of the process and the seconds and size of every Feather file written
+#' are appended to `metrics.jsonl` in the cache directory by
+#' [IngestMetrics.py](IngestMetrics.html).
 #'
 #' [Source code](https://github.com/ruaridhw/london-tube/blob/master/2_analysis/python/XMLParsing.py)
 
 #+ xmlparsing, engine='python'
+import hashlib
+import json
+import os
+import pickle
+
 import click
+
+# Bump to invalidate every cached file when the scraped tables change
+CACHE_VERSION = 3
+
+CACHE_DIR = '.ingest_cache'
+
+# Tables shared across tube lines and the column identifying each row
+common_keys = {'StopPoints': 'AtcoCode', 'NptgLocalities': 'NptgLocalityRef'}
+
+# Columns of stop codes encoded with the dictionary shared by every table
+stop_columns = {
+    'StopPoints': ['AtcoCode'],
+    'RouteLinks': ['From_StopPointRef', 'To_StopPointRef'],
+    'JourneyPatternTimingLinks': ['From_StopPointRef', 'To_StopPointRef']
+}
+
+# Other columns encoded with a dictionary of their own values.
+# Every column of the Operating Profile tables is also encoded
+categorical_columns = {
+    'StopPoints': ['Place_NptgLocalityRef'],
+    'RouteLinks': ['RouteSections', 'Direction'],
+    'Routes': ['Description', 'RouteSectionRef'],
+    'JourneyPatternTimingLinks': ['JourneyPatternSections', 'From_Activity', 'To_Activity',
+                                  'RouteLinkRef'],
+    'Services': ['Line', 'LineName'],
+    'JourneyPatterns': ['Direction', 'RouteRef', 'JourneyPatternSectionRefs'],
+    'VehicleJourneys': ['ServiceRef', 'LineRef', 'JourneyPatternRef']
+}
+
+# Text columns cast to numbers
+numeric_casts = {
+    'StopPoints': ['Place_Location_Easting', 'Place_Location_Northing'],
+    'RouteLinks': ['Distance'],
+    'JourneyPatternTimingLinks': ['From_SequenceNumber', 'To_SequenceNumber']
+}
+
+def parse_file(file, stream=False, stages=None):
+    """
+        file      Path to a TransXChange XML file
+        stream    Use TfLTimetable.stream_tables rather than
+                  parsing the whole file into memory
+        stages    Optional list appended with a dictionary of the seconds
+                  and rows of each stage. See IngestMetrics.py
+
+        Scrape every table in TfLTimetable.required_xpaths along with
+        the Operating Profile tables from a single file.
+        Durations and times of day are converted to seconds.
+        See TfLTimetable.to_numeric
+        Defined at the top level so that it can be sent to worker processes.
+
+        Returns a dictionary of {tablename: pd.DataFrame}
+    """
+    import time
+
+    import TfLTimetable as tfl
+
+    def record(stage, then, tables, **fields):
+        if stages is not None:
+            stages.append(dict(stage=stage, seconds=time.perf_counter() - then,
+                               rows={table: len(df) for table, df in tables.items()},
+                               **fields))
+
+    then = time.perf_counter()
+    if stream:
+        tables = tfl.TfLTimetable.stream_tables(file)
+        record('stream_tables', then, tables)
+    else:
+        timetable = tfl.TfLTimetable(file)
+        record('parse', then, {})
+        tables = {}
+        for table, paths in timetable.required_xpaths.items():
+            then = time.perf_counter()
+            timings = {}
+            tables[table] = timetable.get_df(paths, timetable.required_roots[table], timings)
+            record('get_df', then, {table: tables[table]}, table=table, xpaths=timings)
+
+        # Parse Operating Periods for VehicleJourneys and Services
+        for op_prof_path in timetable.op_prof_paths:
+            then = time.perf_counter()
+            profiles = timetable.get_varying_child_tags(op_prof_path)
+            record('get_varying_child_tags', then, profiles, path=op_prof_path)
+            tables.update(profiles)
+
+    then = time.perf_counter()
+    tables = tfl.TfLTimetable.to_numeric(tables)
+    record('to_numeric', then, {})
+    return tables
+
+def parse_file_with_metrics(file, stream=False):
+    """
+        Calls parse_file recording the seconds of each stage, the total
+        seconds and the peak RSS of the process. See IngestMetrics.py
+
+        Returns a tuple of the dictionary of {tablename: pd.DataFrame},
+        a list of the dictionaries of the stages and a dictionary of the totals
+    """
+    import time
+
+    from IngestMetrics import peak_rss_mb
+
+    stages = []
+    then = time.perf_counter()
+    tables = parse_file(file, stream, stages)
+    totals = dict(seconds=time.perf_counter() - then,
+                  rows={table: len(df) for table, df in tables.items()},
+                  peak_rss_mb=peak_rss_mb(), pid=os.getpid())
+    return tables, stages, totals
+
+def file_hash(file):
+    """
+        Returns the SHA-1 hex digest of the contents of `file`
+    """
+    sha1 = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def read_manifest(cache_dir, output_format='feather'):
+    """
+        Returns the dictionary of {file name: {'sha1', 'line', 'tables', 'stop_codes'}}
+        stored by the previous run or an empty dictionary if there is
+        none, it was written by a different CACHE_VERSION or the tables
+        were output in a different format
+    """
+    try:
+        with open(os.path.join(cache_dir, 'manifest.json')) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get('version') != CACHE_VERSION or \
+            manifest.get('format', 'feather') != output_format:
+        return {}
+    return manifest['files']
+
+def write_manifest(cache_dir, files, output_format='feather'):
+    with open(os.path.join(cache_dir, 'manifest.json'), 'w') as f:
+        json.dump({'version': CACHE_VERSION, 'format': output_format, 'files': files}, f,
+                  indent=1, sort_keys=True)
+
+def cached_tables_path(cache_dir, file_sans_path):
+    return os.path.join(cache_dir, file_sans_path + '.pickle')
+
+def table_stop_codes(tables):
+    """
+        Returns the sorted list of the stop codes found in `tables`. See stop_columns
+    """
+    codes = set()
+    for table, cols in stop_columns.items():
+        if table in tables:
+            for col in cols:
+                codes.update(tables[table][col].dropna())
+    return sorted(codes)
+
+def encode_table(tablename, df, stop_codes):
+    """
+        tablename     Name of the table
+        df            DataFrame of the table as scraped
+        stop_codes    The shared dictionary of stop codes
+
+        Returns `df` with its categorical and numeric columns converted.
+        See "Encoding"
+    """
+    import numpy as np
+    import pandas as pd
+
+    df = df.copy()
+    for col in stop_columns.get(tablename, []):
+        df[col] = pd.Categorical(df[col], categories=stop_codes)
+    if tablename.startswith(('VehicleJourneys_', 'Services_')):
+        categoricals = df.columns
+    else:
+        categoricals = categorical_columns.get(tablename, [])
+    for col in categoricals:
+        df[col] = df[col].astype('category')
+    for col in numeric_casts.get(tablename, []):
+        values = pd.to_numeric(df[col])
+        df[col] = values.astype(np.int32) if values.notnull().all() else values
+    return df
+
+class KeyedTable(object):
+
+    def __init__(self, key):
+        """
+            key     Name of the column identifying each row
+
+            Accumulates the rows of many DataFrames with the same columns
+            keeping the first row seen for each key. Rows are only turned
+            into a DataFrame once by `to_df` so adding a file costs the
+            size of that file rather than of everything seen so far.
+        """
+        self.key = key
+        self.columns = None
+        self.rows = {}
+        self.conflicts = []
+
+    def add(self, df):
+        """
+            Add the rows of `df`. A row whose key has already been seen is
+            dropped and recorded in `conflicts` if any attribute differs
+        """
+        if self.columns is None:
+            self.columns = list(df.columns)
+        elif list(df.columns) != self.columns:
+            df = df.reindex(columns=self.columns)
+        key_pos = self.columns.index(self.key)
+
+        # Missing values as None so that they compare equal
+        df = df.astype(object).where(df.notnull(), None)
+        for row in df.itertuples(index=False, name=None):
+            existing = self.rows.setdefault(row[key_pos], row)
+            if existing != row:
+                self.conflicts.append((existing, row))
+
+    def report_conflicts(self, tablename, limit=10):
+        """
+            Print the first `limit` rows which had the key of an
+            earlier row but different attributes
+        """
+        if not self.conflicts:
+            return
+        print('Warning: {} {} rows have the {} of an earlier row but differ. '
+              'Keeping the first:'.format(len(self.conflicts), tablename, self.key))
+        for kept, dropped in self.conflicts[:limit]:
+            differences = ['{} {!r} != {!r}'.format(col, a, b)
+                           for col, a, b in zip(self.columns, kept, dropped) if a != b]
+            print('     {} {}: {}'.format(self.key, kept[self.columns.index(self.key)],
+                                          ', '.join(differences)))
+
+    def to_df(self):
+        import pandas as pd
+
+        return pd.DataFrame(list(self.rows.values()), columns=self.columns)
+
 @click.command()
 @click.argument('input_dir', required=1, type=click.Path(exists=True))
 @click.argument('output_dir', required=1, type=click.Path(exists=True))
-def main(input_dir, output_dir):
+@click.option('--jobs', '-j', default=1,
+              help='Number of processes parsing files in parallel. 0 uses every core')
+@click.option('--stream', is_flag=True,
+              help='Stream each file with iterparse to bound memory on very large files')
+@click.option('--full', is_flag=True,
+              help='Parse every file ignoring the tables cached by a previous run')
+@click.option('--metrics', type=click.Path(),
+              help='JSON lines file appended with the metrics of the run. '
+                   'Defaults to metrics.jsonl in the cache directory of OUTPUT_DIR')
+@click.option('--metrics-hook', multiple=True,
+              help='Function called with every metric given as module:function')
+@click.option('--profile', is_flag=True,
+              help='Run under cProfile and write ingest-profile.prof and '
+                   'a summary of the slowest XPaths to ingest-profile.txt in OUTPUT_DIR')
+@click.option('--format', 'output_format', type=click.Choice(['feather', 'parquet']),
+              default='feather',
+              help='Write a Feather file per Line and table or a Parquet dataset '
+                   'per table partitioned by Line')
+def main(input_dir, output_dir, jobs, stream, full, metrics, metrics_hook, profile,
+         output_format):
     """
         This script is used for extracting the full set of features from the
         TransXChange timetable data.
@@ -57,20 +355,79 @@ def main(input_dir, output_dir):
 
         `$python3 python/XMLParsing.py ../1_data/1_1_raw_data/timetables/data ../1_data/1_2_processed_data`
 
+        Each file is parsed independently so with `--jobs N` the files are
+        fanned out across N processes. The per-file tables are merged in the
+        same order as a serial run so the output is identical.
+
+        With `--stream` each file is read with `etree.iterparse` so that
+        memory use does not grow with the size of the XML files.
+
+        Files whose contents have not changed since the last run are not
+        parsed again unless `--full` is given. See "Incremental ingest" above.
+
+        The time of each stage of parsing each file and of writing each
+        table is appended to a JSON lines file and passed to any
+        `--metrics-hook`. With `--profile` the run is profiled by cProfile.
+        Files parsed by other processes with `--jobs` are not seen by
+        cProfile but their XPaths are still in the summary.
+        See [IngestMetrics.py](IngestMetrics.html).
+
+        With `--format parquet` the tables are written as datasets in
+        OUTPUT_DIR/<table>/LineCode=<line>/ which requires pyarrow.
+        See [TableDataset.py](TableDataset.html).
+
         The TfLTimetable module must be in the local path or otherwise installed.
     """
-    import os
+    import concurrent.futures
+    import cProfile
+    import functools
     import re
+    import time
 
     import feather
     import pandas as pd
 
-    import TfLTimetable as tfl
+    from IngestMetrics import IngestMetrics, load_hook, peak_rss_mb, profile_summary
+    from TableDataset import remove_partition, write_partition
+
+    if output_format == 'parquet':
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise click.UsageError('--format parquet requires pyarrow')
 
     data_dir_input = input_dir
     data_dir_output = output_dir
 
-    files_all_lines = os.listdir(data_dir_input)
+    hooks = []
+    for spec in metrics_hook:
+        try:
+            hooks.append(load_hook(spec))
+        except (ValueError, ImportError, AttributeError) as e:
+            raise click.BadParameter(str(e), param_hint='--metrics-hook')
+
+    run_start = time.perf_counter()
+    cache_dir = os.path.join(data_dir_output, CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+    recorder = IngestMetrics(metrics or os.path.join(cache_dir, 'metrics.jsonl'), hooks)
+    if profile:
+        records = []
+        recorder.hooks.append(records.append)
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    def write_table(df, line, tablename):
+        with recorder.timer('write', line=line, table=tablename, rows=len(df),
+                            format=output_format) as fields:
+            df = encode_table(tablename, df, stop_codes)
+            if output_format == 'parquet':
+                path = write_partition(df, data_dir_output, tablename, line)
+            else:
+                path = data_dir_output + "/" + line + "-" + tablename + ".feather"
+                feather.write_dataframe(df, path)
+            fields['bytes'] = os.path.getsize(path)
+
+    files_all_lines = sorted(os.listdir(data_dir_input))
 
     # Pattern match all possible three letter abbreviations of tube lines
     lines = []
@@ -78,65 +435,145 @@ def main(input_dir, output_dir):
         extracted_line = re.search("tfl_1-([A-Z]{3})[^.]+\.xml", file)
         if extracted_line is not None and len(extracted_line.group(1)) > 0:
             lines.append(extracted_line.group(1))
-    lines = list(set(lines))
+    lines = sorted(set(lines))
 
-    output_tables_common = {}
-    for i, line in enumerate(lines):
-        print('---- Scraping Line {} of {}: {}'.format(i + 1, len(lines), line))
+    # Retrieve the full path of all xml files for each line
+    files_by_line = []
+    for line in lines:
         # Filter to specific tube line
         this_line_pattern = "tfl_1-{}[^.]+\.xml".format(line)
-        # Retrieve the full path of all xml files which match `this_line_pattern`
         this_line_files = []
         for file in files_all_lines:
             if re.match(this_line_pattern, file) is not None:
                 this_line_files.append(os.path.join(data_dir_input, file))
+        files_by_line.append((line, this_line_files))
+
+    # Compare the contents of each file with the manifest of the previous run
+    previous = read_manifest(cache_dir, output_format)
+    manifest = {}
+    changed_lines = set()
+    for line, this_line_files in files_by_line:
+        for file in this_line_files:
+            file_sans_path = os.path.basename(file)
+            manifest[file_sans_path] = {'sha1': file_hash(file), 'line': line}
+            if full or previous.get(file_sans_path, {}).get('sha1') != manifest[file_sans_path]['sha1'] or \
+                    not os.path.exists(cached_tables_path(cache_dir, file_sans_path)):
+                changed_lines.add(line)
+            else:
+                manifest[file_sans_path]['tables'] = previous[file_sans_path]['tables']
+                manifest[file_sans_path]['stop_codes'] = previous[file_sans_path]['stop_codes']
+
+    # Drop the cached tables of deleted files
+    for file_sans_path, entry in previous.items():
+        if file_sans_path not in manifest:
+            print('Removing deleted file: {}'.format(file_sans_path))
+            changed_lines.add(entry['line'])
+            if os.path.exists(cached_tables_path(cache_dir, file_sans_path)):
+                os.remove(cached_tables_path(cache_dir, file_sans_path))
+
+    # Parse every new or changed file either serially or across a process pool.
+    # Results are returned in the order of the files regardless of which finishes first
+    to_parse = [file for line, this_line_files in files_by_line for file in this_line_files
+                if 'tables' not in manifest[os.path.basename(file)]]
+    print('Parsing {} of {} files'.format(len(to_parse), len(manifest)))
+    parse = functools.partial(parse_file_with_metrics, stream=stream)
+    if jobs == 1 or not to_parse:
+        executor = None
+        parsed = map(parse, to_parse)
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(jobs or os.cpu_count())
+        parsed = executor.map(parse, to_parse)
+
+    for j, (file, (tables, stages, totals)) in enumerate(zip(to_parse, parsed)):
+        file_sans_path = os.path.basename(file)
+        print('     ---- File {} of {}: {}'.format(j + 1, len(to_parse), file_sans_path))
+        line = manifest[file_sans_path]['line']
+        for stage in stages:
+            recorder.emit('stage', file=file_sans_path, line=line, **stage)
+        recorder.emit('file', file=file_sans_path, line=line, stream=stream, **totals)
+        with open(cached_tables_path(cache_dir, file_sans_path), 'wb') as f:
+            pickle.dump(tables, f, pickle.HIGHEST_PROTOCOL)
+        manifest[file_sans_path]['tables'] = sorted(tables)
+        manifest[file_sans_path]['stop_codes'] = table_stop_codes(tables)
+
+    if executor is not None:
+        executor.shutdown()
+
+    # Every Line is rewritten if the shared dictionary of stop codes has changed
+    stop_codes = sorted({code for entry in manifest.values() for code in entry['stop_codes']})
+    if stop_codes != sorted({code for entry in previous.values()
+                             for code in entry['stop_codes']}):
+        changed_lines |= set(lines)
+
+    output_tables_common = {table: KeyedTable(key) for table, key in common_keys.items()}
+    for i, (line, this_line_files) in enumerate(files_by_line):
+        if line in changed_lines:
+            print('---- Scraping Line {} of {}: {}'.format(i + 1, len(lines), line))
+        else:
+            print('---- Unchanged Line {} of {}: {}'.format(i + 1, len(lines), line))
 
         # Build nested dictionary with the structure
         # {tablename: xml_file: pd.DataFrame}
         output_tables = {}
-        for j, file in enumerate(this_line_files):
+        for file in this_line_files:
             file_sans_path = os.path.basename(file)
-            print('     ---- File {} of {}: {}'.format(j + 1,
-                                                len(this_line_files), file_sans_path))
-            timetable = tfl.TfLTimetable(file)
-            for table, paths in timetable.required_xpaths.items():
-                if table == "NptgLocalities" or table == "StopPoints":
-                    if table not in output_tables_common:
-                        output_tables_common[table] = timetable.get_df(paths)
-                    else:
-                        df = pd.concat([output_tables_common[table],
-                                        timetable.get_df(paths)],
-                                       axis=0)
-                        output_tables_common[table] = df.drop_duplicates()
-                else:
-                    if table not in output_tables:
-                        output_tables[table] = {file_sans_path: timetable.get_df(paths)}
-                    else:
-                        output_tables[table][file_sans_path] = timetable.get_df(paths)
+            with open(cached_tables_path(cache_dir, file_sans_path), 'rb') as f:
+                tables = pickle.load(f)
 
-            # Parse Operating Periods for VehicleJourneys and Services
-            for op_prof_path in timetable.op_prof_paths:
-                op_prof_tables = timetable.get_varying_child_tags(op_prof_path)
-
-                for table, data in op_prof_tables.items():
+            for table, data in tables.items():
+                if table in output_tables_common:
+                    output_tables_common[table].add(data)
+                elif line in changed_lines:
                     if table not in output_tables:
                         output_tables[table] = {file_sans_path: data}
                     else:
                         output_tables[table][file_sans_path] = data
 
+        if line not in changed_lines:
+            continue
+
         # Concatenate tables across XML files and dump to a Feather file
         print('     Dumping tables to output directory: {}'.format(data_dir_output))
         for tablename, files in output_tables.items():
             df = pd.concat(files, axis=0)
             df.drop_duplicates(inplace=True)
-            feather.write_dataframe(df, data_dir_output + "/" + line + "-" +
-                                    tablename + ".feather")
-
-    print('Dumping common tables to output directory: {}'.format(data_dir_output))
-    line = "ALL"
-    for tablename, df in output_tables_common.items():
-        feather.write_dataframe(df, data_dir_output + "/" + line + "-" +
-                                tablename + ".feather")
+            write_table(df, line, tablename)
+
+    # Remove the Line files of tables which no longer appear in any file of the line
+    for line in changed_lines:
+        old_tables = {table for entry in previous.values() if entry['line'] == line
+                      for table in entry['tables']}
+        new_tables = {table for entry in manifest.values() if entry['line'] == line
+                      for table in entry['tables']}
+        for tablename in old_tables - new_tables - set(common_keys):
+            old_file = os.path.join(data_dir_output, line + "-" + tablename + ".feather")
+            if os.path.exists(old_file):
+                os.remove(old_file)
+            remove_partition(data_dir_output, tablename, line)
+
+    if changed_lines:
+        print('Dumping common tables to output directory: {}'.format(data_dir_output))
+        line = "ALL"
+        for tablename, common_table in output_tables_common.items():
+            if common_table.columns is None:
+                continue
+            common_table.report_conflicts(tablename)
+            write_table(common_table.to_df(), line, tablename)
+
+    write_manifest(cache_dir, manifest, output_format)
+
+    recorder.emit('run', files=len(manifest), parsed=len(to_parse),
+                  lines_written=len(changed_lines), jobs=jobs, stream=stream,
+                  seconds=time.perf_counter() - run_start, peak_rss_mb=peak_rss_mb())
+    recorder.close()
+
+    if profile:
+        profiler.disable()
+        profiler.dump_stats(os.path.join(data_dir_output, 'ingest-profile.prof'))
+        summary = profile_summary(profiler, records)
+        with open(os.path.join(data_dir_output, 'ingest-profile.txt'), 'w') as f:
+            f.write(summary)
+        print(summary)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,124 @@
+"""
+    Fixtures shared by the tests: a small synthetic timetable taken through
+    the whole pipeline once per test session and random queries between
+    its stations
+"""
+import os
+import sys
+
+import pytest
+
+# The analysis modules import one another as top level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# A Monday within the Operating Periods of the synthetic Services
+timetable_date = '2017-12-18'
+
+@pytest.fixture(scope='session')
+def xml_dir(tmp_path_factory):
+    """
+        Directory of synthetic TransXChange files
+    """
+    from SyntheticTransXChange import generate
+
+    path = str(tmp_path_factory.mktemp('xml'))
+    generate(path, n_lines=3, n_stops=12, n_files=2, n_patterns=2, n_journeys=40, seed=0)
+    return path
+
+def ingest(input_dir, output_dir, *args):
+    """
+        Run XMLParsing.py on `input_dir`
+    """
+    import XMLParsing
+
+    XMLParsing.main.main([input_dir, output_dir] + list(args), standalone_mode=False)
+
+@pytest.fixture(scope='session')
+def data_dir(xml_dir, tmp_path_factory):
+    """
+        Directory of the Feather files of `xml_dir`
+    """
+    path = str(tmp_path_factory.mktemp('feather'))
+    ingest(xml_dir, path)
+    return path
+
+@pytest.fixture(scope='session')
+def tables(data_dir):
+    from Departures import read_tables
+
+    return read_tables(data_dir)
+
+@pytest.fixture(scope='session')
+def board(tables):
+    """
+        The departure board of every journey running on `timetable_date`
+    """
+    from Departures import departure_board
+
+    return departure_board(tables, timetable_date)
+
+@pytest.fixture(scope='session')
+def graph(board):
+    """
+        The Departures Board DiGraph of `board`
+    """
+    from DeparturesGraph import DeparturesGraph
+
+    return DeparturesGraph.from_departureboard(board).to_networkx()
+
+@pytest.fixture(scope='session')
+def station_names(graph):
+    return sorted({n_data['StopPointName'] for n, n_data in graph.nodes(data=True)
+                   if n not in ('Start', 'End')})
+
+@pytest.fixture(scope='session')
+def queries(station_names):
+    """
+        Leave After and Arrive Before queries between random stations
+    """
+    from Benchmarks import random_queries
+
+    return random_queries(station_names, 150, seed=0)
+
+@pytest.fixture(scope='session')
+def cs(graph):
+    """
+        The ConnectionScan of `graph`
+    """
+    from ConnectionScan import ConnectionScan
+
+    return ConnectionScan.from_graph(graph)
+
+@pytest.fixture(scope='session')
+def timetable(cs, tmp_path_factory):
+    """
+        Directory of `cs` written by TimetableStore.py
+    """
+    from TimetableStore import write_timetable
+
+    path = str(tmp_path_factory.mktemp('timetable'))
+    write_timetable(cs, path, timetable_date=timetable_date)
+    return path
+
+@pytest.fixture(scope='session')
+def reference(graph):
+    """
+        The Dijkstra search of ShortestPath.py that the other planners must agree with
+    """
+    from ShortestPath import JourneyPlanner
+
+    return JourneyPlanner(graph, astar=False)
+
+def assert_same_journey(expected, found, path_query):
+    """
+        Journeys may differ in their legs when several are equally good
+        so only what the query asks for is compared: the earliest arrival
+        of a Leave After query or the latest start of an Arrive Before query
+    """
+    assert (expected is None) == (found is None), path_query
+    if expected is None:
+        return
+    if path_query['leave_after']:
+        assert found.end_time == pytest.approx(expected.end_time), path_query
+    else:
+        assert found.start_time == pytest.approx(expected.start_time), path_query
@@ -0,0 +1,11 @@
+from BatchPlanner import make_tasks, plan_journeys
+
+def test_batch_matches_single_queries(cs, timetable, queries):
+    expected = [cs.find_journey(query) for query in queries]
+    for jobs, task_size in ((1, 500), (2, 20)):
+        planned = dict(plan_journeys(timetable, queries, jobs, task_size))
+        assert [planned[i] for i in range(len(queries))] == expected
+
+def test_tasks_cover_every_query(queries):
+    tasks = make_tasks(queries, task_size=20)
+    assert sorted(i for task in tasks for i, path_query in task) == list(range(len(queries)))
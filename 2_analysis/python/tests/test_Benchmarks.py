@@ -0,0 +1,26 @@
+import json
+
+import click
+import pytest
+
+from Benchmarks import suite
+
+suite_args = ['--lines', '2', '--stops', '10', '--vehicle-journeys', '30', '--queries', '20']
+
+def test_suite(tmp_path):
+    output = str(tmp_path / 'suite.json')
+    suite.main(suite_args + ['--output', output], standalone_mode=False)
+    with open(output) as f:
+        results = json.load(f)
+    assert results['ingest']['files'] == 4 and results['ingest']['rows'] > 0
+    assert results['graph']['nodes'] > 0 and results['graph']['edges'] > 0
+    assert sorted(results['query']) == ['csa', 'dijkstra']
+    for query in results['query'].values():
+        assert query['queries'] == 20 and query['differ'] == 0
+
+def test_suite_fails_when_journeys_differ(monkeypatch):
+    from ConnectionScan import ConnectionScan
+
+    monkeypatch.setattr(ConnectionScan, 'find_journey', lambda self, path_query: None)
+    with pytest.raises(click.ClickException, match='differ from the Dijkstra search'):
+        suite.main(suite_args, standalone_mode=False)
@@ -0,0 +1,24 @@
+from conftest import assert_same_journey
+
+def test_find_journey_matches_dijkstra(cs, reference, queries):
+    for query in queries:
+        assert_same_journey(reference.find_journey(query), cs.find_journey(query), query)
+
+def test_same_station_has_no_legs(cs, station_names):
+    query = {'From_StopPointName': station_names[0], 'To_StopPointName': station_names[0],
+             'time': 9 * 60, 'leave_after': True}
+    journey = cs.find_journey(query)
+    assert journey.legs == [] and journey.cost == 0
+
+def test_legs_follow_on(cs, queries):
+    for query in queries:
+        journey = cs.find_journey(query)
+        if journey is None:
+            continue
+        for leg, next_leg in zip(journey.legs, journey.legs[1:]):
+            assert leg.alight_stop == next_leg.board_stop
+            assert leg.alight_time <= next_leg.board_time
+        if journey.legs and query['leave_after']:
+            assert journey.legs[0].board_time >= query['time']
+        elif journey.legs:
+            assert journey.legs[-1].alight_time <= query['time']
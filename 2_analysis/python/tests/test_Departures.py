@@ -0,0 +1,88 @@
+import datetime
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from conftest import timetable_date
+from Departures import departure_board, stop_points
+from DeparturesGraph import departureboard_columns
+from TfLTimetable import TfLTimetable
+
+sql_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))), 'sql')
+
+# DaysOfWeekGroups.sql
+day_groups = {'MondayToFriday': range(1, 6), 'MondayToSaturday': range(1, 7),
+              'MondayToSunday': range(1, 8), 'Weekend': range(6, 8),
+              'Monday': [1], 'Tuesday': [2], 'Wednesday': [3], 'Thursday': [4],
+              'Friday': [5], 'Saturday': [6], 'Sunday': [7]}
+
+def r_tables(tables):
+    """
+        The tables uploaded by FeatherUpload.R after the conversions of VariableCreation.R
+    """
+    text = lambda df: df.astype({col: object for col in df.columns
+                                 if df[col].dtype.name in ('category', 'string', 'str')})
+    journeys = text(tables['VehicleJourneys'])
+    seconds = TfLTimetable.time_of_day_seconds(journeys['DepartureTime'])
+    journeys = journeys.assign(DepartureMins=(seconds // 3600 % 24) * 60 + seconds // 60 % 60,
+                               DepartureTime=None)
+
+    links = text(tables['JourneyPatternTimingLinks'])
+    run_time = TfLTimetable.duration_seconds(links['RunTime']) // 60
+    wait_time = TfLTimetable.duration_seconds(links['WaitTime']) // 60
+    links = links.assign(From_SequenceNumber=pd.to_numeric(links['From_SequenceNumber']),
+                         To_SequenceNumber=pd.to_numeric(links['To_SequenceNumber']),
+                         RunTime=run_time, WaitTime=wait_time,
+                         JourneyTime=run_time + np.where(np.isnan(wait_time), 0, wait_time))
+
+    converted = {name: text(df) for name, df in tables.items() if df is not None}
+    converted.update(VehicleJourneys=journeys, JourneyPatternTimingLinks=links,
+                     StopPoints=stop_points(tables['StopPoints']))
+    converted['DaysOfWeek_Groups'] = pd.DataFrame(
+        [(day, group) for group, days in day_groups.items() for day in days],
+        columns=['DayIndex', 'DayGroup'])
+    return converted
+
+def sql_departureboard(tables, date):
+    """
+        The departureboard function of DepartureBoard.sql run by SQLite
+    """
+    with open(os.path.join(sql_dir, 'DepartureBoard.sql')) as f:
+        query = f.read().split('$BODY$')[1]
+    isodow = datetime.date(*map(int, date.split('-'))).isoweekday()
+    for postgres, sqlite in [
+            ('SUBSTRING("LineRef" FROM 3 FOR 3)', 'SUBSTR("LineRef", 3, 3)'),
+            ("DATE_PART('ISODOW',\n                                                           "
+             "CAST(_timetable_date AS date))", str(isodow)),
+            ('CAST(_timetable_date AS date)', "'{}'".format(date))]:
+        assert postgres in query
+        query = query.replace(postgres, sqlite)
+
+    conn = sqlite3.connect(':memory:')
+    try:
+        for name, df in r_tables(tables).items():
+            df.to_sql(name, conn, index=False)
+        df = pd.read_sql_query(query, conn)
+    finally:
+        conn.close()
+    df['Flag_LastStop'] = df['Flag_LastStop'].astype(bool)
+    return df
+
+def test_board_matches_sql(tables):
+    expected = sql_departureboard(tables, timetable_date)
+    board = departure_board(tables, timetable_date)
+    assert len(board) > 0
+    order = ['VehicleJourneyCode', 'From_VehicleSequenceNumber']
+    expected = expected.sort_values(order).reset_index(drop=True)[departureboard_columns]
+    board = board.sort_values(order).reset_index(drop=True)
+    pd.testing.assert_frame_equal(board, expected, check_dtype=False)
+
+def test_journey_times_are_whole_minutes(board, tables):
+    assert (board['JourneyTime'] % 1 == 0).all()
+    assert (board['DepartureMins_Link'] % 1 == 0).all()
+    # The synthetic WaitTimes of 30 seconds are dropped as by VariableCreation.R
+    assert (TfLTimetable.duration_seconds(tables['JourneyPatternTimingLinks']['WaitTime'])
+            == 30).any()
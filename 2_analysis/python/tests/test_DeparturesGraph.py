@@ -0,0 +1,73 @@
+import os
+
+import networkx as nx
+
+from conftest import timetable_date
+from DeparturesGraph import DeparturesGraph, main, read_gpickle
+
+def notebook_graph(board):
+    """
+        The Departures Board graph built one row at a time as the
+        Visualising Data notebook does
+    """
+    H = nx.DiGraph()
+    prev_row = None
+    rows = board.sort_values(['From_StopPointName', 'DepartureMins_Link', 'VehicleJourneyCode'],
+                             kind='mergesort').to_dict('records')
+    for row in rows:
+        H.add_node(row['VehicleJourneyCode'] + '//' + row['From_StopPointRef'],
+                   VehicleJourneyCode=row['VehicleJourneyCode'],
+                   StopPointName=row['From_StopPointName'],
+                   MinuteOfDay=row['DepartureMins_Link'])
+        if row['Flag_LastStop'] == True:
+            H.add_node(row['VehicleJourneyCode'] + '//' + row['To_StopPointRef'],
+                       VehicleJourneyCode=row['VehicleJourneyCode'],
+                       StopPointName=row['To_StopPointName'],
+                       MinuteOfDay=row['ArrivalMins_Link'])
+        H.add_edge(row['VehicleJourneyCode'] + '//' + row['From_StopPointRef'],
+                   row['VehicleJourneyCode'] + '//' + row['To_StopPointRef'],
+                   movement=row['Line'], cost=row['JourneyTime'])
+        if prev_row is not None and prev_row['From_StopPointName'] == row['From_StopPointName']:
+            H.add_edge(prev_row['VehicleJourneyCode'] + '//' + prev_row['From_StopPointRef'],
+                       row['VehicleJourneyCode'] + '//' + row['From_StopPointRef'],
+                       movement='Stay',
+                       cost=row['DepartureMins_Link'] - prev_row['DepartureMins_Link'])
+        prev_row = row
+    return H
+
+def test_matches_notebook_graph(board):
+    expected = notebook_graph(board)
+    H = DeparturesGraph.from_departureboard(board, transfers=False).to_networkx()
+    assert dict(H.nodes(data=True)) == dict(expected.nodes(data=True))
+    assert {(u, v): d for u, v, d in H.edges(data=True)} == \
+           {(u, v): d for u, v, d in expected.edges(data=True)}
+
+def test_transfers_only_add_stay_edges(board):
+    H = DeparturesGraph.from_departureboard(board, transfers=False).to_networkx()
+    G = DeparturesGraph.from_departureboard(board).to_networkx()
+    assert dict(G.nodes(data=True)) == dict(H.nodes(data=True))
+    added = set(G.edges) - set(H.edges)
+    assert added and set(H.edges) <= set(G.edges)
+    for u, v in added:
+        assert G.edges[u, v]['movement'] == 'Stay' and G.edges[u, v]['cost'] >= 0
+        assert G.nodes[u]['StopPointName'] == G.nodes[v]['StopPointName']
+
+def test_same_minute_departures_reach_each_other(board):
+    G = DeparturesGraph.from_departureboard(board).to_networkx()
+    free = nx.DiGraph([(u, v) for u, v, d in G.edges(data=True)
+                       if d['movement'] == 'Stay' and d['cost'] == 0])
+    departures = board.assign(node=board['VehicleJourneyCode'] + '//' + board['From_StopPointRef'])
+    tied = [group['node'].tolist()
+            for key, group in departures.groupby(['From_StopPointName', 'DepartureMins_Link'])
+            if len(group) > 1]
+    assert tied
+    for nodes in tied:
+        for u in nodes:
+            assert set(nodes) <= nx.descendants(free, u) | {u}
+
+def test_main_writes_graph(data_dir, graph, tmp_path):
+    main(['--data-dir', data_dir, '--output-dir', str(tmp_path), timetable_date],
+         standalone_mode=False)
+    H = read_gpickle(os.path.join(str(tmp_path), 'DeparturesGraph20171218.gpickle'))
+    assert dict(H.nodes(data=True)) == dict(graph.nodes(data=True))
+    assert set(H.edges) == set(graph.edges)
@@ -0,0 +1,93 @@
+import glob
+import json
+import os
+
+import click
+import pytest
+
+from conftest import ingest
+from IngestMetrics import IngestMetrics, hot_xpaths
+
+# Metrics passed to `record_metric` by XMLParsing.py --metrics-hook
+received = []
+
+def record_metric(record):
+    received.append(record)
+
+@pytest.fixture(scope='module')
+def metrics_run(xml_dir, tmp_path_factory):
+    """
+        The metrics of a profiled ingest of `xml_dir` given to a hook
+        and written to a JSON lines file
+    """
+    output_dir = str(tmp_path_factory.mktemp('metrics'))
+    metrics_file = os.path.join(output_dir, 'metrics.jsonl')
+    del received[:]
+    ingest(xml_dir, output_dir, '--metrics', metrics_file,
+           '--metrics-hook', 'test_IngestMetrics:record_metric', '--profile')
+    with open(metrics_file) as f:
+        lines = [json.loads(line) for line in f]
+    return list(received), lines, output_dir
+
+def test_hook_receives_every_event(metrics_run, xml_dir):
+    records, lines, output_dir = metrics_run
+    files = sorted(os.path.basename(f) for f in glob.glob(os.path.join(xml_dir, '*.xml')))
+    assert len({record['run'] for record in records}) == 1
+
+    stages = [record for record in records if record['event'] == 'stage']
+    assert {record['stage'] for record in stages} == \
+        {'parse', 'get_df', 'get_varying_child_tags', 'to_numeric'}
+    assert {record['file'] for record in stages} == set(files)
+    for record in stages:
+        assert record['seconds'] >= 0 and isinstance(record['rows'], dict)
+        if record['stage'] == 'get_df':
+            assert record['table'] in record['rows'] and record['xpaths']
+
+    file_records = [record for record in records if record['event'] == 'file']
+    assert sorted(record['file'] for record in file_records) == files
+    for record in file_records:
+        assert record['rows']['VehicleJourneys'] > 0 and record['stream'] is False
+        assert record['seconds'] > 0 and record['pid'] == os.getpid()
+
+    writes = [record for record in records if record['event'] == 'write']
+    assert {record['line'] for record in writes} == \
+        {file.split('-')[1] for file in files} | {'ALL'}
+    for record in writes:
+        path = os.path.join(output_dir, '{}-{}.feather'.format(record['line'], record['table']))
+        assert record['bytes'] == os.path.getsize(path) and record['format'] == 'feather'
+
+    run, = [record for record in records if record['event'] == 'run']
+    assert run['files'] == run['parsed'] == len(files)
+    assert run['lines_written'] == 3 and run['jobs'] == 1 and run['seconds'] > 0
+    assert records[-1] == run
+
+def test_json_lines_match_hook(metrics_run):
+    records, lines, output_dir = metrics_run
+    assert lines == records
+    for record in lines:
+        assert {'event', 'run'} <= set(record)
+
+def test_profile(metrics_run):
+    records, lines, output_dir = metrics_run
+    assert os.path.getsize(os.path.join(output_dir, 'ingest-profile.prof')) > 0
+    with open(os.path.join(output_dir, 'ingest-profile.txt')) as f:
+        summary = f.read()
+    seconds, calls, table, column = hot_xpaths(records, limit=1)[0]
+    assert 'Slowest XPaths' in summary and '{}: {}'.format(table, column) in summary
+    assert 'Slowest functions' in summary
+
+def test_emit(tmp_path):
+    path = str(tmp_path / 'metrics.jsonl')
+    hooked = []
+    with IngestMetrics(path, [hooked.append]) as recorder:
+        record = recorder.emit('write', line='XAA', rows=3)
+        with recorder.timer('stage', stage='to_numeric') as fields:
+            fields['rows'] = {}
+    assert record == dict(event='write', run=recorder.run, line='XAA', rows=3)
+    with open(path) as f:
+        assert [json.loads(line) for line in f] == hooked
+    assert hooked[1]['seconds'] >= 0 and hooked[1]['stage'] == 'to_numeric'
+
+def test_bad_hook(xml_dir, tmp_path):
+    with pytest.raises(click.BadParameter):
+        ingest(xml_dir, str(tmp_path), '--metrics-hook', 'no_function')
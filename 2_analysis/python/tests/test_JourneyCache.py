@@ -0,0 +1,49 @@
+import random
+
+import pytest
+
+from JourneyCache import JourneyCache
+
+@pytest.fixture(scope='module')
+def peak_queries(station_names):
+    """
+        Queries between a few station pairs within minutes of each other
+        so that most of them are answered by the cache
+    """
+    rnd = random.Random(0)
+    pairs = [rnd.sample(station_names, 2) for _ in range(10)]
+    pairs.append([station_names[0], station_names[0]])
+    queries = []
+    for _ in range(1000):
+        origin, destination = rnd.choice(pairs)
+        queries.append({'From_StopPointName': origin, 'To_StopPointName': destination,
+                        'time': rnd.randrange(8 * 60, 9 * 60) + rnd.choice([0, 0.5]),
+                        'leave_after': rnd.random() < 0.6})
+    return queries
+
+@pytest.mark.parametrize('planner', ['cs', 'reference'])
+def test_cached_journeys_match_planner(request, planner, peak_queries):
+    planner = request.getfixturevalue(planner)
+    journey_cache = JourneyCache(planner, bucket=15)
+    for query in peak_queries:
+        assert journey_cache.find_journey(query) == planner.find_journey(query), query
+    assert journey_cache.cache_info().hits > len(peak_queries) / 2
+
+def test_leave_after_hit_starts_at_query_time(cs, station_names):
+    journey_cache = JourneyCache(cs)
+    query = {'From_StopPointName': station_names[0], 'To_StopPointName': station_names[-1],
+             'time': 8 * 60, 'leave_after': True}
+    first = journey_cache.find_journey(query)
+    later = journey_cache.find_journey(dict(query, time=query['time'] + 0.5))
+    assert journey_cache.cache_info().hits == 1
+    assert later.legs == first.legs
+    assert later.start_time == query['time'] + 0.5
+    assert later.cost == later.end_time - later.start_time
+
+def test_load_clears_cache(cs, queries):
+    journey_cache = JourneyCache(cs)
+    journey_cache.find_journey(queries[0])
+    journey_cache.load(cs)
+    assert journey_cache.cache_info().currsize == 0
+    journey_cache.find_journey(queries[0])
+    assert journey_cache.cache_info().misses == 2
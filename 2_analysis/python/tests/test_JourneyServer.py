@@ -0,0 +1,146 @@
+import asyncio
+import json
+import os
+import shutil
+import threading
+import urllib.parse
+
+import pytest
+
+from Benchmarks import _http
+from ConnectionScan import ConnectionScan
+from JourneyServer import JourneyServer
+from ShortestPath import journey_to_dict
+
+def run_server(timetable, test, **kwargs):
+    """
+        Run the coroutine function `test(server, request)` against a
+        JourneyServer of `timetable` listening on a free port, where
+        `request(method, path, payload)` sends one request on a new connection
+
+        Returns the result of `test`
+    """
+    async def run():
+        server = JourneyServer(timetable, **kwargs)
+        listening = await server.start('127.0.0.1', 0)
+        port = listening.sockets[0].getsockname()[1]
+
+        async def request(method, path, payload=None):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            try:
+                return await _http(reader, writer, method, path, payload)
+            finally:
+                writer.close()
+
+        try:
+            return await test(server, request)
+        finally:
+            listening.close()
+            server.pool.shutdown()
+
+    return asyncio.run(run())
+
+async def wait_until(condition):
+    while not condition():
+        await asyncio.sleep(0.01)
+
+@pytest.fixture
+def gate(monkeypatch):
+    """
+        A threading.Event every search waits for before finding its journey
+        so that requests can be sent while the searches are in flight
+    """
+    event = threading.Event()
+    find_journey = ConnectionScan.find_journey
+
+    def gated(self, path_query):
+        assert event.wait(30)
+        return find_journey(self, path_query)
+
+    monkeypatch.setattr(ConnectionScan, 'find_journey', gated)
+    yield event
+    event.set()
+
+def test_identical_requests_share_one_search(timetable, cs, queries, gate):
+    query = queries[0]
+    n_requests = 8
+    target = '/journey?' + urllib.parse.urlencode(query)
+
+    async def test(server, request):
+        # Half as URL parameters and half as JSON, which are the same query once parsed
+        requests = [asyncio.ensure_future(request('POST', '/journey', query) if i % 2 else
+                                          request('GET', target))
+                    for i in range(n_requests)]
+        await asyncio.wait_for(
+            wait_until(lambda: server.counts['coalesced'] == n_requests - 1), 30)
+        assert server.counts['searches'] == 1 and len(server._in_flight) == 1
+        gate.set()
+        responses = await asyncio.gather(*requests)
+        return responses, (await request('GET', '/metrics'))[1]
+
+    responses, metrics = run_server(timetable, test)
+    expected = json.loads(json.dumps(journey_to_dict(cs.find_journey(query))))
+    assert responses == [(200, {'journey': expected})] * n_requests
+    assert metrics['searches'] == 1 and metrics['coalesced'] == n_requests - 1
+    assert metrics['requests'] == n_requests + 1 and metrics['errors'] == 0
+    assert metrics['in_flight'] == 0
+    assert metrics['latency']['request']['count'] == n_requests
+    assert metrics['latency']['search']['count'] == 1
+
+def test_reload_with_requests_in_flight(timetable, cs, queries, gate):
+    batch = list({json.dumps(query, sort_keys=True): query for query in queries[:10]}.values())
+
+    async def test(server, request):
+        before = [asyncio.ensure_future(request('POST', '/journey', query)) for query in batch]
+        await asyncio.wait_for(wait_until(lambda: len(server._in_flight) == len(batch)), 30)
+        # The old pool is still searching while the new one is swapped in
+        reloaded = await request('POST', '/reload')
+        assert not any(future.done() for future in before)
+        after = [asyncio.ensure_future(request('POST', '/journey', query)) for query in batch]
+        await asyncio.wait_for(wait_until(lambda: len(server._in_flight) == 2 * len(batch)), 30)
+        gate.set()
+        responses = await asyncio.gather(*before + after)
+        return reloaded, responses, (await request('GET', '/metrics'))[1]
+
+    (status, reloaded), responses, metrics = run_server(timetable, test)
+    assert status == 200 and reloaded['version'] == 2 and reloaded['timetable'] == timetable
+    expected = [(200, {'journey': json.loads(json.dumps(journey_to_dict(cs.find_journey(query))))})
+                for query in batch]
+    assert responses == expected * 2
+    assert metrics['version'] == 2 and metrics['reloads'] == 1
+    assert metrics['searches'] == 2 * len(batch) and metrics['coalesced'] == 0
+    assert metrics['requests'] == 2 * len(batch) + 2 and metrics['errors'] == 0
+    assert metrics['latency']['request']['count'] == 2 * len(batch)
+
+def test_reload_only_allowed_timetables(timetable, tmp_path):
+    timetable_dir = tmp_path / 'timetables'
+    timetable_dir.mkdir()
+    shutil.copytree(timetable, str(timetable_dir / 'other'))
+    outside = tmp_path / 'outside.gpickle'
+    outside.write_bytes(b'')
+    os.symlink(str(outside), str(timetable_dir / 'link.gpickle'))
+
+    async def test(server, request):
+        responses = {}
+        for name in [str(outside), '../outside.gpickle', 'link.gpickle', str(timetable_dir),
+                     'missing', 'other', str(timetable), None]:
+            payload = {} if name is None else {'timetable': name}
+            responses[name] = await request('POST', '/reload', payload)
+        return responses
+
+    responses = run_server(timetable, test, timetable_dir=str(timetable_dir))
+    for name in [str(outside), '../outside.gpickle', 'link.gpickle', str(timetable_dir)]:
+        status, response = responses[name]
+        assert status == 403 and 'timetable directory' in response['error']
+    assert responses['missing'][0] == 400
+    assert responses['other'] == (200, dict(responses['other'][1], version=2,
+                                            timetable=str(timetable_dir / 'other')))
+    assert responses[str(timetable)][1]['version'] == 3
+    assert responses[None][1] == dict(responses[None][1], version=4, timetable=str(timetable))
+
+    async def test(server, request):
+        return [await request('POST', '/reload', {'timetable': name})
+                for name in [str(timetable_dir / 'other'), timetable]]
+
+    (status, response), reloaded = run_server(timetable, test)
+    assert status == 403 and reloaded[0] == 200
@@ -0,0 +1,84 @@
+import datetime
+
+import pytest
+
+from conftest import assert_same_journey, timetable_date
+from ServiceCalendar import ServiceCalendar, bank_holidays, dated_timetable, easter_sunday
+
+# Weekdays of the DaysOfWeek of the synthetic timetables
+weekdays = {'MondayToFriday': {0, 1, 2, 3, 4}, 'Saturday': {5}, 'Sunday': {6},
+            'MondayToSunday': {0, 1, 2, 3, 4, 5, 6}}
+
+# Bank holidays of the Operating Periods of the synthetic timetables
+holiday_dates = {'ChristmasDay': datetime.date(2017, 12, 25),
+                 'BoxingDay': datetime.date(2017, 12, 26),
+                 'NewYearsDay': datetime.date(2018, 1, 1),
+                 'GoodFriday': datetime.date(2018, 3, 30),
+                 'EasterMonday': datetime.date(2018, 4, 2)}
+
+dates = [datetime.date(2017, 11, 30), datetime.date(2018, 7, 1)] + \
+    list(holiday_dates.values()) + \
+    [datetime.date(2017, 12, 18) + datetime.timedelta(d) for d in range(21)]
+
+def test_bank_holidays():
+    assert easter_sunday(2018) == datetime.date(2018, 4, 1)
+    assert easter_sunday(2019) == datetime.date(2019, 4, 21)
+    holidays = set(bank_holidays(2017)) | set(bank_holidays(2018))
+    assert set(holiday_dates.values()) <= holidays
+    # Christmas Day 2022 was a Sunday so the substitute day is the Tuesday
+    assert datetime.date(2022, 12, 27) in bank_holidays(2022)
+
+def running_journeys(tables, date):
+    """
+        The VehicleJourneyCodes running on `date` by evaluating the
+        Operating Profile of each journey in turn
+    """
+    services = tables['Services'].set_index('ServiceCode')
+    journey_days = {}
+    for journey, days in tables['VehicleJourneys_RegularDayType_DaysOfWeek'][
+            ['VehicleJourneys', 'DaysOfWeek']].values.tolist():
+        journey_days.setdefault(journey, set()).update(weekdays[days])
+    service_days = {}
+    for service, days in tables['Services_RegularDayType_DaysOfWeek'][
+            ['Services', 'DaysOfWeek']].values.tolist():
+        service_days.setdefault(service, set()).update(weekdays[days])
+    non_operation = {}
+    table = tables['VehicleJourneys_BankHolidayOperation_DaysOfNonOperation']
+    for journey, holiday in table[['VehicleJourneys', 'DaysOfNonOperation']].values.tolist():
+        non_operation.setdefault(journey, set()).add(holiday_dates[holiday])
+
+    running = set()
+    for journey, service in tables['VehicleJourneys'][
+            ['VehicleJourneyCode', 'ServiceRef']].values.tolist():
+        start = datetime.date.fromisoformat(services.loc[service, 'OpPeriod_StartDate'])
+        end = datetime.date.fromisoformat(services.loc[service, 'OpPeriod_EndDate'])
+        if start <= date <= end and \
+                date.weekday() in journey_days.get(journey, weekdays['MondayToSunday']) and \
+                date.weekday() in service_days.get(service, weekdays['MondayToSunday']) and \
+                date not in non_operation.get(journey, set()):
+            running.add(journey)
+    return running
+
+@pytest.fixture(scope='module')
+def calendar(data_dir):
+    return ServiceCalendar.from_directory(data_dir)
+
+@pytest.mark.parametrize('date', dates, ids=str)
+def test_runs_on_matches_operating_profiles(calendar, tables, date):
+    running = {journey for journey, runs in zip(calendar.journeys, calendar.runs_on(date)) if runs}
+    assert running == running_journeys(tables, date)
+
+def test_calendar_restricts_journeys(calendar):
+    assert 0 < calendar.runs_on('2017-12-23').sum() < calendar.runs_on('2017-12-18').sum()
+    assert calendar.runs_on('2017-11-30').sum() == 0
+
+def test_dated_timetable_matches_board_of_date(tables, calendar, reference, queries):
+    from ConnectionScan import ConnectionScan
+    from Departures import departure_board
+    from DeparturesGraph import DeparturesGraph
+
+    every_journey = DeparturesGraph.from_departureboard(departure_board(tables)).to_networkx()
+    dated = dated_timetable(ConnectionScan.from_graph(every_journey), calendar)
+    for query in queries:
+        query = dict(query, date=timetable_date)
+        assert_same_journey(reference.find_journey(query), dated.find_journey(query), query)
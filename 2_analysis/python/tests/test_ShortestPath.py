@@ -0,0 +1,20 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from ShortestPath import JourneyPlanner
+
+@pytest.mark.parametrize('astar', [False, True])
+def test_concurrent_queries_match_serial(graph, queries, astar):
+    planner = JourneyPlanner(graph, astar=astar)
+    n_nodes, n_edges = graph.number_of_nodes(), graph.number_of_edges()
+    edges = set(graph.edges)
+
+    expected = [planner.find_journey(query) for query in queries]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for _ in range(3):
+            assert list(executor.map(planner.find_journey, queries)) == expected
+
+    assert graph.number_of_nodes() == n_nodes and graph.number_of_edges() == n_edges
+    assert 'Start' not in graph and 'End' not in graph
+    assert set(graph.edges) == edges
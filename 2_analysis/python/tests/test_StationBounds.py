@@ -0,0 +1,39 @@
+import pytest
+
+from conftest import assert_same_journey
+
+@pytest.fixture(scope='module')
+def a_star(graph):
+    from ShortestPath import JourneyPlanner
+
+    return JourneyPlanner(graph)
+
+def test_astar_matches_dijkstra(a_star, reference, queries):
+    for query in queries:
+        assert_same_journey(reference.find_journey(query), a_star.find_journey(query), query)
+
+def test_astar_settles_fewer_nodes(a_star, reference, queries):
+    for query in queries:
+        settled = []
+        for planner in (reference, a_star):
+            stats = {}
+            planner.find_path(query, stats)
+            settled.append(stats['settled'])
+        assert settled[1] <= settled[0], query
+
+def test_bounds_are_admissible(a_star, reference, queries):
+    """
+        No leg nor journey is faster than the static bound between its stations
+    """
+    bounds = a_star.bounds
+    codes = {station: i for i, station in enumerate(bounds.stations)}
+    for query in queries:
+        journey = reference.find_journey(query)
+        if journey is None or not journey.legs:
+            continue
+        for leg in journey.legs:
+            bound = bounds.distances[codes[leg.board_stop], codes[leg.alight_stop]]
+            assert leg.alight_time - leg.board_time >= bound - 1e-9, query
+        first, last = journey.legs[0], journey.legs[-1]
+        bound = bounds.distances[codes[first.board_stop], codes[last.alight_stop]]
+        assert last.alight_time - first.board_time >= bound - 1e-9, query
@@ -0,0 +1,149 @@
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import assert_same_journey
+import StationIndex
+from StationIndex import StationLocations, StationNames, walk_speed
+
+@pytest.fixture(scope='module')
+def stop_points(tables):
+    return tables['StopPoints']
+
+@pytest.fixture(scope='module')
+def located(stop_points):
+    """
+        The station name and coordinates of every StopPoint
+    """
+    x = pd.to_numeric(stop_points['Place_Location_Easting']).values.astype(np.float64)
+    y = pd.to_numeric(stop_points['Place_Location_Northing']).values.astype(np.float64)
+    return stop_points['Descriptor_CommonName'].astype(object).values, x, y
+
+def points(located, n, margin):
+    stations, x, y = located
+    rnd = np.random.RandomState(0)
+    return np.column_stack([rnd.uniform(x.min() - margin, x.max() + margin, n),
+                            rnd.uniform(y.min() - margin, y.max() + margin, n)]).tolist()
+
+def scan(located, easting, northing):
+    """
+        The distance to the nearest StopPoint of every station by measuring every StopPoint
+    """
+    stations, x, y = located
+    nearest = {}
+    for distance, station in zip(np.hypot(x - easting, y - northing).tolist(), stations.tolist()):
+        if distance < nearest.get(station, np.inf):
+            nearest[station] = distance
+    return sorted((distance, station) for station, distance in nearest.items())
+
+@pytest.mark.parametrize('cell', [250.0, 500.0, 5000.0])
+def test_within_matches_scan(located, cell):
+    index = StationLocations(*located, cell=cell)
+    for easting, northing in points(located, 300, 2000):
+        expected = [found for found in scan(located, easting, northing) if found[0] <= 3000]
+        assert index.within(easting, northing, 3000) == expected
+
+@pytest.mark.parametrize('cell', [250.0, 500.0, 5000.0])
+def test_nearest_matches_scan(located, cell):
+    index = StationLocations(*located, cell=cell)
+    for easting, northing in points(located, 300, 20000):
+        for k in (1, 3):
+            expected = scan(located, easting, northing)[:k]
+            found = index.nearest(easting, northing, k)
+            assert [distance for distance, station in found] == \
+                [distance for distance, station in expected]
+
+def test_empty_index():
+    index = StationLocations([], [], [])
+    assert index.nearest(0.0, 0.0) == [] and index.within(0.0, 0.0, 1000) == []
+
+def test_coordinate_queries_match_dijkstra(graph, stop_points, located):
+    from ConnectionScan import ConnectionScan
+    from ShortestPath import JourneyPlanner
+
+    reference = JourneyPlanner(graph, stop_points=stop_points, astar=False)
+    cs = ConnectionScan.from_graph(graph, stop_points=stop_points)
+    rnd = random.Random(0)
+    for easting, northing in points(located, 60, 500):
+        destination = rnd.choice(sorted(cs.stop_names))
+        for leave_after in (True, False):
+            query = {'From_Easting': easting, 'From_Northing': northing,
+                     'To_StopPointName': destination, 'time': rnd.uniform(7 * 60, 20 * 60),
+                     'leave_after': leave_after}
+            assert_same_journey(reference.find_journey(query), cs.find_journey(query), query)
+            reverse = {'From_StopPointName': destination, 'To_Easting': easting,
+                       'To_Northing': northing, 'time': query['time'],
+                       'leave_after': leave_after}
+            assert_same_journey(reference.find_journey(reverse), cs.find_journey(reverse),
+                                reverse)
+
+def test_walk_without_trains(graph, stop_points, located):
+    from ConnectionScan import ConnectionScan
+    from ShortestPath import JourneyPlanner
+
+    stations, x, y = located
+    index = StationLocations(stations, x, y)
+    # A point 400 metres from one station and at least 1000 from any other
+    for station, easting, northing in zip(stations.tolist(), x.tolist(), y.tolist()):
+        near = index.within(easting + 400, northing, 1000)
+        if len(near) == 1:
+            break
+    else:
+        pytest.skip('No StopPoint is 1000 metres from every other station')
+    for planner in (JourneyPlanner(graph, stop_points=stop_points, astar=False),
+                    ConnectionScan.from_graph(graph, stop_points=stop_points)):
+        for leave_after in (True, False):
+            journey = planner.find_journey({'From_Easting': easting + 400,
+                                            'From_Northing': northing,
+                                            'To_StopPointName': station, 'time': 9 * 60,
+                                            'leave_after': leave_after})
+            assert journey.legs == []
+            assert journey.cost == pytest.approx(near[0][0] / walk_speed)
+            assert (journey.start_time if leave_after else journey.end_time) == 9 * 60
+
+@pytest.fixture
+def names():
+    stop_points = pd.DataFrame({
+        'AtcoCode': ['940GZZLUBNK', '940GZZLULVT', '940GZZLUHPC'],
+        'CommonName': ['Bank Underground Station', 'Liverpool Street Underground Station',
+                       'Hyde Park Corner Underground Station']
+    })
+    atco_codes = {'940GZZLUBNK': 'Bank', '940GZZLULVT': 'Liverpool Street',
+                  '940GZZLUHPC': 'Hyde Park Corner'}
+    return StationNames(['Bank', 'Bankside', 'Liverpool Street', 'Hyde Park Corner',
+                         'Hyde Park Road', "King's Cross St. Pancras"],
+                        atco_codes, stop_points, fuzzy=True)
+
+def test_bank_is_not_bankside(names):
+    assert names.resolve('Bank') == ['Bank']
+    assert names.resolve('Bankside') == ['Bankside']
+    assert names.resolve('bank station') == ['Bank']
+
+def test_resolve_atco_code(names):
+    assert names.resolve('940GZZLULVT') == ['Liverpool Street']
+
+def test_resolve_alias(names):
+    assert names.resolve('Liverpool Street Underground Station') == ['Liverpool Street']
+    assert names.resolve('kings cross st pancras') == ["King's Cross St. Pancras"]
+
+def test_resolve_leading_words(names):
+    assert names.resolve('Hyde Park') == ['Hyde Park Corner', 'Hyde Park Road']
+    assert names.resolve('Kings Cross') == ["King's Cross St. Pancras"]
+
+def test_resolve_fuzzy(names):
+    assert names.resolve('Liverpool St') == ['Liverpool Street']
+    names.fuzzy = False
+    assert names.resolve('Liverpol Street') == []
+    # Only leading words match
+    assert names.resolve('Park Corner') == []
+
+def test_resolved_names_are_bounded(monkeypatch):
+    monkeypatch.setattr(StationIndex, 'max_resolved', 2)
+    names = StationNames(['Bank', 'Bankside'])
+    for name in ['Bank', 'Bankside', 'Angel', 'Oval', 'Bank']:
+        names.resolve(name)
+    info = names._resolved.cache_info()
+    assert info.currsize == 2 and info.hits == 0
+    assert names.resolve('Bank') == ['Bank'] and names._resolved.cache_info().hits == 1
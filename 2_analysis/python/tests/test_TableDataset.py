@@ -0,0 +1,103 @@
+import os
+import shutil
+
+import pandas as pd
+import pytest
+
+from conftest import ingest, timetable_date
+from Departures import departure_board, read_tables, required_tables
+from TableDataset import common_line, idle_lines, is_dataset, table_lines
+
+@pytest.fixture(scope='module')
+def output_dirs(xml_dir, tmp_path_factory):
+    """
+        Feather files and Parquet datasets of `xml_dir` with the Services
+        of one Line ending before `timetable_date`
+    """
+    path = tmp_path_factory.mktemp('dataset')
+    input_dir = str(path / 'xml')
+    shutil.copytree(xml_dir, input_dir)
+    ended_line = sorted(os.listdir(input_dir))[-1].split('-')[1]
+    for file in os.listdir(input_dir):
+        if file.split('-')[1] == ended_line:
+            with open(os.path.join(input_dir, file)) as f:
+                xml = f.read()
+            with open(os.path.join(input_dir, file), 'w') as f:
+                f.write(xml.replace('<EndDate>2018-06-30<', '<EndDate>2017-12-10<'))
+
+    feather_dir, dataset_dir = str(path / 'feather'), str(path / 'dataset')
+    os.mkdir(feather_dir)
+    os.mkdir(dataset_dir)
+    ingest(input_dir, feather_dir)
+    ingest(input_dir, dataset_dir, '--format', 'parquet')
+    return feather_dir, dataset_dir, ended_line
+
+def decoded(df):
+    """
+        `df` with the categoricals of the datasets as plain values
+    """
+    return df.apply(lambda col: col.astype(object) if col.dtype.kind not in 'biuf' else col)
+
+def assert_same_tables(found, expected):
+    assert sorted(found) == sorted(expected)
+    for tablename, df in expected.items():
+        assert (df is None) == (found[tablename] is None), tablename
+        if df is not None:
+            pd.testing.assert_frame_equal(decoded(found[tablename]), decoded(df),
+                                          check_dtype=False, obj=tablename)
+
+def test_parquet_layout(output_dirs):
+    feather_dir, dataset_dir, _ = output_dirs
+    assert is_dataset(dataset_dir, 'VehicleJourneys')
+    assert not is_dataset(feather_dir, 'VehicleJourneys')
+    assert table_lines(dataset_dir, 'VehicleJourneys') == table_lines(feather_dir, 'VehicleJourneys')
+    assert table_lines(dataset_dir, 'StopPoints') == [common_line]
+
+@pytest.mark.parametrize('kwargs', [
+    dict(columns=None),
+    dict(),
+    dict(timetable_date=timetable_date),
+    dict(timetable_date='2016-01-01'),
+])
+def test_dataset_matches_feather(output_dirs, kwargs):
+    feather_dir, dataset_dir, _ = output_dirs
+    assert_same_tables(read_tables(dataset_dir, required_tables, **kwargs),
+                       read_tables(feather_dir, required_tables, **kwargs))
+
+def test_line_pruning(output_dirs):
+    feather_dir, dataset_dir, _ = output_dirs
+    lines = table_lines(feather_dir, 'VehicleJourneys')[:1]
+    every_line = read_tables(feather_dir, required_tables, columns=None)
+    for data_dir in (feather_dir, dataset_dir):
+        tables = read_tables(data_dir, required_tables, columns=None, lines=lines)
+        services = tables['Services']
+        assert set(services['LineName']) == set(lines)
+        expected = every_line['Services'][every_line['Services']['ServiceCode'].isin(
+            services['ServiceCode'])].reset_index(drop=True)
+        pd.testing.assert_frame_equal(decoded(services), decoded(expected), check_dtype=False)
+        # StopPoints are common to every Line
+        assert_same_tables({'StopPoints': tables['StopPoints']},
+                           {'StopPoints': every_line['StopPoints']})
+
+def test_idle_lines(output_dirs):
+    feather_dir, dataset_dir, ended_line = output_dirs
+    every_line = set(table_lines(feather_dir, 'Services'))
+    for data_dir in (feather_dir, dataset_dir):
+        assert idle_lines(data_dir, timetable_date) == {ended_line}
+        assert idle_lines(data_dir, '2017-12-05') == set()
+        assert idle_lines(data_dir, '2016-01-01') == every_line
+
+def test_date_pruning_keeps_board(output_dirs):
+    """
+        Skipping the Lines not running on a date leaves the journeys of that date
+    """
+    feather_dir, dataset_dir, ended_line = output_dirs
+    expected = departure_board(read_tables(feather_dir), timetable_date)
+    for data_dir in (feather_dir, dataset_dir):
+        services = read_tables(data_dir, ['Services'], columns=None,
+                               timetable_date=timetable_date)['Services']
+        assert ended_line not in set(services['LineName'])
+        tables = read_tables(data_dir, timetable_date=timetable_date)
+        board = departure_board(tables, timetable_date)
+        assert len(board) > 0
+        pd.testing.assert_frame_equal(decoded(board), decoded(expected), check_dtype=False)
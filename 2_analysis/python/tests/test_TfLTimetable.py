@@ -0,0 +1,89 @@
+import glob
+import os
+
+import numpy as np
+
+import TfLTimetable as tfl
+
+def as_strings(df):
+    # The XPath results are string subclasses
+    return [[None if value is None or value != value else str(value) for value in row]
+            for row in df.astype(object).values.tolist()]
+
+def test_single_pass_matches_by_column(xml_dir):
+    for file in sorted(glob.glob(os.path.join(xml_dir, '*.xml'))):
+        timetable = tfl.TfLTimetable(file)
+        for table, paths in timetable.required_xpaths.items():
+            expected = timetable.get_df_by_column(paths)
+            df = timetable.get_df(paths, timetable.required_roots[table])
+            assert list(df.columns) == list(expected.columns), table
+            assert as_strings(df) == as_strings(expected), table
+
+def test_stream_tables_match_get_df(xml_dir):
+    for file in sorted(glob.glob(os.path.join(xml_dir, '*.xml'))):
+        timetable = tfl.TfLTimetable(file)
+        expected = {table: timetable.get_df(paths, timetable.required_roots[table])
+                    for table, paths in timetable.required_xpaths.items()}
+        for op_prof_path in timetable.op_prof_paths:
+            expected.update(timetable.get_varying_child_tags(op_prof_path))
+        assert any('_RegularDayType_' in table for table in expected)
+
+        tables = tfl.TfLTimetable.stream_tables(file)
+        assert sorted(tables) == sorted(expected)
+        for table, df in expected.items():
+            assert list(tables[table].columns) == list(df.columns), table
+            assert as_strings(tables[table]) == as_strings(df), table
+
+def test_iter_rows_profiles_match_get_profile_rows(xml_dir):
+    for file in sorted(glob.glob(os.path.join(xml_dir, '*.xml'))):
+        timetable = tfl.TfLTimetable(file)
+        expected = [row for path in timetable.op_prof_paths for e in timetable.get_xpath(path)
+                    for row in timetable.get_profile_rows(e)]
+        tablenames = {tablename for tablename, cols, row in expected}
+        rows = [row for row in tfl.TfLTimetable.iter_rows(file) if row[0] in tablenames]
+        assert expected and sorted(rows) == sorted(expected)
+
+def r_minutes(duration):
+    """
+        The whole minutes of VariableCreation.R: as.integer(substr(duration, 3, 3))
+    """
+    digit = duration[2:3] if duration is not None else ''
+    return int(digit) if digit.isdigit() else None
+
+def r_departure_mins(time_of_day):
+    """
+        The DepartureMins of VariableCreation.R: minute(t) + 60 * hour(t)
+    """
+    hours, minutes = time_of_day.split(':')[:2]
+    return int(hours) * 60 + int(minutes)
+
+def test_duration_seconds():
+    seconds = tfl.TfLTimetable.duration_seconds(['PT2M30S', 'PT12M', 'PT1H2M', 'PT0S', 'PT45.5S',
+                                                 'P1DT1S', None, 'PT', 'soon'])
+    assert seconds[:6].tolist() == [150, 720, 3720, 0, 45.5, 86401]
+    assert np.isnan(seconds[6:]).all()
+
+def test_time_of_day_seconds():
+    seconds = tfl.TfLTimetable.time_of_day_seconds(['05:32:00', '23:59:30', '24:10', None])
+    assert seconds[:3].tolist() == [19920, 86370, 87000]
+    assert np.isnan(seconds[3])
+
+def test_seconds_match_r_conversion(xml_dir):
+    files = sorted(glob.glob(os.path.join(xml_dir, '*.xml')))
+    tables = [tfl.TfLTimetable.stream_tables(file) for file in files]
+    for table, col, convert, r_conversion in [
+            ('JourneyPatternTimingLinks', 'RunTime', 'duration_seconds', r_minutes),
+            ('JourneyPatternTimingLinks', 'WaitTime', 'duration_seconds', r_minutes),
+            ('VehicleJourneys', 'DepartureTime', 'time_of_day_seconds', r_departure_mins)]:
+        values = [value for t in tables for value in t[table][col].tolist()
+                  if isinstance(value, str)]
+        assert values, col
+        seconds = getattr(tfl.TfLTimetable, convert)(values)
+        assert (seconds // 60).tolist() == [r_conversion(value) for value in values], col
+
+def test_ingest_writes_seconds(tables):
+    links = tables['JourneyPatternTimingLinks']
+    assert links['RunTime'].dtype == np.float64
+    assert (links['RunTime'] % 30 == 0).all()
+    assert links['WaitTime'].isnull().any() and links['WaitTime'].notnull().any()
+    assert tables['VehicleJourneys']['DepartureTime'].dtype == np.float64
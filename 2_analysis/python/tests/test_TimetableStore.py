@@ -0,0 +1,34 @@
+import os
+
+import numpy as np
+
+from DeparturesGraph import write_gpickle
+from TimetableStore import columns, load_timetable, main, read_meta, read_timetable
+
+def test_round_trip(cs, timetable, queries):
+    for mmap in (True, False):
+        stored = read_timetable(timetable, mmap=mmap)
+        for col in columns:
+            assert np.array_equal(getattr(stored, col), getattr(cs, col)), col
+        assert stored.stop_names == cs.stop_names
+        assert [stored.find_journey(query) for query in queries] == \
+            [cs.find_journey(query) for query in queries]
+
+def test_columns_are_read_only(timetable):
+    stored = read_timetable(timetable)
+    assert not stored.dep_time.flags.writeable
+
+def test_meta(timetable, cs):
+    meta = read_meta(timetable)
+    assert meta['n_connections'] == len(cs)
+    assert meta['timetable_date'] == '2017-12-18'
+
+def test_gpickle(cs, graph, queries, tmp_path):
+    gpickle = os.path.join(str(tmp_path), 'DeparturesGraph20171218.gpickle')
+    write_gpickle(graph, gpickle)
+    expected = [cs.find_journey(query) for query in queries]
+    assert [load_timetable(gpickle).find_journey(query) for query in queries] == expected
+
+    output_dir = os.path.join(str(tmp_path), 'DeparturesTimetable20171218')
+    main([gpickle, output_dir], standalone_mode=False)
+    assert [load_timetable(output_dir).find_journey(query) for query in queries] == expected
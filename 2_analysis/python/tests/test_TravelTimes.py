@@ -0,0 +1,23 @@
+import numpy as np
+
+from TravelTimes import travel_time_matrix
+
+minutes = np.arange(7 * 60, 10 * 60, 13.0)
+
+def test_matrix_matches_journeys(cs, timetable):
+    names, matrix = travel_time_matrix(timetable, minutes)
+    assert names == list(cs.stop_names)
+    for i, origin in enumerate(names):
+        for j, destination in enumerate(names):
+            for k, minute in enumerate(minutes.tolist()):
+                journey = cs.find_journey({'From_StopPointName': origin,
+                                           'To_StopPointName': destination,
+                                           'time': minute, 'leave_after': True})
+                expected = np.inf if journey is None else journey.end_time - minute
+                assert matrix[i, j, k] == np.float32(expected), (origin, destination, minute)
+
+def test_processes_match_serial(timetable):
+    serial = travel_time_matrix(timetable, minutes)
+    pooled = travel_time_matrix(timetable, minutes, jobs=2)
+    assert serial[0] == pooled[0]
+    assert np.array_equal(serial[1], pooled[1])
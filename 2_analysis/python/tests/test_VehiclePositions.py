@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from VehiclePositions import VehiclePositions
+
+def trains_point_in_time(df, t):
+    """
+        The VehicleJourneyCodes of NumberOfTrainsPointInTime.sql at minute `t`
+    """
+    by_vehicle = df.groupby('VehicleJourneyCode')
+    running = (by_vehicle['DepartureMins_Link'].transform('min') <= t) & \
+        (by_vehicle['ArrivalMins_Link'].transform('max') > t)
+    return set(df.loc[running, 'VehicleJourneyCode'])
+
+@pytest.fixture(scope='module')
+def positions(board):
+    return VehiclePositions(board)
+
+minutes = np.arange(5 * 60, 24 * 60, 7.5)
+
+def test_at_matches_sql(positions, board):
+    for t in minutes:
+        trains = positions.at(t)
+        assert set(trains['VehicleJourneyCode']) == trains_point_in_time(board, t), t
+        assert trains['VehicleJourneyCode'].is_unique, t
+        assert positions.count(t) == len(trains)
+
+def test_positions_between_stops(positions, board):
+    stops = dict(zip(board['From_StopPointName'], zip(board['From_Longitude'],
+                                                      board['From_Latitude'])))
+    stops.update(zip(board['To_StopPointName'], zip(board['To_Longitude'],
+                                                    board['To_Latitude'])))
+    trains = positions.at(8 * 60 + 3.25)
+    assert len(trains)
+    assert ((trains['Progress'] >= 0) & (trains['Progress'] < 1)).all()
+    for row in trains.itertuples():
+        (from_lon, from_lat), (to_lon, to_lat) = stops[row.From_StopPointName], \
+            stops[row.To_StopPointName]
+        assert row.Longitude == pytest.approx(from_lon + row.Progress * (to_lon - from_lon))
+        assert row.Latitude == pytest.approx(from_lat + row.Progress * (to_lat - from_lat))
+
+def test_frames_match_at(positions):
+    start, end, step = minutes[0], minutes[-1] + 1, 7.5
+    frames = positions.frames(start, end, step)
+    assert frames['Frame'].is_monotonic_increasing
+    for frame, t in enumerate(minutes):
+        expected = positions.at(t)
+        found = frames[frames['Frame'] == frame].drop(columns=['Frame', 'Minute'])
+        if expected.empty:
+            assert found.empty, t
+            continue
+        sort = ['VehicleJourneyCode']
+        assert found.sort_values(sort).reset_index(drop=True).equals(
+            expected.sort_values(sort).reset_index(drop=True)), t
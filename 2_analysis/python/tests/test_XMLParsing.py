@@ -0,0 +1,86 @@
+import os
+import shutil
+
+import feather
+import pandas as pd
+import pytest
+
+from conftest import ingest
+from TableDataset import read_table, table_lines
+from XMLParsing import CACHE_DIR, KeyedTable
+
+def output_tables(data_dir):
+    """
+        Returns a dictionary of {(tablename, line): DataFrame} of every
+        table written to `data_dir` in either format
+    """
+    tablenames = set()
+    for name in os.listdir(data_dir):
+        if name == CACHE_DIR:
+            continue
+        tablenames.add(name[:-len('.feather')].split('-', 1)[1] if name.endswith('.feather')
+                       else name)
+    return {(tablename, line): read_table(data_dir, tablename, lines=[line])
+            for tablename in tablenames for line in table_lines(data_dir, tablename)}
+
+def assert_same_output(data_dir, expected_dir):
+    tables, expected = output_tables(data_dir), output_tables(expected_dir)
+    assert sorted(tables) == sorted(expected)
+    for key, df in expected.items():
+        assert tables[key].equals(df), key
+
+@pytest.mark.parametrize('output_format', ['feather', 'parquet'])
+def test_incremental_matches_full(xml_dir, tmp_path, output_format):
+    input_dir = str(tmp_path / 'xml')
+    shutil.copytree(xml_dir, input_dir)
+    incremental, full = str(tmp_path / 'incremental'), str(tmp_path / 'full')
+    os.mkdir(incremental)
+    os.mkdir(full)
+    ingest(input_dir, incremental, '--format', output_format)
+
+    # Delete every file of one Line and change a file of another
+    files = sorted(os.listdir(input_dir))
+    deleted_line = files[-1].split('-')[1]
+    for file in files:
+        if file.split('-')[1] == deleted_line:
+            os.remove(os.path.join(input_dir, file))
+    with open(os.path.join(input_dir, files[0])) as f:
+        xml = f.read()
+    with open(os.path.join(input_dir, files[0]), 'w') as f:
+        f.write(xml.replace('<DepartureTime>06:', '<DepartureTime>05:', 1))
+
+    ingest(input_dir, incremental, '--format', output_format)
+    ingest(input_dir, full, '--format', output_format, '--full')
+    assert deleted_line not in table_lines(incremental, 'VehicleJourneys')
+    assert_same_output(incremental, full)
+
+def test_jobs_match_serial(xml_dir, data_dir, tmp_path):
+    parallel = str(tmp_path)
+    ingest(xml_dir, parallel, '--jobs', '2')
+    files = sorted(f for f in os.listdir(data_dir) if f.endswith('.feather'))
+    assert files and sorted(f for f in os.listdir(parallel) if f.endswith('.feather')) == files
+    for file in files:
+        pd.testing.assert_frame_equal(feather.read_dataframe(os.path.join(parallel, file)),
+                                      feather.read_dataframe(os.path.join(data_dir, file)),
+                                      obj=file)
+
+def test_keyed_table_keeps_first_row(capsys):
+    stop_points = KeyedTable('AtcoCode')
+    stop_points.add(pd.DataFrame({'AtcoCode': ['940GZZLUBNK', '940GZZLUWLO'],
+                                  'CommonName': ['Bank', 'Waterloo'],
+                                  'Place_Location_Easting': ['532700', None]}))
+    # An identical duplicate, a conflicting duplicate and a new StopPoint
+    stop_points.add(pd.DataFrame({'AtcoCode': ['940GZZLUWLO', '940GZZLUBNK', '940GZZLUOVL'],
+                                  'CommonName': ['Waterloo', 'Bank Station', 'Oval'],
+                                  'Place_Location_Easting': [None, '532700', '531000']}))
+    df = stop_points.to_df()
+    assert df['AtcoCode'].tolist() == ['940GZZLUBNK', '940GZZLUWLO', '940GZZLUOVL']
+    assert df['CommonName'].tolist() == ['Bank', 'Waterloo', 'Oval']
+    assert stop_points.conflicts == [(('940GZZLUBNK', 'Bank', '532700'),
+                                      ('940GZZLUBNK', 'Bank Station', '532700'))]
+
+    stop_points.report_conflicts('StopPoints')
+    out = capsys.readouterr().out
+    assert '1 StopPoints rows have the AtcoCode of an earlier row' in out
+    assert "AtcoCode 940GZZLUBNK: CommonName 'Bank' != 'Bank Station'" in out
+    assert 'Waterloo' not in out